@@ -0,0 +1,224 @@
+"""A content-addressed store on local disk for the bodies of upstream
+responses.
+
+When a BlobStore is configured, the content of a cached upstream
+Representation is written to the store, and the Representation itself
+only holds a reference to it: REFERENCE_MARKER followed by the SHA-256
+of the content. Identical bodies -- such as the many VIAF and Classify
+pages that say "no results" -- are only stored once, and the
+representations table stays small.
+
+The store is a cache like any other. When it grows past its size
+budget, the least recently used blobs are deleted, and a
+Representation whose blob is gone has to be fetched again.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+
+REFERENCE_MARKER = b"\x00blob\x00"
+
+
+class BlobStore(object):
+
+    # Set this environment variable to a directory to keep upstream
+    # response bodies there instead of in the database. Every process
+    # that reads or writes cached upstream documents must see the same
+    # directory.
+    DIRECTORY_VARIABLE = 'SIMPLIFIED_BLOB_STORE_DIRECTORY'
+
+    # The size budget, in megabytes.
+    BUDGET_VARIABLE = 'SIMPLIFIED_BLOB_STORE_BUDGET'
+    DEFAULT_BUDGET = 10 * 1024
+
+    # When the store goes over budget, delete blobs until it's down
+    # to this fraction of the budget, so eviction doesn't have to run
+    # again right away.
+    LOW_WATER_MARK = 0.9
+
+    # Check the size of the store after this fraction of the budget
+    # has been written by this process.
+    EVICTION_INTERVAL = 0.05
+
+    # Blobs are written to temporary files whose names start with
+    # this, which no digest does.
+    TEMPORARY_PREFIX = '.tmp-'
+
+    _default = None
+
+    @classmethod
+    def default(cls):
+        """The BlobStore configured through the environment, or None if
+        upstream response bodies are kept in the database.
+        """
+        directory = os.environ.get(cls.DIRECTORY_VARIABLE)
+        if not directory:
+            return None
+        if not cls._default or cls._default.directory != directory:
+            budget = int(os.environ.get(cls.BUDGET_VARIABLE, cls.DEFAULT_BUDGET))
+            cls._default = cls(directory, budget * 1024 * 1024)
+        return cls._default
+
+    def __init__(self, directory, budget):
+        """Constructor.
+
+        :param directory: Where to keep the blobs.
+        :param budget: The most space, in bytes, the blobs should take
+            up.
+        """
+        self.directory = directory
+        self.budget = budget
+        self.written = 0
+        self.log = logging.getLogger("Blob store")
+
+    @classmethod
+    def digest(cls, content):
+        return hashlib.sha256(content).hexdigest()
+
+    @classmethod
+    def reference(cls, digest):
+        """The value stored in Representation.content in place of the
+        blob with the given digest.
+        """
+        return REFERENCE_MARKER + digest.encode("ascii")
+
+    @classmethod
+    def is_reference(cls, content):
+        return isinstance(content, bytes) and content.startswith(REFERENCE_MARKER)
+
+    def path(self, digest):
+        """Where the blob with the given digest lives.
+
+        Blobs are sharded into two levels of directories, so no one
+        directory gets too big.
+        """
+        return os.path.join(self.directory, digest[:2], digest[2:4], digest)
+
+    def put(self, content):
+        """Add a blob to the store.
+
+        :return: The blob's digest.
+        """
+        digest = self.digest(content)
+        path = self.path(digest)
+        if os.path.exists(path):
+            # We already have this blob. Using it again counts as
+            # using it recently.
+            self.touch(path)
+            return digest
+
+        shard = os.path.dirname(path)
+        os.makedirs(shard, exist_ok=True)
+
+        # Write to a temporary file and move it into place, so no
+        # other process ever sees a partly written blob.
+        fd, temporary = tempfile.mkstemp(
+            dir=shard, prefix=self.TEMPORARY_PREFIX
+        )
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                out.write(content)
+            os.replace(temporary, path)
+        except Exception:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+        self.written += len(content)
+        if self.written >= self.budget * self.EVICTION_INTERVAL:
+            self.written = 0
+            self.evict()
+        return digest
+
+    def get(self, digest):
+        """Read a blob from the store.
+
+        :return: The blob's content, or None if it's not in the store.
+        """
+        path = self.path(digest)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+        self.touch(path)
+        return content
+
+    def contains(self, reference):
+        """Is the blob that a reference refers to still in the store?
+
+        This doesn't read the blob, or count as using it.
+        """
+        return os.path.exists(self.path(self.referenced_digest(reference)))
+
+    def touch(self, path):
+        """Mark a blob as recently used."""
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # It was evicted in the meantime.
+            pass
+
+    def store(self, content):
+        """Add `content` to the store and return a reference to it."""
+        return self.reference(self.put(content))
+
+    @classmethod
+    def referenced_digest(cls, reference):
+        """The digest of the blob a reference refers to."""
+        return reference[len(REFERENCE_MARKER):].decode("ascii")
+
+    def resolve(self, content):
+        """Turn a reference back into the content it refers to.
+
+        :return: The content, or None if the blob has been evicted.
+            Anything that's not a reference is returned as-is.
+        """
+        if not self.is_reference(content):
+            return content
+        return self.get(self.referenced_digest(content))
+
+    def blobs(self):
+        """Yield a (last used, size, path) 3-tuple for every blob.
+
+        Blobs that are still being written are left out.
+        """
+        for directory, subdirectories, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.startswith(self.TEMPORARY_PREFIX):
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def evict(self):
+        """Delete the least recently used blobs until the store is under
+        budget.
+
+        :return: A 2-tuple (blobs deleted, bytes freed).
+        """
+        blobs = sorted(self.blobs())
+        total = sum(size for last_used, size, path in blobs)
+        if total <= self.budget:
+            return 0, 0
+
+        target = self.budget * self.LOW_WATER_MARK
+        deleted = freed = 0
+        for last_used, size, path in blobs:
+            if total - freed <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another process got to it first.
+                pass
+            deleted += 1
+            freed += size
+        self.log.info(
+            "Evicted %d blobs (%d bytes) to stay under budget.", deleted, freed
+        )
+        return deleted, freed
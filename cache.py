@@ -0,0 +1,101 @@
+"""Small in-process caches."""
+import functools
+from collections import OrderedDict
+
+from core.util.datetime_helpers import utc_now
+
+
+class LRUCache(object):
+    """A dictionary that holds on to at most `capacity` items, throwing
+    out the least recently used item when it fills up.
+
+    If `max_age` is set, an item is also thrown out once it's that old.
+    """
+
+    def __init__(self, capacity, max_age=None, clock=utc_now):
+        """Constructor.
+
+        :param capacity: The maximum number of items to hold.
+        :param max_age: A timedelta, or None if items never go stale.
+        :param clock: A drop-in replacement for utc_now, for use in
+            tests.
+        """
+        self.capacity = capacity
+        self.max_age = max_age
+        self.clock = clock
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def hit_rate(self):
+        """The fraction of lookups that found what they were looking
+        for, or None if there haven't been any lookups.
+        """
+        lookups = self.hits + self.misses
+        if not lookups:
+            return None
+        return self.hits / float(lookups)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, default=None, count=True):
+        """Look up an item, marking it as recently used.
+
+        :param count: Count this lookup towards `hits` and `misses`.
+        """
+        if key in self.items:
+            value, timestamp = self.items[key]
+            if not self.max_age or timestamp > self.clock() - self.max_age:
+                self.items.move_to_end(key)
+                if count:
+                    self.hits += 1
+                return value
+            # The item has gone stale.
+            del self.items[key]
+        if count:
+            self.misses += 1
+        return default
+
+    def set(self, key, value, timestamp=None):
+        """Add an item to the cache.
+
+        :param timestamp: When the value was obtained, if that was
+            before now. The item's age is measured from this time.
+        """
+        if key in self.items:
+            del self.items[key]
+        self.items[key] = (value, timestamp or self.clock())
+        while len(self.items) > self.capacity:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+
+def memoize(capacity):
+    """Decorator that remembers the return values of a function in an
+    LRUCache of the given capacity.
+
+    The function's arguments must be hashable. The cache is available
+    as the `cache` attribute of the decorated function.
+    """
+    missing = object()
+    def decorator(f):
+        cache = LRUCache(capacity)
+
+        @functools.wraps(f)
+        def memoized(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            value = cache.get(key, missing)
+            if value is missing:
+                value = f(*args, **kwargs)
+                cache.set(key, value)
+            return value
+        memoized.cache = cache
+        return memoized
+    return decorator
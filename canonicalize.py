@@ -2,25 +2,38 @@
 import logging
 import os
 import re
+from collections import defaultdict
+
+from sqlalchemy import distinct
+from sqlalchemy.sql.functions import func
 
 from oclc.linked_data import OCLCLinkedData
 from viaf import VIAFClient, MockVIAFClient
 
 from core.model import (
+    Contribution,
     Contributor,
+    Edition,
     Identifier,
+    get_one,
 )
 
-from core.util.personal_names import (
-    contributor_name_match_ratio, 
-    display_name_to_sort_name,
-    is_corporate_name,
-    name_tidy, 
-)
+from core.util.personal_names import is_corporate_name
 from core.util.titles import (
     title_match_ratio, 
 )
 
+from model import (
+    AuthorityName,
+    AuthorityToken,
+)
+from personal_names import (
+    contributor_name_match_ratio,
+    display_name_to_sort_name,
+    name_tidy,
+    normalize_contributor_name_for_matching,
+)
+
 
 
 class CanonicalizationError(Exception):
@@ -28,6 +41,193 @@ class CanonicalizationError(Exception):
 
 
 
+class TitleScorer(object):
+    """Decides whether a title is close enough to one of a set of known
+    titles, remembering the answer for every title it's asked about.
+
+    Many editions of the same book share a title, so this saves a lot
+    of calls to title_match_ratio.
+    """
+
+    # 80% similarity -- close enough.
+    THRESHOLD = 80
+
+    def __init__(self, known_titles):
+        self.known_titles = list(known_titles or [])
+        self.scores = {}
+
+    def score(self, title):
+        """How similar is `title` to the most similar known title?"""
+        if title not in self.scores:
+            self.scores[title] = max(
+                title_match_ratio(known_title, title)
+                for known_title in self.known_titles
+            )
+        return self.scores[title]
+
+    def matches(self, title):
+        if not title or not self.known_titles:
+            return False
+        return self.score(title) >= self.THRESHOLD
+
+
+
+class AuthorityIndex(object):
+    """A local name-authority index built from our own Contributors.
+
+    Every Contributor with a display name and a sort name gets an
+    AuthorityName, keyed on its normalized display name, and an
+    AuthorityToken for each word in that key. A display name that
+    doesn't exactly match any Contributor's can then be matched against
+    Contributors whose names are nearly the same, without going out to
+    VIAF.
+
+    The index is kept up to date by monitor.AuthorityIndexSweep.
+    """
+
+    # Two normalized names must be at least this similar, out of 100,
+    # to be considered the same name.
+    THRESHOLD = 90
+
+    # Only score this many of the entries that share words with a name.
+    MAX_CANDIDATES = 50
+
+    # A name with this many words or fewer only matches entries that
+    # share all of its words. Otherwise, "Mark Twain" would be scored
+    # against every Mark in the index.
+    SHORT_NAME = 2
+
+    WORD = re.compile(r"\w+", re.UNICODE)
+
+    def __init__(self, _db):
+        self._db = _db
+        self.log = logging.getLogger("Authority index")
+
+    @classmethod
+    def key(cls, name):
+        """Normalize a display name for matching."""
+        return normalize_contributor_name_for_matching(name) or ""
+
+    @classmethod
+    def tokens(cls, key):
+        """Split a normalized name into words, treating punctuation as
+        a word break so that "j.r.r." and "j. r. r." come out the same.
+        """
+        return set(cls.WORD.findall(key))
+
+    def index(self, contributor):
+        """Add a Contributor to the index, or bring its entry up to date.
+
+        :return: The AuthorityName, or None if the Contributor can't be
+            indexed because it's missing a display name or sort name.
+        """
+        entry = get_one(self._db, AuthorityName, contributor=contributor)
+        if not contributor.display_name or not contributor.sort_name:
+            if entry:
+                self._db.delete(entry)
+            return None
+
+        if not entry:
+            entry = AuthorityName(contributor=contributor)
+            self._db.add(entry)
+        entry.display_name = contributor.display_name
+        entry.sort_name = contributor.sort_name
+        key = self.key(contributor.display_name)
+        if entry.key != key:
+            entry.key = key
+            entry.tokens = [
+                AuthorityToken(token=token)
+                for token in sorted(self.tokens(key))
+            ]
+        return entry
+
+    def candidates(self, key):
+        """Find index entries whose names share all but one of the words
+        in `key` (or all of them, for a short name), the ones with the
+        most words in common first.
+
+        :return: A list of (contributor ID, key, sort name) 3-tuples.
+        """
+        tokens = self.tokens(key)
+        if not tokens:
+            return []
+        needed = len(tokens)
+        if needed > self.SHORT_NAME:
+            needed -= 1
+        in_common = func.count(distinct(AuthorityToken.token))
+        qu = self._db.query(
+            AuthorityName.contributor_id, AuthorityName.key,
+            AuthorityName.sort_name
+        ).join(
+            AuthorityToken, AuthorityToken.authority_name_id==AuthorityName.id
+        ).filter(
+            AuthorityToken.token.in_(sorted(tokens))
+        ).group_by(
+            AuthorityName.id
+        ).having(
+            in_common >= needed
+        ).order_by(
+            in_common.desc(), AuthorityName.contributor_id
+        ).limit(self.MAX_CANDIDATES)
+        return qu.all()
+
+    def lookup(self, display_name, known_titles=None):
+        """Find the sort name of a Contributor whose display name is
+        nearly the same as `display_name`.
+
+        :param known_titles: Titles of books we know the author wrote.
+            A Contributor who worked on a book with one of these titles
+            is preferred over one who's merely a better name match.
+        :return: A sort name, or None if there's no close match, or if
+            there are several equally good matches with different sort
+            names and nothing to decide between them.
+        """
+        key = self.key(display_name)
+        matches = []
+        for contributor_id, candidate_key, sort_name in self.candidates(key):
+            score = contributor_name_match_ratio(
+                key, candidate_key, normalize_names=False
+            )
+            if score >= self.THRESHOLD:
+                matches.append((score, contributor_id, sort_name))
+        if not matches:
+            return None
+        matches.sort(key=lambda x: (-x[0], x[1]))
+
+        if known_titles:
+            # Get the titles of every matching Contributor's books at
+            # once.
+            titles = defaultdict(list)
+            qu = self._db.query(
+                Contribution.contributor_id, Edition.title
+            ).join(
+                Edition, Edition.id==Contribution.edition_id
+            ).filter(
+                Contribution.contributor_id.in_([x[1] for x in matches])
+            )
+            for contributor_id, title in qu:
+                titles[contributor_id].append(title)
+
+            scorer = TitleScorer(known_titles)
+            for score, contributor_id, sort_name in matches:
+                if any(scorer.matches(title) for title in titles[contributor_id]):
+                    return sort_name
+
+        best_score = matches[0][0]
+        sort_names = set(
+            sort_name for score, contributor_id, sort_name in matches
+            if score == best_score
+        )
+        if len(sort_names) > 1:
+            self.log.debug(
+                "%s is ambiguous: could be any of %r",
+                display_name, sorted(sort_names)
+            )
+            return None
+        return sort_names.pop()
+
+
+
 class AuthorNameCanonicalizer(object):
 
     """Does whatever it takes to find the name of a book's primary author
@@ -36,10 +236,11 @@ class AuthorNameCanonicalizer(object):
 
     VIAF_ID = re.compile("^http://viaf.org/viaf/([0-9]+)$")
 
-    def __init__(self, _db, oclcld=None, viaf=None):
+    def __init__(self, _db, oclcld=None, viaf=None, authority_index=None):
         self._db = _db
         self.oclcld = oclcld or OCLCLinkedData(_db)
         self.viaf = viaf or VIAFClient(_db)
+        self.authority_index = authority_index or AuthorityIndex(_db)
         self.log = logging.getLogger("Author name canonicalizer")
 
     @classmethod
@@ -130,8 +331,8 @@ class AuthorNameCanonicalizer(object):
 
     def sort_name_from_services(self, display_name, identifier=None):
         """Try to find a sort name for the given author by asking various
-        knowledgeable sources: our own database, OCLC Linked Data,
-        and VIAF.
+        knowledgeable sources: our own database, the local authority
+        index, OCLC Linked Data, and VIAF.
 
         :param display_name: The display name for which we're trying
             to find a sort name.
@@ -154,6 +355,14 @@ class AuthorNameCanonicalizer(object):
         if sort_name:
             return sort_name
 
+        # We may not have a Contributor with this exact display name,
+        # but we might have one whose name is nearly the same.
+        sort_name = self.sort_name_from_authority_index(
+            display_name, known_titles
+        )
+        if sort_name:
+            return sort_name
+
         # Looking in the database didn't work. Let's ask OCLC
         # Linked Data about this ISBN and see if it gives us an
         # author.
@@ -220,7 +429,7 @@ class AuthorNameCanonicalizer(object):
 
         # Find all Contributors with this display name.
         contributors = self._db.query(
-            Contributor
+            Contributor.id, Contributor.sort_name
         ).filter(
             Contributor.display_name==display_name
         ).filter(
@@ -229,42 +438,60 @@ class AuthorNameCanonicalizer(object):
             Contributor.id
         )
 
+        if not known_titles:
+            # With nothing to go on but the name, we pick the first
+            # author with that name.
+            first = contributors.first()
+            return (first.sort_name if first else None), known_titles
+
+        # Get the titles of every book those Contributors worked on in
+        # the same query, rather than going through their
+        # contributions one at a time.
+        rows = contributors.add_columns(Edition.title).outerjoin(
+            Contribution, Contribution.contributor_id==Contributor.id
+        ).outerjoin(
+            Edition, Edition.id==Contribution.edition_id
+        )
+        sort_name = self._sort_name_from_titles(rows, known_titles)
+        return sort_name, known_titles
+
+    @classmethod
+    def _sort_name_from_titles(cls, rows, known_titles):
+        """Choose a sort name for an author based on the titles of books
+        written by people with the author's display name.
+
+        :param rows: A list of (contributor ID, sort name, title)
+            3-tuples, ordered by contributor ID.
+        :param known_titles: Titles of books we know the author wrote.
+        :return: The sort name of the first Contributor associated
+            with an Edition whose title is similar to one of the
+            `known_titles`. If there is no such Contributor, the sort
+            name of the first Contributor.
+        """
+        scorer = TitleScorer(known_titles)
         fallback_sort_name = None
-        for contributor in contributors:
-            sort_name = self._sort_name_from_contributor_and_titles(
-                contributor, known_titles
-            )
-            if sort_name:
+        for contributor_id, sort_name, title in rows:
+            if scorer.matches(title):
                 # We've found a sort_name based on display_name
                 # and a title match!
-                break
-            elif not fallback_sort_name:
+                return sort_name
+            if not fallback_sort_name:
                 # If we can't match on name + title, we'll pick an
                 # author based solely on name.
-                fallback_sort_name = contributor.sort_name
-        sort_name = sort_name or fallback_sort_name
-        return sort_name, known_titles
+                fallback_sort_name = sort_name
+        return fallback_sort_name
 
-    @classmethod
-    def _sort_name_from_contributor_and_titles(cls, contributor, known_titles):
-        """Return `contributor.sort_name` only if the Contributor is
-        associated with an Edition whose title is similar to one of
-        the `known_titles`.
+    def sort_name_from_authority_index(self, display_name, known_titles):
+        """Try to find an author sort name in the local name-authority
+        index.
+
+        :param display_name: The display name for which we're trying
+            to find a sort name.
+
+        :param known_titles: A set containing the titles of books we
+            know this person wrote.
         """
-        if not contributor or not known_titles:
-            return
-        for contribution in contributor.contributions:
-            if (contribution.edition and known_titles):
-                check_against_title = contribution.edition.title
-                if not check_against_title:
-                    continue
-                max_title_match_ratio = max(
-                    title_match_ratio(title, check_against_title)
-                    for title in known_titles
-                )
-                if max_title_match_ratio >= 80:
-                    # 80% similarity -- close enough.
-                    return contributor.sort_name
+        return self.authority_index.lookup(display_name, known_titles)
 
     def sort_name_from_oclc_linked_data(self, display_name, identifier):
         """Try to find an author sort name for this book from
@@ -0,0 +1,216 @@
+"""Compress the content of cached upstream Representations.
+
+The documents we cache from VIAF and OCLC are big, repetitive XML and
+JSON-LD, and they're kept for months, so they're stored compressed.
+Compressed content starts with MARKER, which can't start an XML or
+JSON document. Content without the marker is stored as-is, so rows
+written before compression was introduced can still be read.
+
+If a blobstore.BlobStore is configured, the compressed content goes
+into the blob store, and the Representation only holds a reference
+to it.
+"""
+import zlib
+
+from sqlalchemy import (
+    and_,
+    or_,
+)
+from sqlalchemy.sql.functions import func
+
+from core.model import Representation
+
+from blobstore import (
+    REFERENCE_MARKER,
+    BlobStore,
+)
+
+MARKER = b"\x00zlib\x00"
+
+# zlib's default trade-off between speed and size.
+LEVEL = 6
+
+# Content smaller than this isn't worth compressing.
+MINIMUM_SIZE = 128
+
+# Representations of URLs that start with one of these are written
+# through a Compressor and read through representation_content().
+URL_PREFIXES = [
+    'http://viaf.org/viaf/',
+    'http://classify.oclc.org/classify2/',
+    'http://www.worldcat.org/',
+    'http://experiment.worldcat.org/entity/work/data/',
+]
+
+
+def is_compressed(content):
+    return isinstance(content, bytes) and content.startswith(MARKER)
+
+
+def compress(content, level=LEVEL):
+    """Compress a document, unless that wouldn't save any space.
+
+    :return: The compressed content, or the original content if it's
+        empty, already compressed, or not worth compressing.
+    """
+    if (not isinstance(content, bytes) or len(content) < MINIMUM_SIZE
+        or is_compressed(content)):
+        return content
+    compressed = MARKER + zlib.compress(content, level)
+    if len(compressed) >= len(content):
+        return content
+    return compressed
+
+
+def decompress(content):
+    """Undo compress(). Content that isn't compressed is returned as-is."""
+    if not is_compressed(content):
+        return content
+    return zlib.decompress(content[len(MARKER):])
+
+
+def representation_content(representation, blob_store=None):
+    """The uncompressed content of a Representation.
+
+    :param blob_store: The BlobStore to look in if the content is a
+        reference. Defaults to the one configured through the
+        environment.
+    :return: The content, or None if it's a reference to a blob that
+        has been evicted.
+    """
+    content = representation.content
+    if BlobStore.is_reference(content):
+        blob_store = blob_store or BlobStore.default()
+        if not blob_store:
+            return None
+        content = blob_store.resolve(content)
+    return decompress(content)
+
+
+def is_evicted(representation, blob_store=None):
+    """Is a Representation's content a reference to a blob that's no
+    longer in the blob store?
+
+    This only checks that the blob exists; it doesn't read it.
+
+    :param blob_store: The BlobStore to look in. Defaults to the one
+        configured through the environment.
+    """
+    content = representation.content
+    if not BlobStore.is_reference(content):
+        return False
+    blob_store = blob_store or BlobStore.default()
+    return not (blob_store and blob_store.contains(content))
+
+
+def get_representation(_db, url, do_get, blob_store=None, **kwargs):
+    """Representation.get, except that a cached Representation whose
+    blob has been evicted from the blob store is fetched again.
+
+    :return: A 2-tuple (Representation, cached), like
+        Representation.get.
+    """
+    representation, cached = Representation.get(
+        _db, url, do_get=do_get, **kwargs
+    )
+    if cached and is_evicted(representation, blob_store):
+        kwargs['max_age'] = 0
+        representation, cached = Representation.get(
+            _db, url, do_get=do_get, **kwargs
+        )
+    return representation, cached
+
+
+def is_cached(_db, url, max_age=None, blob_store=None):
+    """Would get_representation() answer a request for `url` from the
+    cache, rather than going to the network?
+
+    :param max_age: As for Representation.get.
+    """
+    representation = _db.query(Representation).filter(
+        Representation.url==url
+    ).first()
+    return bool(
+        representation and representation.is_fresher_than(max_age)
+        and not is_evicted(representation, blob_store)
+    )
+
+
+def compressible_representations(qu):
+    """Restrict a query against Representation to cached upstream
+    documents that are read through representation_content().
+    """
+    return qu.filter(
+        or_(*[Representation.url.like(prefix + '%')
+              for prefix in URL_PREFIXES])
+    ).filter(Representation.content != None)
+
+
+def uncompressed_representations(qu):
+    """Restrict a query against Representation to cached upstream
+    documents that haven't been compressed but might benefit from it.
+    """
+    return compressible_representations(qu).filter(
+        and_(
+            func.length(Representation.content) >= MINIMUM_SIZE,
+            func.substr(Representation.content, 1, len(MARKER)) != MARKER,
+            func.substr(
+                Representation.content, 1, len(REFERENCE_MARKER)
+            ) != REFERENCE_MARKER,
+        )
+    )
+
+
+def unstored_representations(qu):
+    """Restrict a query against Representation to cached upstream
+    documents whose content is still in the database rather than in
+    the blob store.
+    """
+    return compressible_representations(qu).filter(
+        func.substr(
+            Representation.content, 1, len(REFERENCE_MARKER)
+        ) != REFERENCE_MARKER
+    )
+
+
+def store_content(content, level=LEVEL, blob_store=None):
+    """Compress a document and, if there's a blob store, put it there.
+
+    :return: What should go into Representation.content.
+    """
+    content = compress(content, level)
+    if blob_store and isinstance(content, bytes) and content:
+        content = blob_store.store(content)
+    return content
+
+
+class Compressor(object):
+    """Compresses the content returned by an HTTP GET function, so that
+    Representation.get stores it compressed -- or stores a reference to
+    it, if there's a blob store.
+
+    Use it as the innermost guard passed into upstream.protect().
+    """
+
+    def __init__(self, level=LEVEL, blob_store=None):
+        """Constructor.
+
+        :param blob_store: A BlobStore. Defaults to the one configured
+            through the environment, if any.
+        """
+        self.level = level
+        self.blob_store = blob_store or BlobStore.default()
+
+    def wrap(self, do_get):
+        """Compress the content of responses from an HTTP GET function.
+
+        :param do_get: A function that returns a (status, headers,
+            content) tuple, such as Representation.simple_http_get.
+        :return: A function with the same signature.
+        """
+        def compressing(url, *args, **kwargs):
+            status, headers, content = do_get(url, *args, **kwargs)
+            return status, headers, store_content(
+                content, self.level, self.blob_store
+            )
+        return compressing
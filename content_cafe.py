@@ -31,6 +31,11 @@ from core.util.http import HTTP
 from core.util.summary import SummaryEvaluator
 
 from coverage_utils import MetadataWranglerBibliographicCoverageProvider
+from upstream import (
+    CircuitBreaker,
+    RateLimiter,
+    protect,
+)
 
 def load_file(filename):
     """Load a file from the Content Cafe subdirectory of files/."""
@@ -52,6 +57,15 @@ class ContentCafeCoverageProvider(MetadataWranglerBibliographicCoverageProvider)
     INPUT_IDENTIFIER_TYPES = [Identifier.ISBN]
     DATA_SOURCE_NAME = DataSource.CONTENT_CAFE
 
+    # A book Content Cafe doesn't know about is usually too new for
+    # it, so there's no point in asking again soon. Other transient
+    # failures, such as network errors, get the normal RETRY_DELAY.
+    NOT_FOUND = "Content Cafe has no knowledge of this identifier."
+    NOT_FOUND_RETRY_DELAY = datetime.timedelta(days=3)
+    NOT_FOUND_MAX_RETRY_DELAY = datetime.timedelta(days=90)
+
+    UPSTREAM_URLS = ["http://contentcafe2.btol.com/"]
+
     def __init__(self, collection, api=None, **kwargs):
         """Constructor.
 
@@ -69,6 +83,19 @@ class ContentCafeCoverageProvider(MetadataWranglerBibliographicCoverageProvider)
         _db = Session.object_session(collection)
         self.content_cafe = api or ContentCafeAPI.from_config(self._db)
 
+    def not_found_retry_delay(self, attempts):
+        return self.backoff(
+            attempts, self.NOT_FOUND_RETRY_DELAY,
+            self.NOT_FOUND_MAX_RETRY_DELAY
+        )
+
+    def retry_delay_for(self, failure):
+        if failure.exception == self.NOT_FOUND:
+            return self.not_found_retry_delay
+        return super(ContentCafeCoverageProvider, self).retry_delay_for(
+            failure
+        )
+
     def process_item(self, identifier):
         """Associate bibliographic metadata with the given Identifier.
 
@@ -78,15 +105,12 @@ class ContentCafeCoverageProvider(MetadataWranglerBibliographicCoverageProvider)
             # Create a Metadata object.
             metadata = self.content_cafe.create_metadata(identifier)
             if not metadata:
-                # TODO: The only time this is really a transient error
+                # The only time this is really a transient error
                 # is when the book is too new for Content Cafe to know
-                # about it, which isn't often. It would be best to
-                # keep this as a transient failure but give it a relatively
-                # long and exponentially increasing retry time.
+                # about it, which isn't often. NOT_FOUND_RETRY_DELAY
+                # keeps us from asking again on every run.
                 return self.failure(
-                    identifier,
-                    "Content Cafe has no knowledge of this identifier.",
-                    transient=True
+                    identifier, self.NOT_FOUND, transient=True
                 )
             edition, is_new = Edition.for_foreign_id(
                 self._db, self.data_source, identifier.type,
@@ -149,7 +173,8 @@ class ContentCafeAPI(object):
             **kwargs
         )
 
-    def __init__(self, _db, user_id, password, soap_client=None, do_get=None):
+    def __init__(self, _db, user_id, password, soap_client=None, do_get=None,
+                 rate_limiter=None, circuit_breaker=None):
         """Constructor.
         """
         self._db = _db
@@ -158,7 +183,12 @@ class ContentCafeAPI(object):
         self.soap_client = (
             soap_client or ContentCafeSOAPClient(user_id, password)
         )
-        self.do_get = do_get or HTTP.get_with_timeout
+        self.rate_limiter = rate_limiter or RateLimiter(_db)
+        self.circuit_breaker = circuit_breaker or CircuitBreaker(_db)
+        self.do_get = protect(
+            do_get or HTTP.get_with_timeout,
+            self.circuit_breaker, self.rate_limiter
+        )
 
     @property
     def data_source(self):
@@ -296,9 +326,13 @@ class ContentCafeAPI(object):
         )
 
     def measure_popularity(self, identifier, cutoff=None):
-        value = self.soap_client.estimated_popularity(
-            identifier.identifier, cutoff=cutoff
+        estimated_popularity = protect(
+            lambda url: self.soap_client.estimated_popularity(
+                identifier.identifier, cutoff=cutoff
+            ),
+            self.circuit_breaker, self.rate_limiter
         )
+        value = estimated_popularity(ContentCafeSOAPClient.WSDL_URL)
         # NOTE: even a complete lack of popularity data is useful--it tells
         # us there's no need to check again anytime soon. But we can't
         # store that information in the database.
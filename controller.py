@@ -9,6 +9,7 @@ from sqlalchemy import (
     not_,
 )
 from sqlalchemy.orm import joinedload
+from sqlalchemy.sql import text
 from sqlalchemy.sql.expression import and_
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_OAEP
@@ -16,7 +17,9 @@ import feedparser
 import json
 import jwt
 import logging
+import time
 from urllib.parse import urlparse
+import zlib
 
 from core.app_server import (
     cdn_url_for,
@@ -73,6 +76,7 @@ from coverage_provider import (
 )
 from canonicalize import AuthorNameCanonicalizer
 from integration_client import IntegrationClientCoverImageCoverageProvider
+from model import CoverageSchedule
 from problem_details import *
 
 HTTP_OK = 200
@@ -943,6 +947,17 @@ class URNLookupHandler(CoreURNLookupHandler):
         + [Identifier.GUTENBERG_ID]
     )
 
+    # If another process is already resolving an Identifier, wait this
+    # many seconds for it to finish before giving up on it. This is
+    # also the most time a single lookup request will spend waiting,
+    # however many Identifiers it asks about.
+    RESOLUTION_WAIT = 20
+    RESOLUTION_POLL_INTERVAL = 0.25
+
+    # When the current lookup request has to stop waiting for other
+    # processes, as a time.monotonic() value.
+    resolution_deadline = None
+
     log = logging.getLogger("URN lookup controller")
 
     def __init__(self, _db, resolver, collection):
@@ -980,7 +995,14 @@ class URNLookupHandler(CoreURNLookupHandler):
         # ready.
         self.bulk_load_coverage_records(list(identifiers_by_urn.values()))
 
-        for urn, identifier in list(identifiers_by_urn.items()):
+        # The advisory locks taken in claim_resolution() are held
+        # until the end of the request. Taking them in a consistent
+        # order keeps two requests for overlapping Identifiers from
+        # deadlocking.
+        self.resolution_deadline = time.monotonic() + self.RESOLUTION_WAIT
+        for urn, identifier in sorted(
+            list(identifiers_by_urn.items()), key=lambda x: x[1].id
+        ):
             self.process_identifier(
                 identifier, urn, 
             )
@@ -1005,6 +1027,27 @@ class URNLookupHandler(CoreURNLookupHandler):
             # We already have a presentation-ready Work for this Identifier.
             return self.add_work(identifier, work)
 
+        # Several clients often ask about the same new Identifier at
+        # once. Only one process at a time gets to resolve it.
+        claim = self.claim_resolution(identifier)
+        if claim is None:
+            # Another process is still working on this Identifier.
+            # Rather than repeat its requests to upstream services,
+            # report on its progress.
+            return self.add_status_message(urn, identifier)
+
+        if claim is False:
+            # Another process just finished working on this
+            # Identifier. What it did may have been enough.
+            self.refresh(identifier)
+            work = self.presentation_ready_work_for(identifier)
+            if work:
+                return self.add_work(identifier, work)
+
+            # It wasn't enough, but there's no point in repeating
+            # the same requests to upstream services right away.
+            return self.add_status_message(urn, identifier)
+
         # Some work has not been done. Make the
         # IdentifierResolutionCoverageProvider process this
         # Identifier. This will either do the work, or register all
@@ -1025,6 +1068,56 @@ class URNLookupHandler(CoreURNLookupHandler):
 
         return self.add_status_message(urn, identifier)
 
+    def claim_resolution(self, identifier, sleep=time.sleep):
+        """Make sure no other process resolves `identifier` at the
+        same time as this one.
+
+        This takes a transaction-level advisory lock keyed on the
+        Identifier and the resolver's operation. The lock is released
+        when the transaction is committed in post_lookup_hook(), by
+        which point whatever we did is visible to other processes.
+
+        :return: True if the Identifier was claimed right away, False
+            if it was claimed after waiting for another process to
+            finish with it, and None if the other process didn't
+            finish within RESOLUTION_WAIT seconds, or before the
+            current request ran out of time.
+        """
+        if self.try_resolution_lock(identifier):
+            return True
+        deadline = time.monotonic() + self.RESOLUTION_WAIT
+        if self.resolution_deadline is not None:
+            deadline = min(deadline, self.resolution_deadline)
+        while time.monotonic() < deadline:
+            sleep(self.RESOLUTION_POLL_INTERVAL)
+            if self.try_resolution_lock(identifier):
+                return False
+        self.log.info(
+            "Gave up waiting for another process to resolve %r", identifier
+        )
+        return None
+
+    def try_resolution_lock(self, identifier):
+        """Try once to take the advisory lock for `identifier`.
+
+        :return: True if the lock was taken.
+        """
+        operation = self.resolver.OPERATION or ''
+        namespace = zlib.crc32(operation.encode("utf8")) & 0x7fffffff
+        return self._db.execute(
+            text("select pg_try_advisory_xact_lock(:namespace, :id)"),
+            dict(namespace=namespace, id=identifier.id)
+        ).scalar()
+
+    def refresh(self, identifier):
+        """Reload an Identifier's Work from the database, in case another
+        process has changed it.
+        """
+        self._db.flush()
+        for pool in identifier.licensed_through:
+            self._db.expire(pool)
+        self._db.expire(identifier)
+
     def bulk_load_coverage_records(self, identifiers):
         """Loads CoverageRecords for a list of identifiers into the database
         session in a single query before individual identifier processing
@@ -1127,9 +1220,13 @@ class URNLookupController(CoreURNLookupController, Controller):
                 _("The maximum number of URNs you can provide at once is %d. (You sent %d)") % (limit, len(urns))
             )
 
+        # A client is waiting on these Identifiers, so they go ahead
+        # of anything registered in bulk.
+        resolver_kwargs = dict(priority=CoverageSchedule.HIGH_PRIORITY)
+        resolver_kwargs.update(self.coverage_provider_kwargs)
         resolver = self.identifier_resolver_class(
             collection, provide_coverage_immediately=resolve_now,
-            **self.coverage_provider_kwargs
+            **resolver_kwargs
         )
         handler = URNLookupHandler(self._db, resolver, collection)
         handler.process_urns(urns, **kwargs)
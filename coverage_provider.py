@@ -33,7 +33,11 @@ from core.util import fast_query_count
 
 from oclc.classify import IdentifierLookupCoverageProvider
 
-from coverage_utils import MetadataWranglerReplacementPolicy
+from coverage_utils import (
+    MetadataWranglerReplacementPolicy,
+    ScheduledCoverageProvider,
+)
+from model import CoverageSchedule
 
 from overdrive import (
     OverdriveBibliographicCoverageProvider,
@@ -52,7 +56,9 @@ from integration_client import (
 )
 
 
-class IdentifierResolutionCoverageProvider(CatalogCoverageProvider):
+class IdentifierResolutionCoverageProvider(
+        ScheduledCoverageProvider, CatalogCoverageProvider
+):
     """Make sure all Identifiers associated with some Collection become
     Works.
 
@@ -86,7 +92,8 @@ class IdentifierResolutionCoverageProvider(CatalogCoverageProvider):
 
     def __init__(self, collection, mirror=None, http_get=None, viaf=None,
                  provide_coverage_immediately=False, force=False,
-                 provider_kwargs=None, **kwargs
+                 provider_kwargs=None,
+                 priority=CoverageSchedule.NORMAL_PRIORITY, **kwargs
     ):
         """Constructor.
 
@@ -123,6 +130,10 @@ class IdentifierResolutionCoverageProvider(CatalogCoverageProvider):
         when calling gather_providers at the end of the
         constructor. Used only in testing.
 
+        :param priority: When registering an Identifier with other
+        CoverageProviders, put it in this priority lane. Identifiers
+        that a client is actively waiting on should be given
+        CoverageSchedule.HIGH_PRIORITY.
         """
         _db = Session.object_session(collection)
 
@@ -144,6 +155,7 @@ class IdentifierResolutionCoverageProvider(CatalogCoverageProvider):
 
         self.provide_coverage_immediately = provide_coverage_immediately
         self.force = force or provide_coverage_immediately
+        self.priority = priority
 
         self.viaf = viaf or VIAFClient(self._db)
 
@@ -343,7 +355,14 @@ class IdentifierResolutionCoverageProvider(CatalogCoverageProvider):
             # associated with this CoverageProvider.
             collection = provider.collection
 
-        if self.provide_coverage_immediately:
+        # If the upstream service the subprovider depends on is
+        # down, there's no point in making the client wait for it to
+        # fail. Register the Identifier so it's handled once the
+        # service comes back.
+        upstream_unavailable = getattr(
+            provider, 'upstream_unavailable', lambda: False
+        )
+        if self.provide_coverage_immediately and not upstream_unavailable():
             coverage_record = provider.ensure_coverage(
                 identifier, force=self.force
             )
@@ -351,4 +370,7 @@ class IdentifierResolutionCoverageProvider(CatalogCoverageProvider):
             coverage_record, is_new = provider.register(
                 identifier, collection=collection, force=self.force
             )
+            # Make sure the other CoverageProvider gets to this
+            # Identifier as soon as this one's priority demands.
+            CoverageSchedule.prioritize(coverage_record, self.priority)
         return coverage_record
@@ -1,6 +1,20 @@
+import datetime
 import logging
 
+from sqlalchemy import (
+    Float,
+    and_,
+    cast,
+    event,
+    false,
+    literal,
+    or_,
+    select,
+    true,
+    union_all,
+)
 from sqlalchemy.orm.session import Session
+from sqlalchemy.sql.functions import func
 
 from core.config import CannotLoadConfiguration
 from core.coverage import (
@@ -11,11 +25,45 @@ from core.metadata_layer import ReplacementPolicy
 from core.mirror import MirrorUploader
 from core.model import (
     get_one,
+    CoverageRecord,
     DataSource,
     ExternalIntegration,
     ExternalIntegrationLink,
+    Identifier,
     Work,
 )
+from core.util.datetime_helpers import utc_now
+
+from model import (
+    ContributorVIAFCoverage,
+    CoverageSchedule,
+)
+from upstream import CircuitBreaker
+
+class QueryCounter(object):
+    """Count the SQL statements sent to the database while a block of
+    code runs. This is used to make sure batch code sends a fixed
+    number of queries no matter how big the batch is.
+
+        with QueryCounter(_db) as counter:
+            ...
+        print(counter.count)
+    """
+
+    def __init__(self, _db):
+        self.bind = _db.get_bind()
+        self.count = 0
+
+    def increment(self, *args, **kwargs):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.bind, "before_cursor_execute", self.increment)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(self.bind, "before_cursor_execute", self.increment)
+
 
 class MetadataWranglerReplacementPolicy(ReplacementPolicy):
     """A ReplacementPolicy that uses the only configured storage
@@ -49,7 +97,240 @@ class MetadataWranglerReplacementPolicy(ReplacementPolicy):
         )
 
 
-class MetadataWranglerBibliographicCoverageProvider(BibliographicCoverageProvider):
+class ScheduledCoverageProvider(object):
+    """A mixin for IdentifierCoverageProviders whose queue is ordered
+    by CoverageSchedule.priority rather than handled first-come,
+    first-served.
+
+    Registering an Identifier with a priority puts it in that
+    priority's lane. Every batch drains the lanes in proportion to
+    their weights, so a flood of high-priority work can't starve
+    the backlog entirely. The weights are PRIORITY_WEIGHTS, unless
+    others are passed into the constructor as `priority_weights`.
+
+    Transient failures are retried with exponential backoff: after
+    RETRY_DELAY, then twice that, and so on up to MAX_RETRY_DELAY.
+    Until then, the Identifier doesn't show up in
+    items_that_need_coverage().
+
+    While the circuit for any of UPSTREAM_URLS is open, nothing shows
+    up in items_that_need_coverage(), since there's no point in
+    trying.
+    """
+
+    # Out of every five items in a batch, four come from the
+    # high-priority lane (if there are that many waiting). An item
+    # whose priority isn't mentioned here goes in the highest lane
+    # whose priority it meets.
+    PRIORITY_WEIGHTS = {
+        CoverageSchedule.HIGH_PRIORITY : 4,
+        CoverageSchedule.NORMAL_PRIORITY : 1,
+    }
+
+    # Set RETRY_DELAY to None to retry transient failures on every run.
+    RETRY_DELAY = datetime.timedelta(hours=1)
+    MAX_RETRY_DELAY = datetime.timedelta(days=7)
+
+    # URLs on the upstream hosts this provider can't work without.
+    UPSTREAM_URLS = []
+
+    # Set by run_once() to the most items the current batch could
+    # take from any one lane.
+    schedule_window = None
+
+    # Set by the constructor to use weights other than PRIORITY_WEIGHTS.
+    priority_weights = None
+
+    def __init__(self, *args, **kwargs):
+        """Constructor.
+
+        :param priority_weights: A dictionary mapping each priority
+            lane to its share of every batch. Defaults to
+            PRIORITY_WEIGHTS.
+        """
+        priority_weights = kwargs.pop('priority_weights', None)
+        super(ScheduledCoverageProvider, self).__init__(*args, **kwargs)
+        if priority_weights:
+            self.priority_weights = dict(priority_weights)
+
+    @classmethod
+    def register(cls, identifier, *args, **kwargs):
+        """Register an Identifier for future coverage.
+
+        :param priority: Process the Identifier in this priority lane.
+            If this is not specified, the Identifier keeps whatever
+            priority it already had.
+        """
+        priority = kwargs.pop('priority', None)
+        record, was_registered = super(
+            ScheduledCoverageProvider, cls
+        ).register(identifier, *args, **kwargs)
+        CoverageSchedule.prioritize(record, priority)
+        return record, was_registered
+
+    @classmethod
+    def bulk_register(cls, identifiers, *args, **kwargs):
+        """Register a number of Identifiers for future coverage.
+
+        :param priority: Process the newly registered Identifiers in
+            this priority lane.
+        """
+        priority = kwargs.pop('priority', None)
+        new_records, ignored_identifiers = super(
+            ScheduledCoverageProvider, cls
+        ).bulk_register(identifiers, *args, **kwargs)
+        for record in new_records:
+            CoverageSchedule.prioritize(record, priority)
+        return new_records, ignored_identifiers
+
+    def run_once(self, progress, *args, **kwargs):
+        """Process one batch, only ranking as many items in each lane
+        as the batch could possibly use.
+        """
+        self.schedule_window = self.batch_size + (
+            getattr(progress, 'offset', None) or 0
+        )
+        try:
+            return super(ScheduledCoverageProvider, self).run_once(
+                progress, *args, **kwargs
+            )
+        finally:
+            self.schedule_window = None
+
+    def items_that_need_coverage(self, identifiers=None, **kwargs):
+        qu = super(ScheduledCoverageProvider, self).items_that_need_coverage(
+            identifiers, **kwargs
+        )
+        return self.apply_schedule(qu)
+
+    @classmethod
+    def backoff(cls, attempts, retry_delay, max_retry_delay=None):
+        """Double `retry_delay` for every failure after the first, up
+        to `max_retry_delay`.
+
+        :return: A timedelta, or None to retry on the next run.
+        """
+        if not retry_delay:
+            return None
+        # Cap the exponent well before the timedelta could overflow.
+        delay = retry_delay * (2 ** min(max(attempts-1, 0), 30))
+        if max_retry_delay:
+            delay = min(delay, max_retry_delay)
+        return delay
+
+    def retry_delay(self, attempts):
+        """How long to wait before retrying an item that has failed
+        `attempts` times in a row.
+
+        :return: A timedelta, or None to retry on the next run.
+        """
+        return self.backoff(attempts, self.RETRY_DELAY, self.MAX_RETRY_DELAY)
+
+    def retry_delay_for(self, failure):
+        """The retry_delay function to use for a transient failure.
+
+        A subclass can wait longer for failures that aren't likely to
+        clear up soon.
+        """
+        return self.retry_delay
+
+    def record_failure_as_coverage_record(self, failure):
+        """Put off the next attempt on a transient failure."""
+        record = super(
+            ScheduledCoverageProvider, self
+        ).record_failure_as_coverage_record(failure)
+        if failure.transient:
+            CoverageSchedule.postpone(record, self.retry_delay_for(failure))
+        return record
+
+    def add_coverage_record_for(self, item):
+        """Start the backoff over once an item is covered."""
+        record = super(
+            ScheduledCoverageProvider, self
+        ).add_coverage_record_for(item)
+        CoverageSchedule.reset(record)
+        return record
+
+    def upstream_unavailable(self):
+        """Is any upstream host this provider depends on known to be down?"""
+        if not self.UPSTREAM_URLS:
+            return False
+        breaker = CircuitBreaker(self._db)
+        return any(breaker.is_open(url) for url in self.UPSTREAM_URLS)
+
+    def apply_schedule(self, qu):
+        """Filter and order a query against Identifier and CoverageRecord
+        according to the CoverageSchedules.
+
+        Transient failures whose next attempt is in the future are
+        left out. The rest are ordered so that each batch is drawn
+        from the priority lanes in proportion to their weights:
+        within a lane, the Nth item is given the sort key N/weight,
+        which interleaves the lanes in the right proportions.
+
+        During run_once(), only the first `schedule_window` items in
+        each lane are ranked, so the cost of a batch depends on the
+        size of the batch rather than the size of the backlog.
+        """
+        if self.upstream_unavailable():
+            self.log.info(
+                "An upstream service is down; not processing anything."
+            )
+            return qu.filter(false())
+        qu = qu.outerjoin(
+            CoverageSchedule,
+            CoverageSchedule.coverage_record_id==CoverageRecord.id
+        ).filter(
+            or_(
+                CoverageSchedule.next_attempt_time==None,
+                CoverageSchedule.next_attempt_time <= utc_now(),
+                # Something other than a failure (such as the
+                # Identifier being registered again with force=True)
+                # has put the record back in the queue.
+                CoverageRecord.status != CoverageRecord.TRANSIENT_FAILURE,
+            )
+        )
+        # Each lane is defined by simple comparisons against
+        # CoverageSchedule.priority, so the higher lanes can be found
+        # through its index.
+        weights = self.priority_weights or self.PRIORITY_WEIGHTS
+        lanes = sorted(weights.items(), reverse=True)
+        ranked = []
+        above = None
+        for i, (priority, weight) in enumerate(lanes):
+            if i == len(lanes) - 1:
+                # The lowest lane includes records with no
+                # CoverageSchedule at all.
+                condition = or_(
+                    CoverageSchedule.priority == None,
+                    CoverageSchedule.priority < above
+                ) if above is not None else true()
+            else:
+                condition = CoverageSchedule.priority >= priority
+                if above is not None:
+                    condition = and_(condition, CoverageSchedule.priority < above)
+            above = priority
+            in_lane = qu.filter(condition).with_entities(
+                Identifier.id.label('id')
+            ).order_by(None).order_by(Identifier.id)
+            if self.schedule_window is not None:
+                in_lane = in_lane.limit(self.schedule_window)
+            in_lane = in_lane.subquery()
+            position = func.row_number().over(order_by=in_lane.c.id)
+            ranked.append(select([
+                in_lane.c.id,
+                (cast(position, Float) / weight).label('rank'),
+                literal(priority).label('lane'),
+            ]))
+        ranked = union_all(*ranked).alias('ranked')
+        return qu.join(ranked, ranked.c.id==Identifier.id).order_by(
+            ranked.c.rank, ranked.c.lane.desc(), Identifier.id
+        )
+
+
+class MetadataWranglerBibliographicCoverageProvider(
+        ScheduledCoverageProvider, BibliographicCoverageProvider
+):
 
     def _default_replacement_policy(self, _db, **kwargs):
         """In general, data used by the metadata wrangler is a reliable source
@@ -114,9 +395,12 @@ class MetadataWranglerBibliographicCoverageProvider(BibliographicCoverageProvide
         """Try to create a new presentation-ready Work based on metadata
         obtained during process_item().
 
-        If a Work already existed, recalculate its presentation to
-        incorporate the new metadata.
+        If a Work already existed, register it to have its
+        presentation recalculated to incorporate the new metadata.
         """
+        # Imported here to avoid a circular import.
+        from integration_client import WorkPresentationCoverageProvider
+
         work = self.work(identifier)
         if not isinstance(work, Work):
             return work
@@ -124,20 +408,21 @@ class MetadataWranglerBibliographicCoverageProvider(BibliographicCoverageProvide
         if work.presentation_ready:
             # This work was already presentation-ready, which means
             # its presentation probably just changed and needs to be
-            # recalculated.
-            work.calculate_presentation()
+            # recalculated. Other providers are probably about to
+            # change it too, so rather than recalculate it now, let
+            # WorkPresentationCoverageProvider do it once for all of
+            # them.
+            WorkPresentationCoverageProvider.register(work, force=True)
         self.set_presentation_ready(identifier)
 
 
 class ResolveVIAFOnSuccessCoverageProvider(MetadataWranglerBibliographicCoverageProvider):
     """A mix-in class for metadata wrangler BibliographicCoverageProviders
     that add author information. When such a coverage provider
-    completes its work, it should run any Contributors associated with
-    the presentation Edition through VIAF. Then it should try to
-    create a presentation-ready work.
-
-    By the time handle_success is called, instances of this class must
-    have self.viaf set to a VIAFClient.
+    completes its work, it should register any Contributors associated
+    with the presentation Edition to be run through VIAF by
+    monitor.ContributorVIAFSweep. Then it should try to create a
+    presentation-ready work.
     """
     def handle_success(self, identifier):
         work = self.work(identifier)
@@ -152,16 +437,20 @@ class ResolveVIAFOnSuccessCoverageProvider(MetadataWranglerBibliographicCoverage
         return identifier
 
     def resolve_viaf(self, work):
-        """Get VIAF data on all contributors to the Work's presentation edition.
+        """Make sure VIAF data will be obtained for all contributors to the
+        Work's presentation edition.
+
+        Contributors who were resolved recently aren't registered
+        again.
         """
         for pool in work.license_pools:
             edition = pool.presentation_edition
             if not edition:
                 continue
             for contributor in edition.contributors:
-                # TODO: We need some way of not going to VIAF over and over
-                # again for the same contributors.
-                self.viaf.process_contributor(contributor)
+                ContributorVIAFCoverage.register(contributor)
+
+                # In the meantime, make a guess at the display name.
                 if not contributor.display_name:
                     contributor.family_name, contributor.display_name = (
                         contributor.default_names()
@@ -68,5 +68,9 @@ chown -RHh simplified:simplified /home/simplified/metadata
 # Give logs a place to go.
 mkdir /var/log/simplified
 
+# Give cached upstream documents a place to go.
+mkdir -p /var/lib/simplified/blobs
+chown -R simplified:simplified /var/lib/simplified
+
 # Copy scripts that run at startup.
 cp /ls_build/startup/* /etc/my_init.d/
@@ -0,0 +1,275 @@
+"""Keep the transitive closure of the equivalents table, so that the
+Identifiers equivalent to an Identifier can be found with one indexed
+read instead of a recursive walk.
+"""
+import logging
+from collections import defaultdict
+
+from sqlalchemy import (
+    and_,
+    exists,
+    or_,
+)
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql import text
+
+from core.model import (
+    Equivalency,
+    get_one,
+)
+
+from model import EquivalencyClosure
+
+
+class EquivalencyClosureIndex(object):
+    """The transitive closure of the equivalents table, kept in the
+    equivalencyclosures table (model.EquivalencyClosure).
+
+    Equivalencies are treated as going both ways. For every pair of
+    Identifiers connected by a chain of Equivalencies, the closure
+    holds the strongest chain found, where a chain is as strong as the
+    product of the strengths of its links.
+
+    Adding an Equivalency updates the closure incrementally, in one
+    statement. Deleting an Equivalency, or making one weaker, means
+    the part of the closure around it has to be rebuilt with
+    refresh().
+
+    The OCLC coverage providers add Equivalencies through the index.
+    Equivalencies created anywhere else are picked up by
+    update() and monitor.EquivalencyClosureSweep. So are chains that
+    were missed because two processes added connected Equivalencies
+    at the same time, and neither saw the other's change.
+    """
+
+    # Chains longer or weaker than this aren't kept. This is at least
+    # as generous as the default policy core uses when it walks the
+    # equivalents table.
+    MAX_DEPTH = 5
+    MINIMUM_STRENGTH = 0.5
+
+    # Allow for rounding when comparing the strength of a chain in the
+    # closure with the strength it would have if it were calculated
+    # again.
+    TOLERANCE = 1e-9
+
+    # Every chain that goes through the new link joins a chain ending
+    # at one end of the link (or no chain at all) to a chain starting
+    # at the other end. The strongest chain between each pair of
+    # Identifiers replaces whatever is in the closure, if it's
+    # stronger.
+    ADD = text("""
+with a_side as (
+ select equivalent_id as id, strength, depth from %(table)s where identifier_id = :a
+ union all select :a, 1.0, 0
+), b_side as (
+ select equivalent_id as id, strength, depth from %(table)s where identifier_id = :b
+ union all select :b, 1.0, 0
+), chains as (
+ select x.id as identifier_id, y.id as equivalent_id,
+  x.strength * :strength * y.strength as strength, x.depth + 1 + y.depth as depth
+ from a_side x, b_side y
+ union all
+ select y.id, x.id, x.strength * :strength * y.strength, x.depth + 1 + y.depth
+ from a_side x, b_side y
+)
+insert into %(table)s (identifier_id, equivalent_id, strength, depth)
+select distinct on (identifier_id, equivalent_id) identifier_id, equivalent_id, strength, depth
+ from chains
+ where identifier_id != equivalent_id and depth <= :max_depth and strength >= :minimum_strength
+ order by identifier_id, equivalent_id, strength desc, depth
+on conflict (identifier_id, equivalent_id) do update set
+ strength = excluded.strength,
+ depth = excluded.depth
+where excluded.strength > %(table)s.strength
+ or (excluded.strength = %(table)s.strength and excluded.depth < %(table)s.depth)
+""" % dict(table=EquivalencyClosure.__tablename__))
+
+    def __init__(self, _db):
+        self._db = _db
+        self.log = logging.getLogger("Equivalency closure index")
+
+    @classmethod
+    def unindexed(cls, qu):
+        """Restrict a query against Equivalency to Equivalencies that
+        would make the closure stronger or more complete than it is.
+
+        That's an Equivalency that isn't in the closure, or one that
+        some chain in the closure could be extended through but hasn't
+        been.
+        """
+        return qu.outerjoin(
+            EquivalencyClosure, and_(
+                EquivalencyClosure.identifier_id==Equivalency.input_id,
+                EquivalencyClosure.equivalent_id==Equivalency.output_id,
+            )
+        ).filter(
+            Equivalency.input_id != Equivalency.output_id
+        ).filter(
+            Equivalency.strength >= cls.MINIMUM_STRENGTH
+        ).filter(
+            or_(
+                EquivalencyClosure.id == None,
+                EquivalencyClosure.strength < Equivalency.strength,
+                cls.unextended(Equivalency.input_id, Equivalency.output_id),
+                cls.unextended(Equivalency.output_id, Equivalency.input_id),
+            )
+        )
+
+    @classmethod
+    def unextended(cls, end, other_end):
+        """A condition on an Equivalency that's true if a chain in the
+        closure ends at `end`, but hasn't been extended through the
+        Equivalency to `other_end`.
+        """
+        chain = aliased(EquivalencyClosure)
+        extended = aliased(EquivalencyClosure)
+        strength = chain.strength * Equivalency.strength
+        return exists().where(
+            and_(
+                chain.equivalent_id==end,
+                chain.identifier_id!=other_end,
+                chain.depth < cls.MAX_DEPTH,
+                strength >= cls.MINIMUM_STRENGTH,
+                ~exists().where(
+                    and_(
+                        extended.identifier_id==chain.identifier_id,
+                        extended.equivalent_id==other_end,
+                        extended.strength >= strength - cls.TOLERANCE,
+                    )
+                ).correlate_except(extended)
+            )
+        ).correlate_except(chain)
+
+    def add(self, equivalency):
+        """Bring the closure up to date with a new or stronger
+        Equivalency.
+        """
+        if equivalency.input_id is None or equivalency.output_id is None:
+            self._db.flush()
+        if (equivalency.input_id == equivalency.output_id
+            or equivalency.strength is None
+            or equivalency.strength < self.MINIMUM_STRENGTH):
+            return
+        self._db.execute(
+            self.ADD, dict(
+                a=equivalency.input_id, b=equivalency.output_id,
+                strength=float(equivalency.strength),
+                max_depth=self.MAX_DEPTH,
+                minimum_strength=self.MINIMUM_STRENGTH,
+            )
+        )
+
+    def equivalent_to(self, identifier, data_source, other, strength):
+        """Make two Identifiers equivalent, as Identifier.equivalent_to
+        does, and bring the closure up to date.
+
+        :return: The Equivalency.
+        """
+        existing = None
+        if identifier.id is not None and other.id is not None:
+            existing = get_one(
+                self._db, Equivalency, input_id=identifier.id,
+                output_id=other.id, data_source=data_source
+            )
+        old_strength = existing.strength if existing else None
+        equivalency = identifier.equivalent_to(data_source, other, strength)
+        if old_strength is not None and strength < old_strength:
+            self._db.flush()
+            self.refresh([identifier.id, other.id])
+        else:
+            self.add(equivalency)
+        return equivalency
+
+    def update(self, identifiers):
+        """Add any Equivalencies involving these Identifiers that were
+        created without going through the index.
+        """
+        ids = [x.id for x in identifiers if x.id is not None]
+        if not ids:
+            return
+        qu = self._db.query(Equivalency).filter(
+            or_(Equivalency.input_id.in_(ids), Equivalency.output_id.in_(ids))
+        )
+        for equivalency in self.unindexed(qu):
+            self.add(equivalency)
+
+    def behind(self, equivalents):
+        """Find the Identifiers the closure hasn't caught up with.
+
+        :param equivalents: A dictionary mapping Identifier IDs to
+            lists of equivalent IDs, as returned by equivalent_ids().
+        :return: A set of the keys of `equivalents` for which the
+            Identifier, or one of its equivalents, is involved in an
+            Equivalency that update() would add.
+        """
+        owners = defaultdict(set)
+        for identifier_id, equivalent_ids in list(equivalents.items()):
+            for equivalent_id in equivalent_ids:
+                owners[equivalent_id].add(identifier_id)
+        if not owners:
+            return set()
+        ids = list(owners.keys())
+        qu = self._db.query(
+            Equivalency.input_id, Equivalency.output_id
+        ).filter(
+            or_(Equivalency.input_id.in_(ids), Equivalency.output_id.in_(ids))
+        )
+        behind = set()
+        for input_id, output_id in self.unindexed(qu):
+            behind.update(owners.get(input_id, ()))
+            behind.update(owners.get(output_id, ()))
+        return behind
+
+    def refresh(self, identifier_ids):
+        """Rebuild the part of the closure around some Identifiers.
+
+        A chain can't be taken out of the closure on its own, since
+        there's no telling which other chains depended on it. Instead,
+        everything involving the Identifiers and their equivalents is
+        deleted, and every Equivalency involving them is added again.
+        """
+        ids = set(identifier_ids)
+        for equivalent_ids in list(self.equivalent_ids(ids).values()):
+            ids.update(equivalent_ids)
+
+        self._db.query(EquivalencyClosure).filter(
+            or_(
+                EquivalencyClosure.identifier_id.in_(ids),
+                EquivalencyClosure.equivalent_id.in_(ids),
+            )
+        ).delete(synchronize_session=False)
+
+        equivalencies = self._db.query(Equivalency).filter(
+            or_(Equivalency.input_id.in_(ids), Equivalency.output_id.in_(ids))
+        ).order_by(Equivalency.id)
+        for equivalency in equivalencies:
+            self.add(equivalency)
+        self.log.info("Rebuilt the closure around %d identifiers.", len(ids))
+
+    def equivalent_ids(self, identifier_ids, levels=None, threshold=None):
+        """Find the Identifiers equivalent to each of some Identifiers.
+
+        :param levels: Only follow chains of at most this many links.
+        :param threshold: Only follow chains at least this strong.
+        :return: A dictionary mapping each Identifier ID to a list of
+            equivalent IDs, including the Identifier's own ID -- the
+            same thing Identifier.recursively_equivalent_identifier_ids
+            returns.
+        """
+        identifier_ids = list(identifier_ids)
+        result = dict((x, [x]) for x in identifier_ids)
+        if not identifier_ids:
+            return result
+        qu = self._db.query(
+            EquivalencyClosure.identifier_id, EquivalencyClosure.equivalent_id
+        ).filter(EquivalencyClosure.identifier_id.in_(identifier_ids))
+        if levels is not None:
+            qu = qu.filter(EquivalencyClosure.depth <= levels)
+        if threshold is not None:
+            qu = qu.filter(EquivalencyClosure.strength >= threshold)
+        for identifier_id, equivalent_id in qu.order_by(
+            EquivalencyClosure.identifier_id, EquivalencyClosure.equivalent_id
+        ):
+            result[identifier_id].append(equivalent_id)
+        return result
@@ -1,9 +1,22 @@
+import datetime
+
+from sqlalchemy.orm import selectinload
 from sqlalchemy.orm.session import Session
+from sqlalchemy.sql.expression import or_
 from core.model import (
+    Classification,
+    Contribution,
     CoverageRecord,
     DataSource,
+    Edition,
     ExternalIntegration,
+    Hyperlink,
+    Identifier,
+    LicensePool,
     PresentationCalculationPolicy,
+    Resource,
+    Work,
+    WorkCoverageRecord,
 )
 from core.coverage import (
     CatalogCoverageProvider,
@@ -13,7 +26,12 @@ from core.metadata_layer import (
     Metadata,
 )
 from core.mirror import MirrorUploader
-from coverage_utils import MetadataWranglerReplacementPolicy
+from core.util.datetime_helpers import utc_now
+from coverage_utils import (
+    MetadataWranglerReplacementPolicy,
+    QueryCounter,
+    ScheduledCoverageProvider,
+)
 
 
 class WorkPresentationCoverageProvider(WorkCoverageProvider):
@@ -25,19 +43,72 @@ class WorkPresentationCoverageProvider(WorkCoverageProvider):
     core.coverage.WorkClassificationCoverageProvider,
     but it needs to operate on all works, not just works that have
     been made presentation-ready.
+
+    Content Cafe, OCLC and Overdrive tend to finish with a given Work
+    within minutes of each other. Rather than recalculate the Work's
+    presentation after each one, a Work that's registered again while
+    it's still waiting to be processed keeps its place in line, and
+    nothing is processed until DEBOUNCE_WINDOW after it was first
+    registered. That way one recalculation covers all of the changes.
     """
 
     SERVICE_NAME = "Work Presentation Coverage Provider"
     OPERATION = "recalculate-presentation"
-    DEFAULT_BATCH_SIZE = 25
+
+    # Everything calculate_presentation() needs is loaded for the
+    # whole batch at once (see preload()), so large batches are
+    # cheap.
+    DEFAULT_BATCH_SIZE = 500
+    DEBOUNCE_WINDOW = datetime.timedelta(minutes=15)
 
     _policy = None
 
     def __init__(self, *args, **kwargs):
+        """Constructor.
+
+        :param debounce_window: A timedelta to use instead of
+            DEBOUNCE_WINDOW.
+        """
+        self.debounce_window = kwargs.pop(
+            'debounce_window', self.DEBOUNCE_WINDOW
+        )
         if not 'registered_only' in kwargs:
             kwargs['registered_only'] = True
         super(WorkPresentationCoverageProvider, self).__init__(*args, **kwargs)
 
+    @classmethod
+    def register(cls, work, *args, **kwargs):
+        """Register a Work to have its presentation recalculated.
+
+        If the Work is already registered and waiting, this
+        registration is collapsed into the existing one, even if
+        `force` is True.
+        """
+        record = WorkCoverageRecord.lookup(work, cls.OPERATION)
+        if record and record.status == CoverageRecord.REGISTERED:
+            return record, False
+        return super(WorkPresentationCoverageProvider, cls).register(
+            work, *args, **kwargs
+        )
+
+    def items_that_need_coverage(self, *args, **kwargs):
+        """Find Works that need their presentation recalculated, leaving
+        out Works registered within the debounce window, in case more
+        changes are on the way.
+        """
+        qu = super(
+            WorkPresentationCoverageProvider, self
+        ).items_that_need_coverage(*args, **kwargs)
+        if self.debounce_window:
+            cutoff = utc_now() - self.debounce_window
+            qu = qu.filter(
+                or_(
+                    WorkCoverageRecord.status != CoverageRecord.REGISTERED,
+                    WorkCoverageRecord.timestamp <= cutoff,
+                )
+            )
+        return qu
+
     @property
     def policy(self):
         # We're going to be aggressive about recalculating the presentation
@@ -50,6 +121,64 @@ class WorkPresentationCoverageProvider(WorkCoverageProvider):
             )
         return self._policy
 
+    @classmethod
+    def preload_options(cls):
+        """The loader options that bring in everything
+        calculate_presentation() looks at.
+        """
+        pools = selectinload(Work.license_pools)
+        identifier = pools.joinedload(LicensePool.identifier)
+        def edition(loader):
+            # An Edition's contributors, cover and identifier.
+            return [
+                loader.selectinload(Edition.contributions).joinedload(
+                    Contribution.contributor
+                ),
+                loader.joinedload(Edition.cover),
+                loader.joinedload(Edition.primary_identifier),
+            ]
+        return (
+            edition(selectinload(Work.presentation_edition))
+            + edition(pools.joinedload(LicensePool.presentation_edition))
+            + [
+                identifier.selectinload(Identifier.classifications).joinedload(
+                    Classification.subject
+                ),
+                identifier.selectinload(Identifier.measurements),
+                identifier.selectinload(Identifier.links).joinedload(
+                    Hyperlink.resource
+                ).joinedload(Resource.representation),
+                selectinload(Work.coverage_records),
+            ]
+        )
+
+    def preload(self, works):
+        """Load everything calculate_presentation() will need for a batch
+        of Works, in a fixed number of queries.
+
+        :return: The Works, in their original order.
+        """
+        works = list(works)
+        ids = [work.id for work in works]
+        if ids:
+            self._db.query(Work).filter(Work.id.in_(ids)).options(
+                *self.preload_options()
+            ).all()
+        return works
+
+    def process_batch(self, batch):
+        with QueryCounter(self._db) as counter:
+            works = self.preload(batch)
+            preload_queries = counter.count
+            results = super(
+                WorkPresentationCoverageProvider, self
+            ).process_batch(works)
+        self.log.info(
+            "Recalculated presentation for %d works: %d queries to preload, %d in total.",
+            len(works), preload_queries, counter.count
+        )
+        return results
+
     def process_item(self, work):
         work.calculate_presentation(
             policy=self.policy, exclude_search=True,
@@ -125,8 +254,8 @@ class CalculatesWorkPresentation(object):
         pass
 
 
-class IntegrationClientCoverImageCoverageProvider(CatalogCoverageProvider,
-    CalculatesWorkPresentation
+class IntegrationClientCoverImageCoverageProvider(ScheduledCoverageProvider,
+    CatalogCoverageProvider, CalculatesWorkPresentation
 ):
     """Mirrors and scales cover images we heard about from an IntegrationClient."""
 
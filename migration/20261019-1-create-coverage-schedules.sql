@@ -0,0 +1,11 @@
+-- Keep track of metadata-wrangler-specific scheduling information for
+-- coverage records, starting with the priority lane each record is
+-- processed in.
+create table if not exists coverageschedules (
+ id serial primary key,
+ coverage_record_id integer not null unique references coveragerecords(id) on delete cascade,
+ priority integer not null default 0
+);
+
+create index if not exists ix_coverageschedules_coverage_record_id on coverageschedules (coverage_record_id);
+create index if not exists ix_coverageschedules_priority on coverageschedules (priority);
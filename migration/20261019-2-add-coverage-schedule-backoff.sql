@@ -0,0 +1,6 @@
+-- Keep track of repeated transient failures so they can be retried
+-- with exponential backoff instead of on every run.
+alter table coverageschedules add column if not exists attempts integer not null default 0;
+alter table coverageschedules add column if not exists next_attempt_time timestamp with time zone;
+
+create index if not exists ix_coverageschedules_next_attempt_time on coverageschedules (next_attempt_time);
@@ -0,0 +1,13 @@
+-- Token buckets that limit the combined request rate of every
+-- metadata wrangler process to each upstream host.
+create table if not exists upstreamratelimits (
+ id serial primary key,
+ host varchar not null unique,
+ tokens double precision not null,
+ updated timestamp with time zone not null,
+ requests integer not null default 0,
+ seconds_waited double precision not null default 0,
+ counted_since timestamp with time zone not null
+);
+
+create index if not exists ix_upstreamratelimits_host on upstreamratelimits (host);
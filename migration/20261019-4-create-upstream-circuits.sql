@@ -0,0 +1,11 @@
+-- Circuit breakers that stop every metadata wrangler process from
+-- sending requests to an upstream host that is down.
+create table if not exists upstreamcircuits (
+ id serial primary key,
+ host varchar not null unique,
+ failures integer not null default 0,
+ last_failure timestamp with time zone,
+ open_until timestamp with time zone
+);
+
+create index if not exists ix_upstreamcircuits_host on upstreamcircuits (host);
@@ -0,0 +1,14 @@
+-- Keep track of when each contributor was last resolved through
+-- VIAF, so the same contributors aren't looked up over and over.
+create table if not exists contributorviafcoverage (
+ id serial primary key,
+ contributor_id integer not null unique references contributors(id) on delete cascade,
+ status varchar not null,
+ timestamp timestamp with time zone not null,
+ confidence double precision,
+ exception varchar
+);
+
+create index if not exists ix_contributorviafcoverage_contributor_id on contributorviafcoverage (contributor_id);
+create index if not exists ix_contributorviafcoverage_status on contributorviafcoverage (status);
+create index if not exists ix_contributorviafcoverage_timestamp on contributorviafcoverage (timestamp);
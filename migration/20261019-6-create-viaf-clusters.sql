@@ -0,0 +1,10 @@
+-- Summaries of VIAF clusters, so each cluster is only parsed once.
+create table if not exists viafclusters (
+ id serial primary key,
+ viaf varchar not null unique,
+ summary varchar not null,
+ version integer not null,
+ timestamp timestamp with time zone not null
+);
+
+create index if not exists ix_viafclusters_viaf on viafclusters (viaf);
@@ -0,0 +1,3 @@
+-- AuthorNameCanonicalizer.sort_name_from_database looks up
+-- Contributors by display name.
+create index if not exists ix_contributors_display_name on contributors (display_name);
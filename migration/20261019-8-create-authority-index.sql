@@ -0,0 +1,22 @@
+-- A local name-authority index built from the contributors table, so
+-- names we've already resolved don't have to be looked up in VIAF
+-- again when they're spelled a little differently.
+create table if not exists authoritynames (
+ id serial primary key,
+ contributor_id integer not null unique references contributors(id) on delete cascade,
+ display_name varchar not null,
+ sort_name varchar not null,
+ key varchar not null
+);
+
+create index if not exists ix_authoritynames_contributor_id on authoritynames (contributor_id);
+create index if not exists ix_authoritynames_key on authoritynames (key);
+
+create table if not exists authoritytokens (
+ id serial primary key,
+ authority_name_id integer not null references authoritynames(id) on delete cascade,
+ token varchar not null
+);
+
+create index if not exists ix_authoritytokens_authority_name_id on authoritytokens (authority_name_id);
+create index if not exists ix_authoritytokens_token on authoritytokens (token);
@@ -0,0 +1,14 @@
+-- The transitive closure of the equivalents table, kept up to date
+-- as Equivalencies are added, so the identifiers equivalent to an
+-- identifier can be found without a recursive query.
+create table if not exists equivalencyclosures (
+ id serial primary key,
+ identifier_id integer not null references identifiers(id) on delete cascade,
+ equivalent_id integer not null references identifiers(id) on delete cascade,
+ strength float not null,
+ depth integer not null,
+ unique (identifier_id, equivalent_id)
+);
+
+create index if not exists ix_equivalencyclosures_identifier_id on equivalencyclosures (identifier_id);
+create index if not exists ix_equivalencyclosures_equivalent_id on equivalencyclosures (equivalent_id);
@@ -0,0 +1,421 @@
+"""Database tables used by the metadata wrangler but not by the rest of
+Library Simplified.
+
+These tables share core.model's declarative Base, so they're created
+along with the core tables when a new database is initialized. Each
+one also has a migration in migration/ for existing databases.
+"""
+import datetime
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Float,
+    ForeignKey,
+    Integer,
+    Unicode,
+    UniqueConstraint,
+)
+from sqlalchemy.orm import relationship
+from sqlalchemy.orm.session import Session
+
+from core.model import (
+    Base,
+    Contributor,
+    CoverageRecord,
+    get_one,
+    get_one_or_create,
+)
+from core.util.datetime_helpers import utc_now
+
+
+class CoverageSchedule(Base):
+    """Scheduling information about a CoverageRecord.
+
+    CoverageRecords are shared with every other Library Simplified
+    server, so metadata-wrangler-specific information about when a
+    record should be processed lives here instead.
+    """
+    __tablename__ = 'coverageschedules'
+
+    # Identifiers a client is waiting on go ahead of identifiers
+    # registered in bulk by migration scripts.
+    NORMAL_PRIORITY = 0
+    HIGH_PRIORITY = 10
+
+    id = Column(Integer, primary_key=True)
+    coverage_record_id = Column(
+        Integer, ForeignKey('coveragerecords.id', ondelete='CASCADE'),
+        index=True, unique=True, nullable=False
+    )
+    coverage_record = relationship(CoverageRecord)
+
+    priority = Column(
+        Integer, default=NORMAL_PRIORITY, nullable=False, index=True
+    )
+
+    # The number of transient failures in a row, and the time before
+    # which the record shouldn't be retried.
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_time = Column(DateTime(timezone=True), index=True)
+
+    def __repr__(self):
+        return '<CoverageSchedule: coverage_record_id=%s priority=%s attempts=%s next_attempt_time=%s>' % (
+            self.coverage_record_id, self.priority, self.attempts,
+            self.next_attempt_time
+        )
+
+    @classmethod
+    def for_record(cls, record):
+        """Find or create the CoverageSchedule for a CoverageRecord."""
+        _db = Session.object_session(record)
+        schedule, is_new = get_one_or_create(
+            _db, cls, coverage_record=record
+        )
+        return schedule
+
+    @classmethod
+    def prioritize(cls, record, priority):
+        """Make sure `record` is handled with at least the given priority.
+
+        A priority is never lowered this way -- once a client is
+        waiting on an Identifier, a later bulk registration shouldn't
+        send it to the back of the line.
+
+        A record with no CoverageSchedule is in the normal lane, so
+        no CoverageSchedule is created just to say so.
+
+        :param record: A CoverageRecord, possibly None.
+        :param priority: An integer priority, possibly None.
+        :return: The CoverageSchedule, or None if there was nothing to do.
+        """
+        if record is None or priority is None:
+            return None
+        if priority <= cls.NORMAL_PRIORITY:
+            _db = Session.object_session(record)
+            return get_one(_db, cls, coverage_record=record)
+        schedule = cls.for_record(record)
+        if schedule.priority is None or schedule.priority < priority:
+            schedule.priority = priority
+        return schedule
+
+    @classmethod
+    def postpone(cls, record, retry_delay, now=None):
+        """Note a transient failure for `record` and put off the next
+        attempt.
+
+        :param retry_delay: A function that takes the number of
+            failures in a row and returns a timedelta, or None if the
+            record can be retried immediately.
+        :return: The CoverageSchedule.
+        """
+        schedule = cls.for_record(record)
+        schedule.attempts = (schedule.attempts or 0) + 1
+        delay = retry_delay(schedule.attempts)
+        if delay is None:
+            schedule.next_attempt_time = None
+        else:
+            schedule.next_attempt_time = (now or utc_now()) + delay
+        return schedule
+
+    @classmethod
+    def reset(cls, record):
+        """Forget about any failures in `record`'s past, so that the
+        next failure starts the backoff over again.
+        """
+        if record is None:
+            return None
+        _db = Session.object_session(record)
+        schedule = get_one(_db, cls, coverage_record=record)
+        if schedule:
+            schedule.attempts = 0
+            schedule.next_attempt_time = None
+        return schedule
+
+
+class UpstreamRateLimit(Base):
+    """The state of a token bucket that limits the rate at which every
+    metadata wrangler process, taken together, makes requests to one
+    upstream host.
+
+    This table is only ever changed through upstream.RateLimiter,
+    which does it with a single atomic statement.
+    """
+    __tablename__ = 'upstreamratelimits'
+
+    id = Column(Integer, primary_key=True)
+    host = Column(Unicode, index=True, unique=True, nullable=False)
+
+    # The number of requests that can be made right now. This goes
+    # negative when processes are waiting their turn.
+    tokens = Column(Float, nullable=False)
+
+    # The last time `tokens` was brought up to date.
+    updated = Column(DateTime(timezone=True), nullable=False)
+
+    # Counters used to report the effective request rate.
+    requests = Column(Integer, default=0, nullable=False)
+    seconds_waited = Column(Float, default=0, nullable=False)
+    counted_since = Column(DateTime(timezone=True), nullable=False)
+
+    def __repr__(self):
+        return '<UpstreamRateLimit: host=%s tokens=%.2f requests=%d>' % (
+            self.host, self.tokens, self.requests
+        )
+
+
+class UpstreamCircuit(Base):
+    """The state of the circuit breaker for one upstream host, shared
+    by every metadata wrangler process.
+
+    This table is only ever changed through upstream.CircuitBreaker.
+    """
+    __tablename__ = 'upstreamcircuits'
+
+    id = Column(Integer, primary_key=True)
+    host = Column(Unicode, index=True, unique=True, nullable=False)
+
+    # The number of failures in a row, and when the most recent one
+    # happened.
+    failures = Column(Integer, default=0, nullable=False)
+    last_failure = Column(DateTime(timezone=True))
+
+    # While this is in the future, the circuit is open and nobody
+    # sends requests to the host. Once it's in the past, the circuit
+    # is half-open: one process gets to send a probe request, and
+    # the outcome of that request closes or reopens the circuit. If
+    # this is null, the circuit is closed.
+    open_until = Column(DateTime(timezone=True))
+
+    def __repr__(self):
+        return '<UpstreamCircuit: host=%s failures=%d open_until=%s>' % (
+            self.host, self.failures, self.open_until
+        )
+
+
+class ContributorVIAFCoverage(Base):
+    """The outcome of the most recent attempt to resolve a Contributor
+    through VIAF.
+
+    This keeps us from going to VIAF over and over again for the
+    same Contributor every time one of their books is processed.
+    """
+    __tablename__ = 'contributorviafcoverage'
+
+    REGISTERED = 'registered'
+    MATCHED = 'matched'
+    NOT_FOUND = 'not found'
+    ERROR = 'error'
+
+    # How long each outcome stays good. Once an outcome is this old,
+    # the Contributor can be registered for resolution again. An
+    # error is retried after the same delay the coverage providers
+    # use after a transient failure.
+    FRESH_FOR = {
+        MATCHED : datetime.timedelta(days=365),
+        NOT_FOUND : datetime.timedelta(days=90),
+        ERROR : datetime.timedelta(hours=1),
+    }
+
+    id = Column(Integer, primary_key=True)
+    contributor_id = Column(
+        Integer, ForeignKey('contributors.id', ondelete='CASCADE'),
+        index=True, unique=True, nullable=False
+    )
+    contributor = relationship(Contributor)
+
+    status = Column(Unicode, index=True, nullable=False)
+    timestamp = Column(DateTime(timezone=True), index=True, nullable=False)
+
+    # VIAF's confidence in the best match it found, out of 100.
+    confidence = Column(Float)
+    exception = Column(Unicode)
+
+    def __repr__(self):
+        return '<ContributorVIAFCoverage: contributor_id=%s status=%s confidence=%s>' % (
+            self.contributor_id, self.status, self.confidence
+        )
+
+    def is_fresh(self, now=None):
+        """Is this outcome recent enough that there's no point in asking
+        VIAF again?
+        """
+        if self.status == self.REGISTERED:
+            # The Contributor is already waiting to be resolved.
+            return True
+        fresh_for = self.FRESH_FOR.get(self.status)
+        if not fresh_for or not self.timestamp:
+            return False
+        return self.timestamp > (now or utc_now()) - fresh_for
+
+    @classmethod
+    def register(cls, contributor, now=None):
+        """Make sure a Contributor will be resolved through VIAF, unless
+        it was resolved recently.
+
+        :return: A 2-tuple (ContributorVIAFCoverage, is_registered).
+            `is_registered` is True if the Contributor was just
+            registered for resolution.
+        """
+        _db = Session.object_session(contributor)
+        coverage, is_new = get_one_or_create(
+            _db, cls, contributor=contributor,
+            create_method_kwargs=dict(
+                status=cls.REGISTERED, timestamp=now or utc_now()
+            )
+        )
+        if is_new:
+            return coverage, True
+        if coverage.is_fresh(now):
+            return coverage, False
+        coverage.record(cls.REGISTERED, now=now)
+        return coverage, True
+
+    def record(self, status, confidence=None, exception=None, now=None):
+        """Record the outcome of an attempt to resolve the Contributor."""
+        self.status = status
+        self.confidence = confidence
+        self.exception = exception
+        self.timestamp = now or utc_now()
+
+
+class VIAFCluster(Base):
+    """A compact summary of a VIAF cluster, as extracted by
+    viaf.VIAFParser.summarize.
+
+    Keeping this around means a cluster only has to be parsed once,
+    however many times it's looked up. A summary is good for as long
+    as the document it was extracted from would be.
+    """
+    __tablename__ = 'viafclusters'
+
+    id = Column(Integer, primary_key=True)
+    viaf = Column(Unicode, index=True, unique=True, nullable=False)
+
+    # The output of VIAFClusterSummary.to_json, and the version of
+    # the summary format that produced it.
+    summary = Column(Unicode, nullable=False)
+    version = Column(Integer, nullable=False)
+
+    # When the cluster document was fetched from VIAF.
+    timestamp = Column(DateTime(timezone=True), nullable=False)
+
+    def __repr__(self):
+        return '<VIAFCluster: viaf=%s version=%s timestamp=%s>' % (
+            self.viaf, self.version, self.timestamp
+        )
+
+    def is_fresh(self, max_age, version, now=None):
+        """Can this summary still be used?
+
+        :param max_age: A timedelta.
+        :param version: The current version of the summary format.
+        """
+        return (
+            self.version == version and
+            self.timestamp > (now or utc_now()) - max_age
+        )
+
+    @classmethod
+    def store(cls, _db, viaf, summary, version, timestamp=None):
+        """Create or replace the summary of a VIAF cluster."""
+        cluster, is_new = get_one_or_create(
+            _db, cls, viaf=viaf, create_method_kwargs=dict(
+                summary=summary, version=version,
+                timestamp=timestamp or utc_now()
+            )
+        )
+        if not is_new:
+            cluster.summary = summary
+            cluster.version = version
+            cluster.timestamp = timestamp or utc_now()
+        return cluster
+
+
+class AuthorityName(Base):
+    """A Contributor's entry in the local name-authority index kept by
+    canonicalize.AuthorityIndex.
+
+    The Contributor's names are copied here when it's indexed, so that
+    a Contributor whose names have changed since then can be found and
+    indexed again.
+    """
+    __tablename__ = 'authoritynames'
+
+    id = Column(Integer, primary_key=True)
+    contributor_id = Column(
+        Integer, ForeignKey('contributors.id', ondelete='CASCADE'),
+        index=True, unique=True, nullable=False
+    )
+    contributor = relationship(Contributor)
+
+    display_name = Column(Unicode, nullable=False)
+    sort_name = Column(Unicode, nullable=False)
+
+    # The display name, normalized for matching.
+    key = Column(Unicode, index=True, nullable=False)
+
+    tokens = relationship(
+        'AuthorityToken', backref='authority_name',
+        cascade='all, delete-orphan'
+    )
+
+    def __repr__(self):
+        return '<AuthorityName: contributor_id=%s key=%r sort_name=%r>' % (
+            self.contributor_id, self.key, self.sort_name
+        )
+
+
+class AuthorityToken(Base):
+    """A posting in the local name-authority index: one word in the
+    normalized display name of an AuthorityName.
+    """
+    __tablename__ = 'authoritytokens'
+
+    id = Column(Integer, primary_key=True)
+    authority_name_id = Column(
+        Integer, ForeignKey('authoritynames.id', ondelete='CASCADE'),
+        index=True, nullable=False
+    )
+    token = Column(Unicode, index=True, nullable=False)
+
+    def __repr__(self):
+        return '<AuthorityToken: authority_name_id=%s token=%r>' % (
+            self.authority_name_id, self.token
+        )
+
+
+class EquivalencyClosure(Base):
+    """One Identifier that's equivalent to another, directly or through
+    a chain of Equivalencies, as maintained by
+    equivalency.EquivalencyClosureIndex.
+
+    Every pair is stored in both directions, so the Identifiers
+    equivalent to an Identifier can be found with a single indexed
+    read instead of a recursive walk over the equivalents table.
+    """
+    __tablename__ = 'equivalencyclosures'
+    __table_args__ = (
+        UniqueConstraint('identifier_id', 'equivalent_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    identifier_id = Column(
+        Integer, ForeignKey('identifiers.id', ondelete='CASCADE'),
+        index=True, nullable=False
+    )
+    equivalent_id = Column(
+        Integer, ForeignKey('identifiers.id', ondelete='CASCADE'),
+        index=True, nullable=False
+    )
+
+    # The strength of the strongest chain of Equivalencies found
+    # between the two Identifiers -- the product of the strengths of
+    # its links -- and the number of links in it.
+    strength = Column(Float, nullable=False)
+    depth = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return '<EquivalencyClosure: identifier_id=%s equivalent_id=%s strength=%.2f depth=%d>' % (
+            self.identifier_id, self.equivalent_id, self.strength, self.depth
+        )
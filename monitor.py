@@ -3,7 +3,10 @@ import csv
 import sys
 
 from psycopg2.extras import NumericRange
-from sqlalchemy import or_
+from sqlalchemy import (
+    and_,
+    or_,
+)
 from sqlalchemy.orm import (
     aliased,
 )
@@ -13,18 +16,37 @@ from core.classifier import Classifier
 from core.monitor import (
     SubjectSweepMonitor,
     IdentifierSweepMonitor,
+    SweepMonitor,
     WorkSweepMonitor,
 )
 from core.model import (
+    Contributor,
     DataSource,
     Equivalency,
     Identifier,
     LicensePool,
+    Representation,
     Subject,
     Work,
 )
+from core.util.datetime_helpers import utc_now
 
+from blobstore import BlobStore
+from canonicalize import AuthorityIndex
+from compression import (
+    store_content,
+    uncompressed_representations,
+    unstored_representations,
+)
 from content_cafe import ContentCafeAPI
+from equivalency import EquivalencyClosureIndex
+from integration_client import WorkPresentationCoverageProvider
+from model import (
+    AuthorityName,
+    ContributorVIAFCoverage,
+)
+import personal_names
+from viaf import VIAFClient
 
 
 class FASTNameAssignmentMonitor(SubjectSweepMonitor):
@@ -54,6 +76,198 @@ class FASTNameAssignmentMonitor(SubjectSweepMonitor):
         elif subject.type == Subject.LCSH:
             subject.name = self.lcsh.get(subject.identifier)
 
+class ContributorVIAFSweep(SweepMonitor):
+    """Resolve Contributors through VIAF.
+
+    Contributors are registered for resolution (with
+    ContributorVIAFCoverage.register) when a book they worked on is
+    processed. This Monitor does the actual VIAF lookups, in
+    batches, away from the coverage providers.
+    """
+
+    SERVICE_NAME = "VIAF Contributor Sweep"
+    MODEL_CLASS = Contributor
+    DEFAULT_BATCH_SIZE = 25
+
+    # Wait this long after an error before trying a Contributor again.
+    RETRY_DELAY = ContributorVIAFCoverage.FRESH_FOR[
+        ContributorVIAFCoverage.ERROR
+    ]
+
+    def __init__(self, _db, viaf=None, **kwargs):
+        super(ContributorVIAFSweep, self).__init__(_db, **kwargs)
+        self.viaf = viaf or VIAFClient(_db)
+
+    def item_query(self):
+        """Find Contributors that are waiting to be resolved, or whose
+        last resolution ended in an error more than RETRY_DELAY ago.
+        """
+        qu = super(ContributorVIAFSweep, self).item_query()
+        retry = ContributorVIAFCoverage.status==ContributorVIAFCoverage.ERROR
+        if self.RETRY_DELAY:
+            retry = and_(
+                retry,
+                ContributorVIAFCoverage.timestamp < utc_now()-self.RETRY_DELAY
+            )
+        return qu.join(
+            ContributorVIAFCoverage,
+            ContributorVIAFCoverage.contributor_id==Contributor.id
+        ).filter(
+            or_(
+                ContributorVIAFCoverage.status==ContributorVIAFCoverage.REGISTERED,
+                retry,
+            )
+        )
+
+    def process_batch(self, offset):
+        offset = super(ContributorVIAFSweep, self).process_batch(offset)
+        # Report how well the name caches are working, so they can be
+        # sized appropriately.
+        self.log.info(
+            "Name cache statistics: %s", personal_names.describe_statistics()
+        )
+        return offset
+
+    def process_item(self, contributor):
+        coverage, is_new = ContributorVIAFCoverage.register(contributor)
+        try:
+            survivor, match = self.viaf.process_contributor(contributor)
+        except Exception as e:
+            self.log.error(
+                "Error resolving %r through VIAF", contributor, exc_info=e
+            )
+            coverage.record(ContributorVIAFCoverage.ERROR, exception=repr(e))
+            return
+
+        if survivor is not contributor:
+            # The Contributor turned out to be a duplicate and was
+            # merged into an earlier one. Its coverage goes away along
+            # with it, through the foreign key, so leave it alone and
+            # record the outcome for the earlier Contributor instead.
+            if coverage in self._db:
+                self._db.expunge(coverage)
+            contributor = survivor
+            coverage, is_new = ContributorVIAFCoverage.register(contributor)
+
+        if not match:
+            coverage.record(ContributorVIAFCoverage.NOT_FOUND)
+            return
+
+        data, match_confidences, titles = match
+        coverage.record(
+            ContributorVIAFCoverage.MATCHED,
+            confidence=match_confidences.get("total")
+        )
+
+        # The Contributor's names may have changed, which affects
+        # the presentation of every Work they contributed to.
+        for contribution in contributor.contributions:
+            edition = contribution.edition
+            if edition and edition.work:
+                WorkPresentationCoverageProvider.register(
+                    edition.work, force=True
+                )
+
+
+class AuthorityIndexSweep(SweepMonitor):
+    """Keep the local name-authority index (canonicalize.AuthorityIndex)
+    up to date with the contributors table.
+
+    Only Contributors that are new, or whose names have changed since
+    they were indexed, are processed.
+    """
+
+    SERVICE_NAME = "Authority Index Sweep"
+    MODEL_CLASS = Contributor
+    DEFAULT_BATCH_SIZE = 100
+
+    def __init__(self, _db, **kwargs):
+        super(AuthorityIndexSweep, self).__init__(_db, **kwargs)
+        self.index = AuthorityIndex(_db)
+
+    def item_query(self):
+        qu = super(AuthorityIndexSweep, self).item_query()
+        has_names = and_(
+            Contributor.display_name != None, Contributor.sort_name != None
+        )
+        return qu.outerjoin(
+            AuthorityName, AuthorityName.contributor_id==Contributor.id
+        ).filter(
+            or_(
+                # Not indexed yet.
+                and_(AuthorityName.id == None, has_names),
+                # Indexed under names that have since changed.
+                and_(
+                    AuthorityName.id != None,
+                    or_(
+                        Contributor.display_name.is_distinct_from(
+                            AuthorityName.display_name
+                        ),
+                        Contributor.sort_name.is_distinct_from(
+                            AuthorityName.sort_name
+                        ),
+                    )
+                ),
+            )
+        )
+
+    def process_item(self, contributor):
+        self.index.index(contributor)
+
+
+class EquivalencyClosureSweep(SweepMonitor):
+    """Keep the closure of the equivalents table
+    (equivalency.EquivalencyClosureIndex) up to date with
+    Equivalencies that weren't added through the index.
+
+    The first sweep builds the closure for a database that didn't
+    have one.
+    """
+
+    SERVICE_NAME = "Equivalency Closure Sweep"
+    MODEL_CLASS = Equivalency
+    DEFAULT_BATCH_SIZE = 100
+
+    def __init__(self, _db, **kwargs):
+        super(EquivalencyClosureSweep, self).__init__(_db, **kwargs)
+        self.index = EquivalencyClosureIndex(_db)
+
+    def item_query(self):
+        qu = super(EquivalencyClosureSweep, self).item_query()
+        return self.index.unindexed(qu)
+
+    def process_item(self, equivalency):
+        self.index.add(equivalency)
+
+
+class RepresentationCompressionSweep(SweepMonitor):
+    """Compress cached upstream documents that were stored before
+    compression was introduced.
+
+    If a blob store is configured, this also moves documents out of
+    the database and into the blob store.
+    """
+
+    SERVICE_NAME = "Representation Compression Sweep"
+    MODEL_CLASS = Representation
+    DEFAULT_BATCH_SIZE = 100
+
+    def __init__(self, _db, blob_store=None, **kwargs):
+        super(RepresentationCompressionSweep, self).__init__(_db, **kwargs)
+        self.blob_store = blob_store or BlobStore.default()
+
+    def item_query(self):
+        qu = super(RepresentationCompressionSweep, self).item_query()
+        if self.blob_store:
+            return unstored_representations(qu)
+        return uncompressed_representations(qu)
+
+    def process_item(self, representation):
+        representation.content = store_content(
+            representation.content, blob_store=self.blob_store
+        )
+
+
 class ContentCafeDemandMeasurementSweep(IdentifierSweepMonitor):
     """Ensure that every ISBN directly associated with a commercial
     identifier has a recent demand measurement.
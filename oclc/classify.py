@@ -1,3 +1,4 @@
+import datetime
 import logging
 import re
 from urllib.parse import urlencode
@@ -30,7 +31,23 @@ from core.model import (
 )
 from core.util import MetadataSimilarity
 from core.util.xmlparser import XMLParser
+from compression import (
+    Compressor,
+    get_representation,
+    is_cached,
+    representation_content,
+)
+from cache import LRUCache
 from coverage_utils import MetadataWranglerBibliographicCoverageProvider
+from equivalency import EquivalencyClosureIndex
+from upstream import (
+    CircuitBreaker,
+    MockCircuitBreaker,
+    MockRateLimiter,
+    Prefetcher,
+    RateLimiter,
+    protect,
+)
 from viaf import NameParser as VIAFNameParser
 
 class OCLC(object):
@@ -1063,8 +1080,15 @@ class OCLCClassifyAPI(object):
 
     NO_SUMMARY = '&summary=false'
 
-    def __init__(self, _db):
+    # The number of documents prefetch() fetches at once.
+    CONCURRENCY = 4
+
+    def __init__(self, _db, rate_limiter=None, circuit_breaker=None,
+                 concurrency=None):
         self._db = _db
+        self.rate_limiter = rate_limiter or RateLimiter(_db)
+        self.circuit_breaker = circuit_breaker or CircuitBreaker(_db)
+        self.concurrency = concurrency or self.CONCURRENCY
 
     @property
     def source(self):
@@ -1073,39 +1097,95 @@ class OCLCClassifyAPI(object):
     def query_string(self, **kwargs):
         return urlencode(sorted(kwargs.items()))
 
-    def lookup_by(self, **kwargs):
-        """Perform an OCLC Classify lookup."""
-        query_string = self.query_string(**kwargs)
-        url = self.BASE_URL + query_string
-        return self._make_request(url)
+    def url_for(self, **kwargs):
+        return self.BASE_URL + self.query_string(**kwargs)
+
+    def lookup_by(self, prefetcher=None, **kwargs):
+        """Perform an OCLC Classify lookup.
+
+        :param prefetcher: A Prefetcher returned by prefetch(), which
+            may already have fetched the document.
+        """
+        return self._make_request(self.url_for(**kwargs), prefetcher)
+
+    def _fetch(self, do_get=None):
+        """The HTTP GET function to use, without the guards that keep
+        track of shared upstream state.
+        """
+        return protect(
+            do_get or Representation.simple_http_get, Compressor()
+        )
+
+    def _guard(self, do_get=None):
+        return protect(
+            self._fetch(do_get), self.circuit_breaker, self.rate_limiter
+        )
+
+    def prefetch(self, urls, do_get=None, concurrency=None):
+        """Fetch the documents that aren't cached yet, `concurrency` at
+        a time.
+
+        Only the network requests happen in worker threads. The rate
+        limiter and circuit breaker are consulted in this thread, and
+        the documents are written to the cache by the lookups that
+        eventually ask for them, one at a time, also in this thread.
+
+        :param concurrency: The number of documents to fetch at once,
+            if not this API's own `concurrency`.
+        :return: A Prefetcher to pass into lookup_by(). Close it, or
+            use it as a context manager, once the lookups are done.
+        """
+        prefetcher = Prefetcher(
+            concurrency or self.concurrency, self.rate_limiter,
+            self.circuit_breaker
+        )
+        prefetcher.prefetch(
+            self._fetch(do_get),
+            [x for x in urls if not is_cached(self._db, x)], {}
+        )
+        return prefetcher
 
-    def _make_request(self, url):
-        representation, cached = Representation.get(self._db, url)
-        return representation.content
+    def _make_request(self, url, prefetcher=None):
+        do_get = self._guard()
+        if prefetcher:
+            do_get = prefetcher.wrap(do_get)
+        representation, cached = get_representation(self._db, url, do_get)
+        return representation_content(representation)
 
 
 class MockOCLCClassifyAPI(OCLCClassifyAPI):
 
     def __init__(self, _db):
-        super(MockOCLCClassifyAPI, self).__init__(_db)
+        super(MockOCLCClassifyAPI, self).__init__(
+            _db, rate_limiter=MockRateLimiter(),
+            circuit_breaker=MockCircuitBreaker()
+        )
         self.requests = []
         self.responses = []
 
     def queue_response(self, content):
         self.responses.append(content)
 
-    def _make_request(self, url):
+    def prefetch(self, urls, do_get=None, concurrency=None):
+        # Responses come from the queue, in the order they're asked
+        # for.
+        return Prefetcher(concurrency or self.concurrency)
+
+    def _make_request(self, url, prefetcher=None):
         self.requests.append(url)
         return self.responses.pop(0)
 
 
 class OCLCLookupCoverageProvider(MetadataWranglerBibliographicCoverageProvider):
 
+    UPSTREAM_URLS = [OCLCClassifyAPI.BASE_URL]
+
     def __init__(self, collection, api=None, **kwargs):
         super(OCLCLookupCoverageProvider, self).__init__(
             collection, registered_only=True, **kwargs
         )
         self.api = api or OCLCClassifyAPI(self._db)
+        self.closure = EquivalencyClosureIndex(self._db)
 
 
 class IdentifierLookupCoverageProvider(OCLCLookupCoverageProvider):
@@ -1115,13 +1195,80 @@ class IdentifierLookupCoverageProvider(OCLCLookupCoverageProvider):
     INPUT_IDENTIFIER_TYPES = [Identifier.ISBN]
     DATA_SOURCE_NAME = DataSource.OCLC
 
+    # Many ISBNs belong to the same few popular works, so the parsed
+    # document for each OWI is kept around for a while, rather than
+    # being read from the cache and parsed again for every ISBN.
+    OWI_CACHE_SIZE = 1000
+    OWI_CACHE_MAX_AGE = datetime.timedelta(hours=6)
+
     parser = OCLCClassifyXMLParser()
 
+    def __init__(self, collection, owi_concurrency=None, owi_cache_size=None,
+                 **kwargs):
+        """Constructor.
+
+        :param owi_concurrency: The number of OWIs to fetch at once.
+            Defaults to the API's own concurrency.
+        :param owi_cache_size: The number of parsed OWI documents to
+            keep around.
+        """
+        super(IdentifierLookupCoverageProvider, self).__init__(
+            collection, **kwargs
+        )
+        self.owi_concurrency = owi_concurrency or self.api.concurrency
+        self.owi_cache = LRUCache(
+            owi_cache_size or self.OWI_CACHE_SIZE, self.OWI_CACHE_MAX_AGE
+        )
+
+    def process_batch(self, batch):
+        hits, misses = self.owi_cache.hits, self.owi_cache.misses
+        results = super(IdentifierLookupCoverageProvider, self).process_batch(
+            batch
+        )
+        hits = self.owi_cache.hits - hits
+        misses = self.owi_cache.misses - misses
+        if hits or misses:
+            self.log.info(
+                "OWI cache this batch: %d hits, %d misses (%.0f%%), %d OWIs held",
+                hits, misses, 100.0 * hits / (hits + misses),
+                len(self.owi_cache)
+            )
+        return results
+
     def _get_tree(self, **kwargs):
         """Look up either an ISBN or an OWI, and return a tree generated from the resulting XML."""
         xml = self.api.lookup_by(**kwargs)
         return etree.fromstring(xml, parser=etree.XMLParser(recover=True))
 
+    def _owi_trees(self, owis):
+        """Find the tree for each of a number of OWIs.
+
+        Trees come from the OWI cache if possible. The documents for
+        the rest are fetched concurrently, then parsed and cached.
+
+        :return: A dictionary mapping each OWI to its tree.
+        """
+        trees = dict()
+        missing = []
+        for owi in owis:
+            if owi in trees or owi in missing:
+                continue
+            tree = self.owi_cache.get(owi)
+            if tree is None:
+                missing.append(owi)
+            else:
+                trees[owi] = tree
+        if missing:
+            urls = [self.api.url_for(owi=owi) for owi in missing]
+            with self.api.prefetch(
+                urls, concurrency=self.owi_concurrency
+            ) as prefetcher:
+                for owi in missing:
+                    tree = self._get_tree(owi=owi, prefetcher=prefetcher)
+                    self.owi_cache.set(owi, tree)
+                    trees[owi] = tree
+        return trees
+
     def process_item(self, identifier):
         """Ask OCLC Classify about a single ISBN. Create an Edition based on
         what it says. This may involve consolidating information from
@@ -1173,9 +1320,10 @@ class IdentifierLookupCoverageProvider(OCLCLookupCoverageProvider):
         by looking up the OWI, and annotate `metadata` based on
         that.
         """
-        for item in owi_data:
-            tree_from_owi = self._get_tree(owi=item.identifier)
-            metadata = self.parser.parse(tree_from_owi, metadata)
+        owis = [item.identifier for item in owi_data]
+        trees = self._owi_trees(owis)
+        for owi in owis:
+            metadata = self.parser.parse(trees[owi], metadata)
         return metadata
 
     def _apply(self, metadata):
@@ -1186,6 +1334,9 @@ class IdentifierLookupCoverageProvider(OCLCLookupCoverageProvider):
         metadata.apply(
             edition, collection=None, replace=self.replacement_policy
         )
+        # The ISBN is now equivalent to the OCLC Numbers and Work IDs
+        # Classify told us about.
+        self.closure.update([metadata.primary_identifier])
 
 
 class TitleAuthorLookupCoverageProvider(IdentifierCoverageProvider):
@@ -1220,6 +1371,7 @@ class TitleAuthorLookupCoverageProvider(IdentifierCoverageProvider):
             _db, registered_only=True, **kwargs
         )
         self.api = api or OCLCClassifyAPI(self._db)
+        self.closure = EquivalencyClosureIndex(self._db)
 
     def oclc_safe_title(self, title):
         if not title:
@@ -1341,8 +1493,9 @@ class TitleAuthorLookupCoverageProvider(IdentifierCoverageProvider):
             # similarity between the two records.
             strength = edition.similarity_to(r)
             if strength > 0:
-                edition.primary_identifier.equivalent_to(
-                    self.data_source, r.primary_identifier, strength
+                self.closure.equivalent_to(
+                    edition.primary_identifier, self.data_source,
+                    r.primary_identifier, strength
                 )
 
     def process_item(self, identifier):
@@ -38,7 +38,26 @@ from core.util import (
 )
 from core.util.datetime_helpers import strptime_utc
 
-from coverage_utils import ResolveVIAFOnSuccessCoverageProvider
+from cache import LRUCache
+from compression import (
+    Compressor,
+    get_representation,
+    is_cached,
+    representation_content,
+)
+from coverage_utils import (
+    QueryCounter,
+    ResolveVIAFOnSuccessCoverageProvider,
+)
+from equivalency import EquivalencyClosureIndex
+from upstream import (
+    CircuitBreaker,
+    MockCircuitBreaker,
+    MockRateLimiter,
+    Prefetcher,
+    RateLimiter,
+    protect,
+)
 from viaf import VIAFClient
 
 
@@ -88,6 +107,64 @@ class ldq(object):
                 yield v['@value']
 
 
+class JSONLDGraph(list):
+    """The nodes in a JSON-LD document's @graph, indexed by @id."""
+
+    def __init__(self, nodes=()):
+        super(JSONLDGraph, self).__init__(nodes)
+        self.by_id = collections.defaultdict(list)
+        for position, node in enumerate(self):
+            if isinstance(node, dict) and '@id' in node:
+                self.by_id[node['@id']].append((position, node))
+
+    def lookup(self, uris):
+        """Find the nodes whose @id is one of `uris`.
+
+        :return: A list of nodes, in the order they show up in the graph.
+        """
+        found = []
+        for uri in set(uris):
+            found.extend(self.by_id.get(uri, []))
+        found.sort(key=lambda x: x[0])
+        return [node for position, node in found]
+
+
+class LookupContext(object):
+    """The linked data documents looked up during one run.
+
+    Many identifiers lead to the same OCLC Work and example documents.
+    Sharing a LookupContext between their lookups means each of those
+    documents is retrieved only once. The context is an LRU cache, so
+    a long run can't grow it without limit.
+    """
+
+    # Remember this many documents by default.
+    SIZE = 1000
+
+    def __init__(self, size=None):
+        self.documents = LRUCache(size or self.SIZE)
+
+    def __contains__(self, url):
+        return url in self.documents
+
+    def get(self, url):
+        """The document retrieved from `url` earlier in this run, or None."""
+        return self.documents.get(url)
+
+    def set(self, url, document):
+        self.documents.set(url, document)
+
+    @property
+    def hit_rate(self):
+        return self.documents.hit_rate
+
+    def describe(self):
+        """Summarize how useful the context has been, for logging."""
+        return "%d hits, %d misses, %d documents held" % (
+            self.documents.hits, self.documents.misses, len(self.documents)
+        )
+
+
 class OCLCLinkedData(object):
 
     BASE_URL = 'http://www.worldcat.org/%(type)s/%(id)s.jsonld'
@@ -171,20 +248,41 @@ class OCLCLinkedData(object):
     ])
 
     FILTER_TAGS = POINTLESS_TAGS.union(TAGS_FOR_UNUSABLE_RECORDS)
+
+    # Keep this many parsed documents in memory, so a document that's
+    # looked at several times in one run is only parsed once.
+    GRAPH_CACHE_SIZE = 100
+    graph_cache = LRUCache(GRAPH_CACHE_SIZE)
+
+    # Fetch the documents for this many of a work's examples at once.
+    EXAMPLE_CONCURRENCY = 4
+
     log = logging.getLogger("OCLC Linked Data Client")
 
 
-    def __init__(self, _db):
+    def __init__(self, _db, rate_limiter=None, circuit_breaker=None,
+                 example_concurrency=None):
         self._db = _db
         self.log = logging.getLogger("OCLC Linked Data")
+        self.rate_limiter = rate_limiter or RateLimiter(_db)
+        self.circuit_breaker = circuit_breaker or CircuitBreaker(_db)
+        self.example_concurrency = (
+            example_concurrency or self.EXAMPLE_CONCURRENCY
+        )
 
 
     @property
     def source(self):
         return DataSource.lookup(self._db, DataSource.OCLC_LINKED_DATA)
 
-    def lookup(self, identifier_or_uri, processed_uris=set()):
-        """Perform an OCLC Open Data lookup for the given identifier."""
+    def lookup(self, identifier_or_uri, context=None, prefetcher=None):
+        """Perform an OCLC Open Data lookup for the given identifier.
+
+        :param context: A LookupContext holding documents that were
+            already looked up during this run.
+        :param prefetcher: An upstream.Prefetcher that may already have
+            fetched the document.
+        """
         type = None
         identifier = None
         if isinstance(identifier_or_uri, bytes):
@@ -204,52 +302,119 @@ class OCLCLinkedData(object):
             type = identifier.type
         if not type or not identifier:
             return None, None
-        return self.lookup_by_identifier(identifier, processed_uris)
+        return self.lookup_by_identifier(identifier, context, prefetcher)
+
+    def lookup_by_identifier(self, identifier, context=None,
+                             prefetcher=None):
+        """Turn an Identifier into a JSON-LD document.
 
-    def lookup_by_identifier(self, identifier, processed_uris=set()):
-        """Turn an Identifier into a JSON-LD document."""
+        :param context: A LookupContext. A document that was already
+            looked up in this context is reused rather than retrieved
+            again.
+        """
+        url = self.document_url(identifier)
+        if context:
+            document = context.get(url)
+            if document:
+                self.log.debug("Reusing %s, already looked up.", url)
+                return document, True
+
+        document, cached = self.get_jsonld(url, prefetcher=prefetcher)
+        if context and document:
+            context.set(url, document)
+        return document, cached
+
+    def document_url(self, identifier):
+        """The URL of the JSON-LD document for an OCLC Work or OCLC
+        Number.
+        """
         if identifier.type == Identifier.OCLC_WORK:
             foreign_type = 'work'
             url = self.WORK_BASE_URL
         elif identifier.type == Identifier.OCLC_NUMBER:
             foreign_type = "oclc"
             url = self.BASE_URL
+        return url % dict(id=identifier.identifier, type=foreign_type)
+
+    def _fetch(self, do_get=None):
+        """The HTTP GET function to use, without the guards that keep
+        track of shared upstream state.
+        """
+        return protect(
+            do_get or Representation.simple_http_get, Compressor()
+        )
+
+    def _guard(self, do_get=None):
+        return protect(
+            self._fetch(do_get), self.circuit_breaker, self.rate_limiter
+        )
 
-        url = url % dict(id=identifier.identifier, type=foreign_type)
-        if url in processed_uris:
-            self.log.debug("SKIPPING %s, already processed.", url)
-            return None, True
+    def get_jsonld(self, url, do_get=None, prefetcher=None):
+        """Retrieve a JSON-LD document through the Representation cache.
 
-        processed_uris.add(url)
-        return self.get_jsonld(url)
+        A cache hit makes no network calls, and a cache miss makes one.
 
-    def get_jsonld(self, url):
-        representation, cached = Representation.get(self._db, url)
+        :param prefetcher: An upstream.Prefetcher that may already have
+            fetched the document.
+        :return: A 2-tuple (document, cached). The document is a
+            dictionary like the ones PyLD's document loaders return, or
+            None if the document couldn't be retrieved.
+        """
+        do_get = self._guard(do_get)
+        if prefetcher:
+            do_get = prefetcher.wrap(do_get)
         try:
-            data = jsonld.load_document(url)
+            representation, cached = get_representation(
+                self._db, url, do_get
+            )
+            content = representation_content(representation)
+            if cached and not content:
+                representation, cached = get_representation(
+                    self._db, url, do_get, max_age=0
+                )
+                content = representation_content(representation)
         except Exception as e:
             self.log.error("EXCEPTION on %s: %s", url, e, exc_info=e)
             return None, False
 
-        if cached and not representation.content:
-            representation, cached = Representation.get(
-                self._db, url, max_age=0)
-
-        if not representation.content:
+        if not content:
             return None, False
-        
+
         doc = {
             'contextUrl': None,
             'documentUrl': url,
-            'document': representation.content.decode('utf8')
+            'document': content.decode('utf8')
         }
         return doc, cached
 
+    def document_loader(self, do_get=None):
+        """A PyLD document loader that goes through get_jsonld(), so that
+        PyLD never fetches a document we already have.
+
+        Pass it in as the `documentLoader` option to jsonld.expand(),
+        jsonld.compact() and so on.
+        """
+        def load(url, options=None):
+            doc, cached = self.get_jsonld(url, do_get)
+            if not doc:
+                raise jsonld.JsonLdError(
+                    'Could not retrieve a JSON-LD document from the URL.',
+                    'jsonld.LoadDocumentError', {'url': url},
+                    code='loading document failed'
+                )
+            return doc
+        return load
+
     def oclc_number_for_isbn(self, isbn):
         """Turn an ISBN identifier into an OCLC Number identifier."""
         url = self.ISBN_BASE_URL % dict(id=isbn.identifier)
         representation, cached = Representation.get(
-            self._db, url, Representation.http_get_no_redirect)
+            self._db, url,
+            protect(
+                Representation.http_get_no_redirect,
+                self.circuit_breaker, self.rate_limiter
+            )
+        )
         if not representation.location:
             raise IOError(
                 "Expected %s to redirect, but couldn't find location." % url
@@ -264,14 +429,14 @@ class OCLCLinkedData(object):
         return Identifier.for_foreign_id(
             self._db, Identifier.OCLC_NUMBER, oclc_number)[0]
 
-    def oclc_works_for_isbn(self, isbn, processed_uris=set()):
+    def oclc_works_for_isbn(self, isbn, context=None):
         """Yield every OCLC Work graph for the given ISBN."""
         # Find the OCLC Number for this ISBN.
         oclc_number = self.oclc_number_for_isbn(isbn)
 
         # Retrieve the OCLC Linked Data document for that OCLC Number.
         oclc_number_data, was_new = self.lookup_by_identifier(
-            oclc_number, processed_uris)
+            oclc_number, context)
         if not oclc_number_data:
             return
 
@@ -286,7 +451,7 @@ class OCLCLinkedData(object):
                     self._db, Identifier.OCLC_WORK, work_id)
 
                 oclc_work_data, cached = self.lookup_by_identifier(
-                    identifier, processed_uris)
+                    identifier, context)
                 yield oclc_work_data
 
     @classmethod
@@ -304,7 +469,7 @@ class OCLCLinkedData(object):
             for creator_uri in ldq.values(
                 ldq.restrict_to_language(values, 'en')
             ):
-                internal_results = cls.internal_lookup(graph, creator_uri)
+                internal_results = cls.internal_lookup(graph, [creator_uri])
                 if internal_results:
                     for obj in internal_results:
                         for fieldname in ('name', 'schema:name'):
@@ -316,18 +481,35 @@ class OCLCLinkedData(object):
 
     @classmethod
     def graph(cls, raw_data):
+        """Parse the graph out of a document returned by get_jsonld().
+
+        Parsed graphs are cached by document URL, so asking for the
+        same document's graph again doesn't parse it again.
+
+        :return: A JSONLDGraph, or None if there's no document.
+        """
         if not raw_data or not raw_data['document']:
             return None
+        url = raw_data.get('documentUrl')
+        cached = cls.graph_cache.get(url) if url else None
+        if cached and cached[0] == raw_data['document']:
+            return cached[1]
+
         try:
             document = json.loads(raw_data['document'])
         except ValueError as e:
             # We couldn't parse this JSON. It's _extremely_ rare from OCLC
             # but it does seem to happen.
-            return dict()
-        if not '@graph' in document:
-            # Empty graph
-            return dict()
-        return document['@graph']
+            graph = JSONLDGraph()
+        else:
+            if isinstance(document, dict) and '@graph' in document:
+                graph = JSONLDGraph(document['@graph'])
+            else:
+                # Empty graph
+                graph = JSONLDGraph()
+        if url:
+            cls.graph_cache.set(url, (raw_data['document'], graph))
+        return graph
 
     @classmethod
     def books(cls, graph):
@@ -610,7 +792,10 @@ class OCLCLinkedData(object):
 
     @classmethod
     def internal_lookup(cls, graph, uris):
-        return [x for x in graph if x['@id'] in uris]
+        """Find the nodes in `graph` whose @id is one of `uris`."""
+        if not isinstance(graph, JSONLDGraph):
+            graph = JSONLDGraph(graph)
+        return graph.lookup(uris)
 
     @classmethod
     def _fix_tag(self, tag):
@@ -623,8 +808,14 @@ class OCLCLinkedData(object):
             return None
         return tag
 
-    def info_for(self, identifier):
-        for data in self.graphs_for(identifier):
+    def info_for(self, identifier, context=None):
+        """Yield a Metadata object for every useful edition OCLC
+        knows about for `identifier`.
+
+        :param context: A LookupContext to share with other lookups in
+            this run.
+        """
+        for data in self.graphs_for(identifier, context):
             subgraph = self.graph(data)
             for book in self.books(subgraph):
                 info = self.book_info_to_metadata(subgraph, book)
@@ -775,26 +966,32 @@ class OCLCLinkedData(object):
         if not graph:
             return []
 
-        contributors_data = []
-        for item in graph:
-            if item['@id'] == person_uri:
-                contributors_data = self.extract_contributor(item)
-                if contributor:
-                    contributors.append(contributor)
+        contributors = []
+        for item in graph.lookup([person_uri]):
+            contributor = self.extract_contributor(item)
+            if contributor:
+                contributors.append(contributor)
         return contributors
 
-    def graphs_for(self, identifier):
+    def graphs_for(self, identifier, context=None):
+        """Yield the documents for the editions of `identifier`.
+
+        :param context: A LookupContext to share with other lookups in
+            this run. If there isn't one, documents are only shared
+            within this call.
+        """
         self.log.debug("BEGIN GRAPHS FOR %r", identifier)
         work_data = None
+        context = context or LookupContext()
 
         if identifier.type in self.CAN_HANDLE:
             if identifier.type == Identifier.ISBN:
-                work_data = list(self.oclc_works_for_isbn(identifier))
+                work_data = list(self.oclc_works_for_isbn(identifier, context))
             elif identifier.type == Identifier.OCLC_WORK:
-                work_data, cached = self.lookup(identifier)
+                work_data, cached = self.lookup(identifier, context)
             else:
                 # Look up and yield a single edition.
-                edition_data, cached = self.lookup(identifier)
+                edition_data, cached = self.lookup(identifier, context)
                 yield edition_data
                 work_data = None
 
@@ -802,6 +999,8 @@ class OCLCLinkedData(object):
                 # We have one or more work graphs.
                 if not isinstance(work_data, list):
                     work_data = [work_data]
+                # Works can share examples. Only yield each one once.
+                seen = set()
                 for data in work_data:
                     # Turn the work graph into a bunch of edition graphs.
                     if not data:
@@ -811,9 +1010,13 @@ class OCLCLinkedData(object):
                     )
                     graph = self.graph(data)
                     examples = self.extract_workexamples(graph)
-                    for uri in examples:
-                        self.log.debug("Found example URI %s", uri)
-                        data, cached = self.lookup(uri)
+                    for data, cached in self.lookup_examples(
+                            examples, context=context
+                    ):
+                        if data:
+                            if data['documentUrl'] in seen:
+                                continue
+                            seen.add(data['documentUrl'])
                         yield data
 
         else:
@@ -826,14 +1029,55 @@ class OCLCLinkedData(object):
                     # high-strength ones.
                     continue
                 if i.output.type in self.CAN_HANDLE:
-                    for graph in self.graphs_for(i.output):
+                    for graph in self.graphs_for(i.output, context):
                         yield graph
         self.log.debug("END GRAPHS FOR %r", identifier)
 
+    def lookup_examples(self, uris, do_get=None, context=None):
+        """Look up the documents for a work's examples.
+
+        The documents that aren't cached are fetched
+        `example_concurrency` at a time, ahead of the lookups that need
+        them. Only the network requests happen in worker threads. The
+        rate limiter and circuit breaker, the lookups themselves, and
+        the Representations they write all stay in this thread.
+
+        :yield: A (document, cached) 2-tuple for each URI, in order.
+        """
+        uris = list(uris)
+        with Prefetcher(
+            self.example_concurrency, self.rate_limiter, self.circuit_breaker
+        ) as prefetcher:
+            for start in range(0, len(uris), self.example_concurrency):
+                window = uris[start:start+self.example_concurrency]
+                urls = []
+                for uri in window:
+                    match = self.URI_WITH_OCLC_NUMBER.search(uri)
+                    if not match:
+                        continue
+                    url = self.BASE_URL % dict(
+                        type="oclc", id=match.groups()[0]
+                    )
+                    if (not (context and url in context)
+                        and not is_cached(self._db, url)):
+                        urls.append(url)
+
+                # These documents will be asked for with no extra
+                # headers, apart from the conditional ones sent for a
+                # copy whose blob was evicted, which the Prefetcher
+                # doesn't hold against them.
+                prefetcher.prefetch(self._fetch(do_get), urls, {})
+                for uri in window:
+                    self.log.debug("Found example URI %s", uri)
+                    yield self.lookup(uri, context, prefetcher)
+
 
 class MockOCLCLinkedData(OCLCLinkedData):    
     def __init__(self, _db):
-        super(MockOCLCLinkedData, self).__init__(_db)
+        super(MockOCLCLinkedData, self).__init__(
+            _db, rate_limiter=MockRateLimiter(),
+            circuit_breaker=MockCircuitBreaker()
+        )
         self._db = _db
         self.log = logging.getLogger("Mocked OCLC Linked Data")
         base_path = os.path.split(__file__)[0]
@@ -858,7 +1102,7 @@ class MockOCLCLinkedData(OCLCLinkedData):
         return oclc_identifier
 
 
-    def oclc_works_for_isbn(self, isbn, processed_uris=set()):
+    def oclc_works_for_isbn(self, isbn, context=None):
         """Empty-yielding stub for: Yield every OCLC Work graph for the given ISBN."""
 
         # assume the calling test code has put a test file-derived graph into the queue
@@ -924,6 +1168,7 @@ class LinkedDataCoverageProvider(ResolveVIAFOnSuccessCoverageProvider):
         Identifier.OCLC_WORK, Identifier.OCLC_NUMBER,
         Identifier.ISBN, Identifier.OVERDRIVE_ID
     ]
+    UPSTREAM_URLS = [OCLCLinkedData.BASE_URL, OCLCLinkedData.WORK_BASE_URL]
     
     def __init__(self, collection, *args, **kwargs):
         _db = Session.object_session(collection)
@@ -936,13 +1181,117 @@ class LinkedDataCoverageProvider(ResolveVIAFOnSuccessCoverageProvider):
         if not viaf:
             viaf = VIAFClient(_db)
         self.viaf = viaf
+        self.closure = EquivalencyClosureIndex(_db)
+
+        # The number of documents to share between the lookups in a
+        # batch.
+        self.lookup_context_size = kwargs.pop(
+            'lookup_context_size', LookupContext.SIZE
+        )
+        self.context = None
+
+        # Set up by process_batch() for the items in a batch.
+        self.oclc_numbers = None
+        self.metadata_client = None
 
         kwargs['registered_only'] = True
         super(LinkedDataCoverageProvider, self).__init__(
             collection, *args, **kwargs
         )
-            
+
+    def process_batch(self, batch):
+        """Process a batch of identifiers, sharing the documents looked
+        up for one with the others.
+
+        The OCLC Numbers equivalent to every ISBN in the batch are found
+        up front, and one AuthorNameCanonicalizer is used for the whole
+        batch.
+        """
+        batch = list(batch)
+        self.context = LookupContext(self.lookup_context_size)
+        try:
+            with QueryCounter(self._db) as counter:
+                self.oclc_numbers = self.equivalent_oclc_numbers(batch)
+                preload_queries = counter.count
+                self.metadata_client = self.canonicalizer()
+                results = super(
+                    LinkedDataCoverageProvider, self
+                ).process_batch(batch)
+        finally:
+            self.oclc_numbers = None
+            self.metadata_client = None
+            context, self.context = self.context, None
+        self.log.info(
+            "Processed %d identifiers: %d queries to find OCLC Numbers, %d in total (%.1f per identifier). Linked data lookups: %s",
+            len(batch), preload_queries, counter.count,
+            counter.count / float(max(len(batch), 1)),
+            context.describe()
+        )
+        return results
+
+    def equivalent_oclc_numbers(self, identifiers):
+        """Find the OCLC Numbers equivalent to each ISBN in a batch, in
+        a fixed number of queries.
+
+        :return: A dictionary mapping the ID of each ISBN to a list of
+            OCLC Number Identifiers.
+        """
+        isbn_ids = [x.id for x in identifiers if x.type == Identifier.ISBN]
+        if not isbn_ids:
+            return dict()
+
+        # This maps each ISBN's ID to a list of equivalent IDs.
+        equivalents = self.closure.equivalent_ids(isbn_ids)
+
+        # The closure may not have caught up with Equivalencies created
+        # elsewhere, such as by Metadata.apply(). For the ISBNs it
+        # hasn't, walk the equivalents table instead.
+        behind = self.closure.behind(equivalents)
+        if behind:
+            equivalents.update(
+                Identifier.recursively_equivalent_identifier_ids(
+                    self._db, sorted(behind)
+                )
+            )
+
+        all_ids = set()
+        for ids in list(equivalents.values()):
+            all_ids.update(ids)
+        oclc_numbers = dict(
+            (x.id, x) for x in self._db.query(Identifier).filter(
+                Identifier.id.in_(all_ids)
+            ).filter(Identifier.type==Identifier.OCLC_NUMBER)
+        )
+        return dict(
+            (isbn_id, [
+                oclc_numbers[x] for x in sorted(equivalents.get(isbn_id, []))
+                if x in oclc_numbers
+            ])
+            for isbn_id in isbn_ids
+        )
+
+    def canonicalizer(self):
+        """The client Metadata.apply() should use to canonicalize
+        author names.
+
+        Usually this is an OPDSImporter that reaches out to the
+        Metadata Wrangler, but in the case of being _on_ the Metadata
+        Wrangler...
+        """
+        if self.metadata_client:
+            return self.metadata_client
+        from canonicalize import AuthorNameCanonicalizer
+        return AuthorNameCanonicalizer(
+            self._db, oclcld=self.api, viaf=self.viaf
+        )
+
     def process_item(self, identifier):
+        with QueryCounter(self._db) as counter:
+            result = self._process_item(identifier)
+        self.log.info("%d queries to process %r", counter.count, identifier)
+        return result
+
+    def _process_item(self, identifier):
         # Books are not looked up in OCLC Linked Data directly, since
         # there is no Collection that identifies a book by its OCLC Number.
         # However, when a book is looked up through OCLC Classify, some
@@ -951,23 +1300,39 @@ class LinkedDataCoverageProvider(ResolveVIAFOnSuccessCoverageProvider):
         try:
             new_info_counter = Counter()
             self.log.info("Processing identifier %r", identifier)
-            metadatas = [m for m in self.api.info_for(identifier)]
+            context = self.context or LookupContext(self.lookup_context_size)
+            metadatas = [m for m in self.api.info_for(identifier, context)]
 
             if identifier.type==Identifier.ISBN:
                 # Currently info_for seeks the results of OCLC Work IDs only
                 # This segment will get the metadata of any equivalent OCLC Numbers
                 # as well.
-                equivalents = Identifier.recursively_equivalent_identifier_ids(
-                    self._db, [identifier.id]
-                )
-                oclc_numbers = self._db.query(Identifier).\
-                    filter(Identifier.id.in_(equivalents)).\
-                    filter(Identifier.type==Identifier.OCLC_NUMBER).all()
-                for oclc_number in oclc_numbers:
-                    more_metadata = [m for m in self.api.info_for(oclc_number)]
+                oclc_numbers = self.oclc_numbers
+                if oclc_numbers is None or identifier.id not in oclc_numbers:
+                    oclc_numbers = self.equivalent_oclc_numbers([identifier])
+                for oclc_number in oclc_numbers[identifier.id]:
+                    more_metadata = [
+                        m for m in self.api.info_for(oclc_number, context)
+                    ]
                     metadatas += more_metadata
                     metadatas = [m for m in metadatas if m]
 
+                # The editions of the ISBN's OCLC Works are often
+                # found again through its OCLC Numbers. Only apply each
+                # edition's metadata once.
+                unique = []
+                seen = set()
+                for metadata in metadatas:
+                    key = (metadata.primary_identifier.type,
+                           metadata.primary_identifier.identifier)
+                    if key not in seen:
+                        seen.add(key)
+                        unique.append(metadata)
+                metadatas = unique
+
+            # When metadata is applied, it must be given a client that can
+            # response to 'canonicalize_author_name'.
+            metadata_client = self.canonicalizer()
             for metadata in metadatas:
                 other_identifier, ignore = metadata.primary_identifier.load(self._db)
                 oclc_editions = other_identifier.primarily_identifies
@@ -988,14 +1353,6 @@ class LinkedDataCoverageProvider(ResolveVIAFOnSuccessCoverageProvider):
                     if c.sort_name or c.display_name
                 ]
 
-                # When metadata is applied, it must be given a client that can
-                # response to 'canonicalize_author_name'. Usually this is an
-                # OPDSImporter that reaches out to the Metadata Wrangler, but
-                # in the case of being _on_ the Metadata Wrangler...:
-                from canonicalize import AuthorNameCanonicalizer
-                metadata_client = AuthorNameCanonicalizer(
-                    self._db, oclcld=self.api, viaf=self.viaf
-                )
 
                 num_new_isbns = self.new_isbns(metadata)
                 new_info_counter['isbns'] += num_new_isbns
@@ -1018,6 +1375,10 @@ class LinkedDataCoverageProvider(ResolveVIAFOnSuccessCoverageProvider):
                     # identifier so we know they're related.
                     self.set_equivalence(identifier, metadata)
 
+                # Applying the metadata may have made the OCLC
+                # identifier equivalent to some ISBNs.
+                self.closure.update([other_identifier])
+
                 self.log.info(
                     "Total: %(editions)d editions, %(isbns)d ISBNs, "\
                     "%(descriptions)d descriptions, %(subjects)d classifications.",
@@ -1111,8 +1472,8 @@ class LinkedDataCoverageProvider(ResolveVIAFOnSuccessCoverageProvider):
             primary_identifier, ignore = metadata.primary_identifier.load(
                 self._db
             )
-            identifier.equivalent_to(
-                self.data_source, primary_identifier, strength
+            self.closure.equivalent_to(
+                identifier, self.data_source, primary_identifier, strength
             )
 
     def calculate_work_for_isbn(self, identifier):
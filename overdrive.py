@@ -104,7 +104,9 @@ class OverdriveBibliographicCoverageProvider(
         qu = qu.join(Identifier.collections).filter(
             Collection.id==self.collection_id
         )
-        return qu
+        # The super() call above skips ScheduledCoverageProvider, so
+        # the queue has to be put in priority order here.
+        return self.apply_schedule(qu)
 
     def metadata_pre_hook(self, metadata):
         """If we happened to get any circulation data, because this item
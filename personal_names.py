@@ -0,0 +1,57 @@
+"""Memoized versions of the name functions in core.util.personal_names.
+
+Matching a contributor against VIAF or OCLC means normalizing and
+comparing the same few names over and over again, so the results are
+kept in bounded LRU caches. Use these functions instead of the
+originals everywhere in the metadata wrangler, so that they all share
+the caches.
+"""
+from core.util import personal_names
+
+from cache import memoize
+
+# The number of results to remember for each function.
+CACHE_SIZE = 10000
+
+contributor_name_match_ratio = memoize(CACHE_SIZE)(
+    personal_names.contributor_name_match_ratio
+)
+display_name_to_sort_name = memoize(CACHE_SIZE)(
+    personal_names.display_name_to_sort_name
+)
+name_tidy = memoize(CACHE_SIZE)(personal_names.name_tidy)
+normalize_contributor_name_for_matching = memoize(CACHE_SIZE)(
+    personal_names.normalize_contributor_name_for_matching
+)
+
+MEMOIZED = [
+    contributor_name_match_ratio,
+    display_name_to_sort_name,
+    name_tidy,
+    normalize_contributor_name_for_matching,
+]
+
+
+def statistics():
+    """How well each cache is doing.
+
+    :return: A dictionary mapping each function's name to a dictionary
+        with its cache's `hits`, `misses`, `hit_rate` and `size`.
+    """
+    return dict(
+        (f.__name__, dict(
+            hits=f.cache.hits, misses=f.cache.misses,
+            hit_rate=f.cache.hit_rate, size=len(f.cache)
+        ))
+        for f in MEMOIZED
+    )
+
+
+def describe_statistics():
+    """Summarize statistics() in a single line, for logging."""
+    return ", ".join(
+        "%s: %d hits, %d misses, %d cached" % (
+            name, stats['hits'], stats['misses'], stats['size']
+        )
+        for name, stats in sorted(statistics().items())
+    )
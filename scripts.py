@@ -5,9 +5,15 @@ import csv
 import datetime
 import os
 import sys
+import time
 import unicodedata
 
-from sqlalchemy.sql import select
+from lxml import etree
+
+from sqlalchemy.sql import (
+    select,
+    text,
+)
 from sqlalchemy.sql.functions import func
 from sqlalchemy.sql.expression import or_
 
@@ -24,6 +30,7 @@ from core.model import (
     Identifier,
     IntegrationClient,
     LicensePool,
+    Representation,
     Timestamp,
     Work,
     get_one,
@@ -40,10 +47,22 @@ from core.scripts import (
     RunMonitorScript,
 )
 from core.util.permanent_work_id import WorkIDCalculator
-from core.util.personal_names import contributor_name_match_ratio
 from core.util.datetime_helpers import utc_now
+from compression import (
+    compress,
+    compressible_representations,
+    decompress,
+    representation_content,
+)
+from equivalency import EquivalencyClosureIndex
 from oclc.linked_data import LinkedDataCoverageProvider
-from viaf import VIAFClient
+from personal_names import contributor_name_match_ratio
+from upstream import RateLimiter
+from viaf import (
+    VIAFClient,
+    VIAFDumpIndex,
+    VIAFParser,
+)
 
 
 class FillInVIAFAuthorNames(Script):
@@ -512,6 +531,8 @@ class RedoOCLC(Explain):
             if e.strength == 0:
                 print("DELETING %r" % e)
             self._db.delete(e)
+        self._db.flush()
+        EquivalencyClosureIndex(self._db).refresh(equivalent_ids)
         t1.commit()
 
         self.coverage.process_item(primary_identifier)
@@ -609,6 +630,26 @@ class DashboardScript(Script):
                 types.add(type)
         self.write("\n Totals:")
         self.report_backlog(None)
+        self.write()
+
+        # How fast have we actually been sending requests to each
+        # upstream service, and how long have we spent waiting our
+        # turn?
+        self.report_upstream_rates()
+
+    def report_upstream_rates(self):
+        title = "Upstream request rates"
+        self.write("=" * len(title))
+        self.write(title)
+        self.write("=" * len(title))
+        for host, requests, per_second, waited in RateLimiter.effective_rates(
+            self._db
+        ):
+            self.write(
+                " %s - %d requests, %.2f/sec, %.1fs spent waiting" % (
+                    host, requests, per_second, waited
+                )
+            )
 
     def report_the_past(self, title, base_qu, field, days=7):
         """Go backwards `days` days into the past and execute a
@@ -703,3 +744,242 @@ class DashboardScript(Script):
             self.report_backlog_item(type, done, not_done)
         return done, not_done
 
+
+
+class RepresentationCompressionBenchmarkScript(Script):
+    """Measure how compressing cached upstream documents affects the
+    speed of writing them to the database and reading them back.
+
+    A random sample of cached documents is written to a temporary
+    table and read back, first as-is and then compressed. Throughput
+    is reported in terms of uncompressed megabytes, so the two are
+    directly comparable.
+    """
+
+    SAMPLE_SIZE = 500
+    TABLE = "representation_compression_benchmark"
+
+    @classmethod
+    def arg_parser(cls):
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            '--sample-size', type=int, default=cls.SAMPLE_SIZE,
+            help='Number of cached documents to benchmark with.'
+        )
+        return parser
+
+    def write(self, s=''):
+        self.out.write(s + "\n")
+
+    def do_run(self, cmd_args=None, output=sys.stdout):
+        self.out = output
+        parsed = self.arg_parser().parse_args(cmd_args)
+
+        qu = compressible_representations(
+            self._db.query(Representation.content)
+        ).order_by(func.random()).limit(parsed.sample_size)
+        sample = [decompress(content) for [content] in qu]
+        if not sample:
+            self.write("No cached upstream documents to benchmark with.")
+            return
+
+        size = sum(len(x) for x in sample)
+        self.write("%d documents, %.2f MB uncompressed" % (
+            len(sample), size / 1024.0 / 1024)
+        )
+        for name, compressed in (("Before", False), ("After", True)):
+            stored, write_seconds, read_seconds = self.benchmark(
+                sample, compressed
+            )
+            self.write(
+                "%s: %.2f MB stored, write %.2f MB/sec, read %.2f MB/sec" % (
+                    name, stored / 1024.0 / 1024,
+                    self.throughput(size, write_seconds),
+                    self.throughput(size, read_seconds),
+                )
+            )
+
+    @classmethod
+    def throughput(cls, size, seconds):
+        """Megabytes per second, guarding against a clock too coarse to
+        measure the operation.
+        """
+        return size / 1024.0 / 1024 / max(seconds, 0.000001)
+
+    def benchmark(self, sample, compressed):
+        """Write `sample` to a temporary table and read it back.
+
+        :param compressed: Compress each document before writing it,
+            and decompress it after reading it.
+        :return: A 3-tuple (bytes stored, seconds spent writing,
+            seconds spent reading).
+        """
+        self._db.execute(text(
+            "create temporary table %s (id serial primary key, content bytea)"
+            % self.TABLE
+        ))
+        insert = text("insert into %s (content) values (:content)" % self.TABLE)
+
+        start = time.time()
+        rows = sample
+        if compressed:
+            rows = [compress(x) for x in sample]
+        for content in rows:
+            self._db.execute(insert, dict(content=content))
+        write_seconds = time.time() - start
+
+        start = time.time()
+        contents = [
+            content for [content] in self._db.execute(
+                text("select content from %s" % self.TABLE)
+            )
+        ]
+        if compressed:
+            contents = [decompress(bytes(x)) for x in contents]
+        read_seconds = time.time() - start
+
+        self._db.execute(text("drop table %s" % self.TABLE))
+        return sum(len(x) for x in rows), write_seconds, read_seconds
+
+
+class VIAFSummaryBenchmarkScript(Script):
+    """Measure how long it takes to summarize VIAF clusters in a single
+    pass (VIAFParser.summarize), compared to picking out one field at a
+    time with a separate XPath query for each.
+
+    The clusters come from XML files named on the command line, such
+    as the ones in tests/files/viaf, or else from a random sample of
+    cached VIAF documents.
+    """
+
+    SAMPLE_SIZE = 100
+    REPEAT = 10
+
+    @classmethod
+    def arg_parser(cls):
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            'paths', nargs='*',
+            help='VIAF XML files to benchmark with.'
+        )
+        parser.add_argument(
+            '--sample-size', type=int, default=cls.SAMPLE_SIZE,
+            help='Number of cached VIAF documents to benchmark with, if no files are named.'
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=cls.REPEAT,
+            help='Number of times to summarize each cluster.'
+        )
+        return parser
+
+    def write(self, s=''):
+        self.out.write(s + "\n")
+
+    def do_run(self, cmd_args=None, output=sys.stdout):
+        self.out = output
+        parsed = self.arg_parser().parse_args(cmd_args)
+        self.parser = VIAFParser()
+
+        clusters = []
+        for document in self.documents(parsed.paths, parsed.sample_size):
+            tree = etree.fromstring(
+                document, parser=etree.XMLParser(recover=True)
+            )
+            if tree is not None:
+                clusters.extend(self.parser.CLUSTERS(tree) or [tree])
+        if not clusters:
+            self.write("No VIAF clusters to benchmark with.")
+            return
+
+        disagreements = [
+            x for x in clusters
+            if self.parser.summarize(x).__dict__ != self.field_by_field(x)
+        ]
+        self.write("%d clusters, %d summarized differently" % (
+            len(clusters), len(disagreements))
+        )
+        for name, summarize in (
+            ("Field by field", self.field_by_field),
+            ("Single pass", self.parser.summarize),
+        ):
+            start = time.time()
+            for i in range(parsed.repeat):
+                for cluster in clusters:
+                    summarize(cluster)
+            seconds = (time.time() - start) / parsed.repeat
+            self.write("%s: %.1f ms per pass over every cluster" % (
+                name, seconds * 1000)
+            )
+
+    def documents(self, paths, sample_size):
+        """The XML documents to take clusters from."""
+        if paths:
+            for path in paths:
+                with open(path, 'rb') as f:
+                    yield f.read()
+            return
+        qu = self._db.query(Representation).filter(
+            Representation.url.like('http://viaf.org/viaf/%')
+        ).filter(
+            Representation.content != None
+        ).order_by(func.random()).limit(sample_size)
+        for representation in qu:
+            content = representation_content(representation)
+            if content:
+                yield content
+
+    def field_by_field(self, cluster):
+        """Extract what VIAFParser.summarize does, one field at a time.
+
+        :return: A dictionary like a VIAFClusterSummary's __dict__.
+        """
+        parser = self.parser
+        viaf_tag = parser._xpath1(cluster, './/*[local-name()="viafID"]')
+        unimarcs = parser._xpath(
+            cluster, './/*[local-name()="datafield"][@dtype="UNIMARC"]'
+        )
+        titles = parser._xpath(
+            cluster, './/*[local-name()="titles"]/*[local-name()="work"]/*[local-name()="title"]'
+        )
+        return dict(
+            viaf=viaf_tag.text if viaf_tag is not None else None,
+            wikipedia_name=parser.extract_wikipedia_name(cluster),
+            sort_names=list(parser.sort_names_for_cluster(cluster)),
+            name_titles=list(parser.name_titles_for_cluster(cluster)),
+            alternate_names=list(
+                parser.alternate_name_forms_for_cluster(cluster)
+            ),
+            unimarc_names=[
+                parser.extract_name_from_unimarc(x) for x in unimarcs
+            ],
+            titles=[x.text for x in titles],
+        )
+
+
+class VIAFDumpIndexScript(Script):
+    """Build a local index of VIAF clusters from the data dumps VIAF
+    publishes, so that VIAF lookups can be answered without going to
+    the network.
+
+    Put the gzipped dumps in the VIAF subdirectory of a data directory.
+    An interrupted load can be resumed by running the script again.
+    """
+
+    @classmethod
+    def arg_parser(cls):
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            'data_directory',
+            help='Directory whose %s subdirectory holds the dumps.'
+            % VIAFDumpIndex.SUBDIR
+        )
+        return parser
+
+    def do_run(self, cmd_args=None, output=sys.stdout):
+        parsed = self.arg_parser().parse_args(cmd_args)
+        index = VIAFDumpIndex.from_data_directory(parsed.data_directory)
+        output.write(
+            "Set %s=%s to use the index.\n" % (
+                VIAFDumpIndex.PATH_VARIABLE, os.path.abspath(index.path)
+            )
+        )
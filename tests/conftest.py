@@ -1,3 +1,15 @@
+import pytest
+
+import upstream
+
 # Pull in the session_fixture defined in core/testing.py
 # which does the database setup and initialization
 pytest_plugins = ["core.testing"]
+
+
+@pytest.fixture(autouse=True)
+def upstream_state_in_test_transaction(monkeypatch):
+    """Keep the shared rate limiter and circuit breaker state in each
+    test's transaction, so it's rolled back with everything else.
+    """
+    monkeypatch.setattr(upstream, 'IN_CALLER_TRANSACTION', True)
@@ -1,6 +1,8 @@
 # encoding: utf-8
 
 import json
+import threading
+
 from .. import (
     DatabaseTest,
     sample_data
@@ -11,9 +13,14 @@ from core.model import Contributor, Identifier, Measurement
 from core.metadata_layer import *
 from oclc.classify import (
     IdentifierLookupCoverageProvider,
+    OCLCClassifyAPI,
     OCLCClassifyXMLParser,
     MockOCLCClassifyAPI,
 )
+from upstream import (
+    MockCircuitBreaker,
+    MockRateLimiter,
+)
 
 class MockParser(OCLCClassifyXMLParser):
     def __init__(self):
@@ -213,6 +220,77 @@ class TestIdentifierLookupCoverageProvider(DatabaseTest):
         assert result.primary_identifier.identifier == self.MULTI_ISBN
         assert isinstance(result.primary_identifier, Identifier)
 
+    def test__multiple_uses_owi_cache(self):
+        api = MockOCLCClassifyAPI(self._db)
+        for filename in (
+            'single_work_48446512.xml',
+            'single_work_48525129.xml',
+        ):
+            api.queue_response(sample_data(filename, "oclc_classify"))
+        provider = IdentifierLookupCoverageProvider(
+            self._default_collection, api=api, owi_concurrency=2
+        )
+        # The provider's concurrency doesn't change the API's.
+        assert 2 == provider.owi_concurrency
+        assert OCLCClassifyAPI.CONCURRENCY == api.concurrency
+        tree = self._tree("multi")
+        code, owi_data = provider.parser.initial_look_up(tree)
+
+        # The first ISBN's OWIs have to be looked up.
+        first = provider._multiple(owi_data, self._blank_metadata(self._id("multi")))
+        assert 2 == len(api.requests)
+        assert 0 == provider.owi_cache.hits
+
+        # Another ISBN that belongs to the same works gets the same
+        # information without any more lookups.
+        other = self._identifier(Identifier.ISBN, "9780345391834")
+        second = provider._multiple(owi_data, self._blank_metadata(other))
+        assert 2 == len(api.requests)
+        assert 0.5 == provider.owi_cache.hit_rate
+        assert (
+            sorted(x.identifier for x in first.subjects) ==
+            sorted(x.identifier for x in second.subjects)
+        )
+        assert other == second.primary_identifier
+
+    def test_prefetch(self):
+        api = OCLCClassifyAPI(
+            self._db, rate_limiter=MockRateLimiter(),
+            circuit_breaker=MockCircuitBreaker(), concurrency=2
+        )
+        content = sample_data('single_work_48446512.xml', "oclc_classify")
+        requests = []
+        threads = set()
+        def do_get(url, *args, **kwargs):
+            requests.append(url)
+            threads.add(threading.current_thread())
+            return 200, {"content-type": "text/xml"}, content
+
+        owis = ["48446512", "48525129", "1000"]
+        urls = [api.url_for(owi=x) for x in owis]
+
+        # One of the documents is already cached.
+        with api.prefetch(urls[:1], do_get) as prefetcher:
+            assert content == api.lookup_by(
+                prefetcher=prefetcher, owi=owis[0]
+            )
+        del requests[:]
+        del api.rate_limiter.requests[:]
+        threads.clear()
+
+        # The others are fetched ahead of time, by worker threads, but
+        # the rate limiter is consulted in this thread.
+        with api.prefetch(urls, do_get) as prefetcher:
+            assert urls[1:] == api.rate_limiter.requests
+
+            # Looking them up doesn't fetch them again.
+            for owi in owis:
+                assert content == api.lookup_by(
+                    prefetcher=prefetcher, owi=owi
+                )
+        assert sorted(urls[1:]) == sorted(requests)
+        assert threading.current_thread() not in threads
+
     def test__single_with_real_parser(self):
         # Testing that calling _single actually returns the correct metadata object.
         provider = IdentifierLookupCoverageProvider(self._default_collection)
@@ -1,6 +1,10 @@
 # encoding: utf-8
 
 import json
+import threading
+
+import pytest
+from pyld import jsonld
 
 from core.model import (
     Contributor,
@@ -8,6 +12,7 @@ from core.model import (
     Equivalency,
     Identifier,
     LicensePool,
+    Representation,
     Subject,
 )
 from core.metadata_layer import (
@@ -18,14 +23,22 @@ from core.metadata_layer import (
 from core.coverage import CoverageFailure
 
 from oclc.linked_data import (
+    JSONLDGraph,
+    LookupContext,
     OCLCLinkedData,
     LinkedDataCoverageProvider,
 )
 
+from blobstore import BlobStore
+from coverage_utils import QueryCounter
 from testing import (
     MockOCLCLinkedDataAPI,
     MockVIAFClient,
 )
+from upstream import (
+    MockCircuitBreaker,
+    MockRateLimiter,
+)
 
 from .. import (
     DatabaseTest,
@@ -157,6 +170,214 @@ class TestOCLCLinkedData(DatabaseTest):
         assert None == metadata_obj.title
 
 
+    def test_jsonld_graph(self):
+        graph = JSONLDGraph([
+            {"@id": "a", "name": "first"},
+            {"@id": "b"},
+            {"@id": "a", "name": "second"},
+            {"name": "no id"},
+        ])
+        assert 4 == len(graph)
+        assert ["first", "second"] == [
+            x["name"] for x in graph.lookup(["a"])
+        ]
+        # Nodes come back in graph order, whatever order they were
+        # asked for in.
+        assert ["a", "b", "a"] == [x["@id"] for x in graph.lookup(["b", "a"])]
+        assert [] == graph.lookup(["c"])
+
+        # internal_lookup works on plain lists too.
+        assert [{"@id": "b"}] == OCLCLinkedData.internal_lookup(
+            list(graph), ["b"]
+        )
+
+    def test_graph(self):
+        content = self.sample_data("galapagos.jsonld").decode("utf8")
+        url = "http://www.worldcat.org/oclc/6.jsonld"
+        doc = dict(contextUrl=None, documentUrl=url, document=content)
+        graph = OCLCLinkedData.graph(doc)
+        assert isinstance(graph, JSONLDGraph)
+        assert json.loads(content)['@graph'] == list(graph)
+        node = graph[0]
+        assert [node] == graph.lookup([node['@id']])
+
+        # The same document is only parsed once.
+        assert graph is OCLCLinkedData.graph(dict(doc))
+
+        # But if the document at that URL changes, it's parsed again.
+        changed = dict(doc, document=json.dumps({"@graph": [node]}))
+        assert [node] == OCLCLinkedData.graph(changed)
+
+        # Documents that aren't graphs come out as empty graphs.
+        for document in ('{"@context": {}}', '[]', '{"not json'):
+            graph = OCLCLinkedData.graph(dict(doc, document=document))
+            assert isinstance(graph, JSONLDGraph)
+            assert [] == graph
+        assert None == OCLCLinkedData.graph(None)
+        assert None == OCLCLinkedData.graph(dict(doc, document=None))
+
+    def test_get_jsonld(self):
+        oclc = OCLCLinkedData(
+            self._db, rate_limiter=MockRateLimiter(),
+            circuit_breaker=MockCircuitBreaker()
+        )
+        content = self.sample_data("galapagos.jsonld")
+        requests = []
+        def do_get(url, *args, **kwargs):
+            requests.append(url)
+            return 200, {"content-type": "application/ld+json"}, content
+
+        # The first lookup fetches the document, once.
+        url = "http://www.worldcat.org/oclc/4.jsonld"
+        doc, cached = oclc.get_jsonld(url, do_get)
+        assert False == cached
+        assert [url] == requests
+        assert url == doc['documentUrl']
+        assert content.decode("utf8") == doc['document']
+
+        # The second lookup doesn't touch the network.
+        doc, cached = oclc.get_jsonld(url, do_get)
+        assert True == cached
+        assert [url] == requests
+
+        # Neither does PyLD, when it's given our document loader.
+        load = oclc.document_loader(do_get)
+        assert doc == load(url)
+        assert [url] == requests
+        [expanded] = jsonld.expand(
+            {"@context": url, "@type": "schema:Book"},
+            dict(documentLoader=load)
+        )
+        assert ["http://schema.org/Book"] == expanded["@type"]
+        assert [url] == requests
+
+        # A document that can't be retrieved is a PyLD error.
+        def failure(url, *args, **kwargs):
+            raise IOError("Connection refused")
+        assert (None, False) == oclc.get_jsonld(
+            "http://www.worldcat.org/oclc/5.jsonld", failure
+        )
+        with pytest.raises(jsonld.JsonLdError):
+            oclc.document_loader(failure)(
+                "http://www.worldcat.org/oclc/5.jsonld"
+            )
+
+
+    def test_lookup_examples(self):
+        oclc = OCLCLinkedData(
+            self._db, rate_limiter=MockRateLimiter(),
+            circuit_breaker=MockCircuitBreaker(), example_concurrency=2
+        )
+        content = self.sample_data("galapagos.jsonld")
+        requests = []
+        threads = set()
+        def do_get(url, *args, **kwargs):
+            requests.append(url)
+            threads.add(threading.current_thread())
+            return 200, {"content-type": "application/ld+json"}, content
+
+        ids = ["90001", "90002", "90003", "90004", "90005"]
+        uris = ["http://www.worldcat.org/oclc/%s" % x for x in ids]
+        urls = [oclc.BASE_URL % dict(type="oclc", id=x) for x in ids]
+
+        # One of the documents is already cached.
+        oclc.get_jsonld(urls[2], do_get)
+        del requests[:]
+        threads.clear()
+
+        # The documents come back in the order of the examples.
+        results = list(oclc.lookup_examples(uris, do_get))
+        assert urls == [doc['documentUrl'] for doc, cached in results]
+        assert [False, False, True, False, False] == [
+            cached for doc, cached in results
+        ]
+
+        # Each document that wasn't cached was fetched once, by a
+        # worker thread.
+        assert sorted(urls[:2] + urls[3:]) == sorted(requests)
+        assert threading.current_thread() not in threads
+
+        # The rate limiter was consulted for each of them, in this
+        # thread, before it was sent off.
+        assert sorted(requests) == sorted(oclc.rate_limiter.requests)
+
+    def test_lookup_examples_evicted_document_is_fetched_once(self):
+        oclc = OCLCLinkedData(
+            self._db, rate_limiter=MockRateLimiter(),
+            circuit_breaker=MockCircuitBreaker()
+        )
+        content = self.sample_data("galapagos.jsonld")
+        requests = []
+        def do_get(url, *args, **kwargs):
+            requests.append((url, args))
+            return 200, {"content-type": "application/ld+json"}, content
+
+        # A document was cached, but its blob has since been evicted
+        # from the blob store.
+        uri = "http://www.worldcat.org/oclc/90001"
+        url = oclc.BASE_URL % dict(type="oclc", id="90001")
+        oclc.get_jsonld(url, do_get)
+        representation = self._db.query(Representation).filter(
+            Representation.url==url
+        ).one()
+        representation.content = BlobStore.reference("0" * 64)
+        representation.etag = '"1"'
+        del requests[:]
+        del oclc.rate_limiter.requests[:]
+
+        # It's prefetched, then asked for again -- probably with
+        # headers that ask whether it's changed. The prefetched
+        # response is used, so only one request goes upstream, and
+        # only one rate-limiting token is taken.
+        [(doc, cached)] = list(oclc.lookup_examples([uri], do_get))
+        assert url == doc['documentUrl']
+        assert [(url, ({},))] == requests
+        assert [url] == oclc.rate_limiter.requests
+
+    def test_lookup_context(self):
+        oclc = OCLCLinkedData(
+            self._db, rate_limiter=MockRateLimiter(),
+            circuit_breaker=MockCircuitBreaker()
+        )
+        content = self.sample_data("galapagos.jsonld")
+        def do_get(url, *args, **kwargs):
+            return 200, {"content-type": "application/ld+json"}, content
+
+        identifiers = [
+            self._identifier(Identifier.OCLC_NUMBER, foreign_id=x)
+            for x in ("80001", "80002")
+        ]
+        for identifier in identifiers:
+            oclc.get_jsonld(oclc.document_url(identifier), do_get)
+
+        # The first lookup goes to the Representation cache, and the
+        # document is remembered in the context.
+        context = LookupContext(1)
+        doc, cached = oclc.lookup_by_identifier(identifiers[0], context)
+        assert True == cached
+        assert doc == context.get(oclc.document_url(identifiers[0]))
+
+        # A second lookup in the same context -- even for a different
+        # identifier -- doesn't even need that.
+        assert (doc, True) == oclc.lookup(
+            "http://www.worldcat.org/oclc/80001", context
+        )
+        assert 2 == context.documents.hits
+
+        # The context is bounded, so the oldest document is forgotten
+        # to make room for a new one.
+        oclc.lookup_by_identifier(identifiers[1], context)
+        assert oclc.document_url(identifiers[0]) not in context
+        assert oclc.document_url(identifiers[1]) in context
+        assert 0.5 == context.hit_rate
+        assert "2 hits, 2 misses, 1 documents held" == context.describe()
+
+        # Without a context, nothing is remembered and nothing is
+        # skipped.
+        assert (doc, True) == oclc.lookup_by_identifier(identifiers[0])
+        assert (doc, True) == oclc.lookup_by_identifier(identifiers[0])
+
+
 class TestLinkedDataCoverageProvider(DatabaseTest):
 
     def setup_method(self):
@@ -216,9 +437,76 @@ class TestLinkedDataCoverageProvider(DatabaseTest):
         assert [i2] == [x.output for x in equivalencies]
         assert [1] == [x.strength for x in equivalencies]
 
+    def test_process_batch_shares_lookup_context(self):
+        class RecordingOCLCLinkedData(OCLCLinkedData):
+            contexts = []
+            canonicalizers = []
+            def info_for(self, identifier, context=None):
+                self.contexts.append(context)
+                self.canonicalizers.append(provider.canonicalizer())
+                return []
+
+        api = RecordingOCLCLinkedData(self._db)
+        provider = LinkedDataCoverageProvider(
+            self._default_collection, api=api, viaf=MockVIAFClient(),
+            lookup_context_size=5
+        )
+        identifiers = [self._identifier(), self._identifier()]
+        provider.process_batch(identifiers)
+
+        # Every item in the batch was looked up in the same context,
+        # and used the same canonicalizer.
+        [first, second] = api.contexts
+        assert first is second
+        assert 5 == first.documents.capacity
+        assert None == provider.context
+        [first, second] = api.canonicalizers
+        assert first is second
+        assert None == provider.metadata_client
+
+        # An item processed on its own gets a context of its own.
+        provider.process_item(identifiers[0])
+        assert isinstance(api.contexts[-1], LookupContext)
+        assert api.contexts[-1] is not first
+
+    def test_equivalent_oclc_numbers(self):
+        source = self.provider.data_source
+        isbns = [
+            self._identifier(identifier_type=Identifier.ISBN)
+            for i in range(3)
+        ]
+        numbers = [
+            self._identifier(identifier_type=Identifier.OCLC_NUMBER)
+            for i in range(3)
+        ]
+        work_id = self._identifier(identifier_type=Identifier.OCLC_WORK)
+        isbns[0].equivalent_to(source, numbers[0], 1)
+        isbns[0].equivalent_to(source, work_id, 1)
+        isbns[1].equivalent_to(source, numbers[1], 1)
+        # Equivalents of equivalents count, too.
+        numbers[1].equivalent_to(source, numbers[2], 1)
+        other = self._identifier()
+        self._db.commit()
+
+        with QueryCounter(self._db) as counter:
+            result = self.provider.equivalent_oclc_numbers(isbns + [other])
+        assert {
+            isbns[0].id: [numbers[0]],
+            isbns[1].id: sorted(numbers[1:], key=lambda x: x.id),
+            isbns[2].id: [],
+        } == result
+
+        # The number of queries doesn't depend on the number of ISBNs.
+        with QueryCounter(self._db) as counter2:
+            self.provider.equivalent_oclc_numbers(isbns[:1])
+        assert counter.count == counter2.count
+
+        # If there are no ISBNs, there's nothing to look up.
+        assert {} == self.provider.equivalent_oclc_numbers([other])
+
     def test_process_item_exception(self):
         class DoomedOCLCLinkedData(OCLCLinkedData):
-            def info_for(self, identifier):
+            def info_for(self, identifier, context=None):
                 raise IOError("Exception!")
 
         provider = LinkedDataCoverageProvider(
@@ -234,7 +522,7 @@ class TestLinkedDataCoverageProvider(DatabaseTest):
 
     def test_process_item_exception_missing_isbn(self):
         class DoomedOCLCLinkedData(OCLCLinkedData):
-            def info_for(self, identifier):
+            def info_for(self, identifier, context=None):
                 raise IOError("Tried, but couldn't find location")
 
         provider = LinkedDataCoverageProvider(
@@ -313,6 +601,39 @@ class TestLinkedDataCoverageProvider(DatabaseTest):
         # Instead, that result is still in the mock VIAF queue.
         assert viaf.results == ["Unrequested lookup"]
 
+    def test_process_item_applies_each_edition_once(self):
+        oclc = MockOCLCLinkedDataAPI()
+        provider = LinkedDataCoverageProvider(
+            self._default_collection, api=oclc, viaf=MockVIAFClient()
+        )
+        isbn = self._identifier(identifier_type=Identifier.ISBN)
+        number = self._identifier(identifier_type=Identifier.OCLC_NUMBER)
+        provider.oclc_numbers = {isbn.id: [number]}
+
+        # The same edition turns up through the ISBN's OCLC Work and
+        # again through its OCLC Number.
+        edition = self._identifier(identifier_type=Identifier.OCLC_NUMBER)
+        def metadata():
+            return Metadata(
+                DataSource.OCLC_LINKED_DATA, title="foo",
+                primary_identifier=IdentifierData(
+                    type=edition.type, identifier=edition.identifier
+                )
+            )
+        oclc.queue_info_for(metadata())
+        oclc.queue_info_for(metadata())
+
+        applied = []
+        original = provider.apply_metadata_to_edition
+        def apply_metadata_to_edition(edition, metadata, *args):
+            applied.append(metadata)
+            return original(edition, metadata, *args)
+        provider.apply_metadata_to_edition = apply_metadata_to_edition
+
+        assert isbn == provider.process_item(isbn)
+        assert 1 == len(applied)
+        assert [] == oclc.info_results
+
     def test_calculate_work_for_isbn(self):
         identifier = self._identifier()
 
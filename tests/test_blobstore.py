@@ -0,0 +1,130 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+from blobstore import (
+    REFERENCE_MARKER,
+    BlobStore,
+)
+
+
+class TestBlobStore(object):
+
+    def setup_method(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = BlobStore(self.directory, 1000)
+
+    def teardown_method(self):
+        shutil.rmtree(self.directory)
+
+    def test_put_and_get(self):
+        content = b"<searchRetrieveResponse><numberOfRecords>0</numberOfRecords></searchRetrieveResponse>"
+        digest = self.store.put(content)
+        assert hashlib.sha256(content).hexdigest() == digest
+
+        # The blob is sharded by the first bytes of its digest.
+        path = os.path.join(self.directory, digest[:2], digest[2:4], digest)
+        assert path == self.store.path(digest)
+        assert True == os.path.exists(path)
+        assert content == self.store.get(digest)
+
+        # Putting the same content again doesn't store another copy.
+        assert digest == self.store.put(content)
+        assert [path] == [p for t, s, p in self.store.blobs()]
+
+        # Empty content can be stored and read back.
+        assert b"" == self.store.get(self.store.put(b""))
+
+        # A blob that isn't there can't be read.
+        assert None == self.store.get("0" * 64)
+
+    def test_references(self):
+        content = b"<cluster/>"
+        reference = self.store.store(content)
+        assert reference.startswith(REFERENCE_MARKER)
+        assert True == BlobStore.is_reference(reference)
+        assert content == self.store.resolve(reference)
+
+        # Anything that isn't a reference is passed through.
+        assert False == BlobStore.is_reference(content)
+        assert content == self.store.resolve(content)
+        assert None == self.store.resolve(None)
+
+        # A reference to an evicted blob resolves to None.
+        assert True == self.store.contains(reference)
+        os.remove(self.store.path(self.store.digest(content)))
+        assert False == self.store.contains(reference)
+        assert None == self.store.resolve(reference)
+
+    def test_evict(self):
+        # The store is under budget, so nothing is evicted.
+        digests = [self.store.put(bytes([i]) * 300) for i in range(3)]
+        assert (0, 0) == self.store.evict()
+
+        # Make the blobs look like they were last used in order.
+        for i, digest in enumerate(digests):
+            os.utime(self.store.path(digest), (i, i))
+
+        # Reading a blob marks it as recently used.
+        self.store.get(digests[0])
+
+        # Adding another blob puts the store over budget. The least
+        # recently used blobs are deleted until the store is down to
+        # 90% of its budget.
+        self.store.EVICTION_INTERVAL = 100
+        new = self.store.put(b"x" * 300)
+        assert (1, 300) == self.store.evict()
+        assert None == self.store.get(digests[1])
+        assert b"\x02" * 300 == self.store.get(digests[2])
+        assert b"\x00" * 300 == self.store.get(digests[0])
+        assert b"x" * 300 == self.store.get(new)
+
+    def test_evict_ignores_blobs_being_written(self):
+        digest = self.store.put(b"a" * 600)
+        os.utime(self.store.path(digest), (0, 0))
+
+        # Another process is partway through writing a blob.
+        shard = os.path.dirname(self.store.path(digest))
+        temporary = os.path.join(shard, BlobStore.TEMPORARY_PREFIX + "xyz")
+        with open(temporary, 'wb') as out:
+            out.write(b"b" * 600)
+
+        # It isn't counted as a blob, and it isn't evicted out from
+        # under the other process.
+        assert [self.store.path(digest)] == [p for t, s, p in self.store.blobs()]
+        assert (0, 0) == self.store.evict()
+        assert True == os.path.exists(temporary)
+
+    def test_put_evicts_periodically(self):
+        self.store.EVICTION_INTERVAL = 0.4
+        first = self.store.put(b"a" * 400)
+        os.utime(self.store.path(first), (0, 0))
+        second = self.store.put(b"b" * 400)
+        os.utime(self.store.path(second), (1, 1))
+
+        # Every write of 400 bytes makes the store check its size.
+        # This one puts it over budget, so it evicts the least
+        # recently used blob.
+        self.store.put(b"c" * 400)
+        assert None == self.store.get(first)
+        assert b"b" * 400 == self.store.get(second)
+
+    def test_default(self):
+        old = os.environ.pop(BlobStore.DIRECTORY_VARIABLE, None)
+        try:
+            assert None == BlobStore.default()
+
+            os.environ[BlobStore.DIRECTORY_VARIABLE] = self.directory
+            os.environ[BlobStore.BUDGET_VARIABLE] = "5"
+            store = BlobStore.default()
+            assert self.directory == store.directory
+            assert 5 * 1024 * 1024 == store.budget
+            assert store == BlobStore.default()
+        finally:
+            os.environ.pop(BlobStore.BUDGET_VARIABLE, None)
+            if old:
+                os.environ[BlobStore.DIRECTORY_VARIABLE] = old
+            else:
+                os.environ.pop(BlobStore.DIRECTORY_VARIABLE, None)
+            BlobStore._default = None
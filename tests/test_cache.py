@@ -0,0 +1,87 @@
+import datetime
+
+from cache import (
+    LRUCache,
+    memoize,
+)
+
+
+class TestLRUCache(object):
+
+    def test_capacity(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert 1 == cache.get("a")
+
+        # "b" is now the least recently used item, so it's the one
+        # that gets thrown out to make room.
+        cache.set("c", 3)
+        assert 2 == len(cache)
+        assert None == cache.get("b")
+        assert "default" == cache.get("b", "default")
+        assert 1 == cache.get("a")
+        assert 3 == cache.get("c")
+
+        # Hits and misses are counted.
+        assert 3 == cache.hits
+        assert 2 == cache.misses
+        assert 3/5.0 == cache.hit_rate
+
+        cache.clear()
+        assert 0 == len(cache)
+
+    def test_max_age(self):
+        now = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        clock = [now]
+        cache = LRUCache(
+            10, max_age=datetime.timedelta(hours=1), clock=lambda: clock[0]
+        )
+        cache.set("a", 1)
+
+        # This value was obtained a while ago, so it'll go stale
+        # sooner.
+        cache.set("b", 2, timestamp=now - datetime.timedelta(minutes=50))
+        assert "a" in cache
+        assert "b" in cache
+
+        clock[0] = now + datetime.timedelta(minutes=30)
+        assert 1 == cache.get("a")
+        assert None == cache.get("b")
+        assert 1 == len(cache)
+
+        clock[0] = now + datetime.timedelta(hours=2)
+        assert "a" not in cache
+        assert 0 == len(cache)
+
+
+class TestMemoize(object):
+
+    def test_memoize(self):
+        calls = []
+        @memoize(2)
+        def shout(name, punctuation="!"):
+            calls.append(name)
+            return None if name == "nobody" else name.upper() + punctuation
+
+        assert "JANE!" == shout("jane")
+        assert "JANE!" == shout("jane")
+        assert ["jane"] == calls
+        assert 1 == shout.cache.hits
+        assert 1 == shout.cache.misses
+        assert 0.5 == shout.cache.hit_rate
+
+        # Keyword arguments are part of the key.
+        assert "JANE?" == shout("jane", punctuation="?")
+        assert ["jane", "jane"] == calls
+
+        # None is remembered like any other value.
+        assert None == shout("nobody")
+        assert None == shout("nobody")
+        assert ["jane", "jane", "nobody"] == calls
+
+        # The cache is bounded.
+        assert 2 == len(shout.cache)
+        assert "JANE!" == shout("jane")
+        assert ["jane", "jane", "nobody", "jane"] == calls
+        assert shout.__name__ == "shout"
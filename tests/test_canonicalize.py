@@ -7,14 +7,20 @@ from . import (
 )
 
 from core.metadata_layer import ContributorData
-from core.model import DataSource
+from core.model import (
+    Contributor,
+    DataSource,
+)
 
 from .test_viaf import MockVIAFClientLookup
 
 from canonicalize import (
     AuthorNameCanonicalizer,
+    AuthorityIndex,
     CanonicalizationError,
+    TitleScorer,
 )
+from model import AuthorityName
 
 
 class TestAuthorNameCanonicalizer(DatabaseTest):
@@ -175,6 +181,7 @@ class TestAuthorNameCanonicalizer(DatabaseTest):
                 raise Exception("boom!")
 
             sort_name_from_database = explode
+            sort_name_from_authority_index = explode
             sort_name_from_oclc_linked_data = explode
             sort_name_from_viaf_urls = explode
             sort_name_from_viaf = explode
@@ -212,6 +219,7 @@ class TestAuthorNameCanonicalizer(DatabaseTest):
                 # service when another fails to get results.
                 self.return_values = dict(
                     sort_name_from_database="good value from database",
+                    sort_name_from_authority_index="good value from authority index",
                     sort_name_from_oclc_linked_data="good value from OCLC",
                     sort_name_from_viaf_urls="good value from VIAF URLs",
                     sort_name_from_viaf_display_name="good value from VIAF display name",
@@ -223,6 +231,11 @@ class TestAuthorNameCanonicalizer(DatabaseTest):
                 self.calls.append((m, display_name, identifier))
                 return self.return_values.get(m), self.titles_from_database
 
+            def sort_name_from_authority_index(self, display_name, known_titles):
+                m = "sort_name_from_authority_index"
+                self.calls.append((m, display_name, known_titles))
+                return self.return_values.get(m)
+
             def sort_name_from_oclc_linked_data(self, display_name, identifier):
                 m = "sort_name_from_oclc_linked_data"
                 self.calls.append((m, display_name, identifier))
@@ -248,6 +261,9 @@ class TestAuthorNameCanonicalizer(DatabaseTest):
         assert "good value from database" == m(*args)
 
         del c.return_values['sort_name_from_database']
+        assert "good value from authority index" == m(*args)
+
+        del c.return_values['sort_name_from_authority_index']
         assert "good value from OCLC" == m(*args)
 
         del c.return_values['sort_name_from_oclc_linked_data']
@@ -269,12 +285,17 @@ class TestAuthorNameCanonicalizer(DatabaseTest):
         assert None == m(*args)
 
         # Let's see the journey we took on the way to this failure.
-        (from_database, from_oclc, from_viaf_urls,
+        (from_database, from_authority_index, from_oclc, from_viaf_urls,
             from_viaf_display_name) = c.calls
 
         # We passed the name and identifier into sort_name_from_database.
         assert ('sort_name_from_database', 'Jim Davis', 'An ISBN') == from_database
 
+        # We checked the local authority index for a similar name,
+        # using the book titles returned by sort_name_from_database.
+        assert (('sort_name_from_authority_index', 'Jim Davis',
+             c.titles_from_database) == from_authority_index)
+
         # Then we passed the same information into
         # sort_name_from_oclc_linked_data.
         assert (('sort_name_from_oclc_linked_data', 'Jim Davis', 'An ISBN') ==
@@ -293,8 +314,8 @@ class TestAuthorNameCanonicalizer(DatabaseTest):
     def test_sort_name_from_database(self):
         # Verify that sort_name_from_database grabs titles and
         # Contributors from the database, then passes them into
-        # _sort_name_from_contributor_and_titles.
-        
+        # _sort_name_from_titles.
+
         class Mock(AuthorNameCanonicalizer):
 
             def __init__(self, _db):
@@ -302,11 +323,12 @@ class TestAuthorNameCanonicalizer(DatabaseTest):
                 self.calls = []
                 self.right_answer = None
 
-            def _sort_name_from_contributor_and_titles(
-                self, contributor, known_titles
-            ):
-                self.calls.append((contributor, known_titles))
-                return self.right_answer
+            def _sort_name_from_titles(self, rows, known_titles):
+                rows = list(rows)
+                self.calls.append((rows, known_titles))
+                return self.right_answer or super(
+                    Mock, self
+                )._sort_name_from_titles(rows, known_titles)
 
         canonicalizer = Mock(self._db)
 
@@ -318,6 +340,8 @@ class TestAuthorNameCanonicalizer(DatabaseTest):
 
         c2, ignore = self._contributor(sort_name="Yarrow, Bloom")
         c2.display_name = input_name
+        huck_finn = self._edition(title="Adventures of Huckleberry Finn")
+        huck_finn.add_contributor(c2, Contributor.AUTHOR_ROLE)
 
         # These contributors will be ignored -- c3 beacuse it doesn't
         # have a sort name (which is what we're trying to find) and v4
@@ -341,8 +365,8 @@ class TestAuthorNameCanonicalizer(DatabaseTest):
             data_source_name=DataSource.OVERDRIVE
         )
 
-        # Our mocked _sort_name_from_contributor_and_titles will
-        # return the answer we specify.
+        # Our mocked _sort_name_from_titles will return the answer we
+        # specify.
         canonicalizer.right_answer = "Sort Name, The Real"
         answer, titles = canonicalizer.sort_name_from_database(
             input_name, identifier
@@ -353,84 +377,102 @@ class TestAuthorNameCanonicalizer(DatabaseTest):
         # we passed in.
         assert set(["Title 1", "Title 2"]) == titles
 
-        # If we don't pass in an Identifier, we get the same answer
-        # but no titles.
+        # A single query found every Contributor that looked like it
+        # might be a match based on the display_name, along with the
+        # titles of their books.
+        [(rows, known_titles)] = canonicalizer.calls
+        assert titles == known_titles
+        assert [
+            (c1.id, "Zebra, Ant", None),
+            (c2.id, "Yarrow, Bloom", "Adventures of Huckleberry Finn"),
+        ] == [tuple(row) for row in rows]
+
+        # If we don't pass in an Identifier, there are no titles to
+        # go on, so the sort name of the first matching Contributor is
+        # used without looking at any books.
+        canonicalizer.calls = []
         answer, titles = canonicalizer.sort_name_from_database(
             input_name, None
         )
-        assert "Sort Name, The Real" == answer
+        assert c1.sort_name == answer
         assert set() == titles
-        
+        assert [] == canonicalizer.calls
+
         # Now let's get rid of the 'right answer' so we can see
-        # everything sort_name_from_database goes through before
-        # giving up.
+        # what _sort_name_from_titles does with the rows.
         canonicalizer.right_answer = None
-        canonicalizer.calls = []
         answer, titles = canonicalizer.sort_name_from_database(
             input_name, identifier
         )
 
-        # _sort_name_from_contributor_and_titles was called twice, one
-        # for each Contributor that looked like it might be a match
-        # based on the display_name.
-        call1, call2 = canonicalizer.calls
-        assert (c1, titles) == call1
-        assert (c2, titles) == call2
-
-        # Since neither call to _sort_name_from_contributor_and_titles
-        # turned up anything, the sort name of the first matching
-        # Contributor was used as the answer.
+        # Neither Contributor wrote a book whose title looks like
+        # "Title 1" or "Title 2", so the sort name of the first
+        # matching Contributor was used as the answer.
         assert c1.sort_name == answer
         assert set(["Title 1", "Title 2"]) == titles
 
+        # If one of the Identifier's titles is similar to a title by
+        # one of the Contributors, that Contributor's sort name is
+        # used.
+        edition2.title = "The Adventures of Huckleberry Finn"
+        answer, titles = canonicalizer.sort_name_from_database(
+            input_name, identifier
+        )
+        assert c2.sort_name == answer
+
         # If there are no matching Contributors at all,
         # sort_name_from_database returns None.
         assert ((None, set()) ==
             canonicalizer.sort_name_from_database("Jim Davis", None))
-
-    def test__sort_name_from_contributor_and_titles(self):
-        # Verify that _sort_name_from_contributor_and_titles returns a
-        # contributor's sort_name only if it looks like they wrote a
-        # book with one of the given titles.
-        m = AuthorNameCanonicalizer._sort_name_from_contributor_and_titles
-
-        # No contributor -> failure
-        assert None == m(None, None)
-        assert None == m(None, ["Title 1", "Title 2"])
-
-        # This contributor has no contributions at all -> failure
-        no_contributions, ignore = self._contributor()
-        assert None == m(no_contributions, ["Title 1"])
-
-        # This contributor has an associated edition.
-        edition = self._edition(
-            title="Adventures of Huckleberry Finn",
-            authors="A Display Name"
-        )
-        [contributor] = edition.contributors
-        contributor.sort_name = "Sort Name, An"
-
-        # We'll get None unless we pass in a title that's a
-        # substantial match.
-        assert None == m(contributor, None)
-        assert None == m(contributor, [])
-        assert None == m(contributor, ["Title 1", "Title 2"])
-
-        # If there is a match, we get the answer.
+        assert (None ==
+            canonicalizer.sort_name_from_database("Jim Davis", identifier)[0])
+
+    def test__sort_name_from_titles(self):
+        # Verify that _sort_name_from_titles picks the sort name of the
+        # first Contributor who looks like they wrote a book with one
+        # of the given titles.
+        m = AuthorNameCanonicalizer._sort_name_from_titles
+
+        # No Contributors -> failure
+        assert None == m([], ["Title 1"])
+
+        rows = [
+            (1, "Name, No Books", None),
+            (2, "Name, Another", "Some Other Book"),
+            (3, "Sort Name, An", "Some Other Book"),
+            (3, "Sort Name, An", "Adventures of Huckleberry Finn"),
+            (4, "Name, Also", "Adventures of Huckleberry Finn"),
+        ]
+
+        # If no titles match, we get the first Contributor's sort name.
+        assert "Name, No Books" == m(rows, None)
+        assert "Name, No Books" == m(rows, [])
+        assert "Name, No Books" == m(rows, ["Title 1", "Title 2"])
+
+        # If there is a match, we get the first Contributor who matched.
         assert ("Sort Name, An" ==
-            m(
-                contributor,
-                ["Adventures of Huckleberry Finn", "Some Other Book"]
-            )
-        )
+            m(rows, ["Adventures of Huckleberry Finn", "Title 1"]))
 
         # It doesn't have to be an exact match, but it must be close.
         assert ("Sort Name, An" ==
-            m(
-                contributor,
-                ["The Adventures of Huckleberry Finn"]
-            )
-        )
+            m(rows, ["The Adventures of Huckleberry Finn"]))
+
+    def test_title_scorer(self):
+        scorer = TitleScorer(["Adventures of Huckleberry Finn", "Title 1"])
+        assert False == scorer.matches(None)
+        assert False == scorer.matches("Some Other Book")
+        assert True == scorer.matches("The Adventures of Huckleberry Finn")
+        assert scorer.score("Adventures of Huckleberry Finn") >= TitleScorer.THRESHOLD
+
+        # Every score is remembered.
+        assert (set(["Some Other Book", "The Adventures of Huckleberry Finn",
+                     "Adventures of Huckleberry Finn"]) ==
+                set(scorer.scores))
+        scorer.scores["Some Other Book"] = 100
+        assert True == scorer.matches("Some Other Book")
+
+        # With no known titles, nothing matches.
+        assert False == TitleScorer([]).matches("Title 1")
 
     def test_sort_name_from_oclc_linked_data(self):
         # We may be able to use OCLC Linked Data to find an author sort
@@ -545,3 +587,117 @@ class TestAuthorNameCanonicalizer(DatabaseTest):
         assert "Davis, Jim" == m("Jim Davis and Matt Groening")
         assert "Vassar College" == m("Vassar College")
 
+
+
+class TestAuthorityIndex(DatabaseTest):
+
+    def setup_method(self):
+        super(TestAuthorityIndex, self).setup_method()
+        self.index = AuthorityIndex(self._db)
+
+    def _indexed(self, display_name, sort_name):
+        contributor, ignore = self._contributor(sort_name=sort_name)
+        contributor.display_name = display_name
+        self.index.index(contributor)
+        return contributor
+
+    def test_index(self):
+        contributor, ignore = self._contributor(sort_name="Twain, Mark")
+        contributor.display_name = "Mark Twain"
+
+        entry = self.index.index(contributor)
+        assert contributor == entry.contributor
+        assert "Mark Twain" == entry.display_name
+        assert "Twain, Mark" == entry.sort_name
+        assert AuthorityIndex.key("Mark Twain") == entry.key
+        assert (sorted(AuthorityIndex.tokens(entry.key)) ==
+                [x.token for x in entry.tokens])
+
+        # Indexing again brings the entry up to date.
+        contributor.display_name = "Samuel Clemens"
+        assert entry == self.index.index(contributor)
+        assert "Samuel Clemens" == entry.display_name
+        assert (sorted(AuthorityIndex.tokens(entry.key)) ==
+                sorted(x.token for x in entry.tokens))
+
+        # A Contributor without a sort name is taken out of the index.
+        contributor.sort_name = None
+        assert None == self.index.index(contributor)
+        self._db.flush()
+        assert [] == self._db.query(AuthorityName).all()
+
+    def test_lookup(self):
+        twain = self._indexed("Mark Twain", "Twain, Mark")
+        self._indexed("Mark Antony", "Antony, Mark")
+
+        # A name that's nearly the same is a match.
+        assert "Twain, Mark" == self.index.lookup("Mark  Twain.")
+
+        # A name that's merely similar isn't.
+        assert None == self.index.lookup("Mark Twine-Smith")
+        assert None == self.index.lookup("Shania Twain")
+        assert None == self.index.lookup("")
+
+    def test_lookup_ambiguous(self):
+        # Two different people have the same name.
+        smith1 = self._indexed("John Smith", "Smith, John")
+        smith2 = self._indexed("John Smith", "Smith, John, 1580-1631")
+
+        # With nothing else to go on, we can't tell which one is meant.
+        assert None == self.index.lookup("John Smith.")
+
+        # But if we know one of the books they wrote, we can.
+        edition = self._edition(title="The Generall Historie of Virginia")
+        edition.add_contributor(smith2, Contributor.AUTHOR_ROLE)
+        assert ("Smith, John, 1580-1631" ==
+                self.index.lookup("John Smith.", ["Generall Historie of Virginia"]))
+
+        # If the titles don't help, we're back where we started.
+        assert None == self.index.lookup("John Smith.", ["Pocahontas"])
+
+        # If everyone with the name agrees on the sort name, there's
+        # no ambiguity.
+        smith2.sort_name = "Smith, John"
+        self.index.index(smith2)
+        assert "Smith, John" == self.index.lookup("John Smith.")
+
+    def test_candidates(self):
+        twain = self._indexed("Mark Twain", "Twain, Mark")
+        antony = self._indexed("Mark Antony", "Antony, Mark")
+        clemens = self._indexed("Samuel Clemens", "Clemens, Samuel")
+
+        # Entries must share every word of a short name.
+        key = AuthorityIndex.key("Mark Twain")
+        assert [twain.id] == [x[0] for x in self.index.candidates(key)]
+
+        # For a longer name, they must share all but one word. The
+        # ones with more words in common come first.
+        both = self._indexed("Mark Twain Antony", "Antony, Mark Twain")
+        key = AuthorityIndex.key("Mark Antony Twain")
+        assert ([both.id, twain.id, antony.id] ==
+                [x[0] for x in self.index.candidates(key)])
+        key = AuthorityIndex.key("Samuel Mark Jones")
+        assert [] == self.index.candidates(key)
+        assert [] == self.index.candidates("")
+
+        # When there are too many candidates, the ones with the most
+        # words in common are kept.
+        self.index.MAX_CANDIDATES = 1
+        key = AuthorityIndex.key("Mark Antony Twain")
+        assert [both.id] == [x[0] for x in self.index.candidates(key)]
+
+    def test_sort_name_from_services_uses_authority_index(self):
+        # A Contributor's name is in the index, but spelled a little
+        # differently from the name we're asked about.
+        self._indexed("J. R. R. Tolkien", "Tolkien, J. R. R.")
+
+        class Mock(AuthorNameCanonicalizer):
+            def explode(self, *args, **kwargs):
+                raise Exception("boom!")
+            sort_name_from_oclc_linked_data = explode
+            sort_name_from_viaf_urls = explode
+            sort_name_from_viaf_display_name = explode
+
+        canonicalizer = Mock(self._db, oclcld=object(), viaf=object())
+        assert ("Tolkien, J. R. R." ==
+                canonicalizer.sort_name_from_services("J.R.R. Tolkien"))
@@ -0,0 +1,216 @@
+import datetime
+import os
+import shutil
+import tempfile
+import zlib
+
+from . import DatabaseTest
+
+from core.model import Representation
+from core.util.datetime_helpers import utc_now
+
+from blobstore import BlobStore
+from compression import (
+    MARKER,
+    Compressor,
+    compress,
+    compressible_representations,
+    decompress,
+    get_representation,
+    is_cached,
+    is_compressed,
+    is_evicted,
+    representation_content,
+    uncompressed_representations,
+    unstored_representations,
+)
+
+
+class TestCompression(object):
+
+    def test_compress_and_decompress(self):
+        document = b"<cluster>" + (b"<name>Twain, Mark</name>" * 100) + b"</cluster>"
+        compressed = compress(document)
+        assert True == is_compressed(compressed)
+        assert compressed.startswith(MARKER)
+        assert len(compressed) < len(document)
+        assert document == zlib.decompress(compressed[len(MARKER):])
+        assert document == decompress(compressed)
+
+        # Compressing twice does nothing.
+        assert compressed == compress(compressed)
+
+        # Content that isn't compressed is passed through, so
+        # documents stored before compression can still be read.
+        assert document == decompress(document)
+        assert None == decompress(None)
+
+    def test_compress_leaves_some_content_alone(self):
+        # Nothing to compress.
+        assert None == compress(None)
+        assert b"" == compress(b"")
+
+        # Too small to bother.
+        assert b"<a/>" == compress(b"<a/>")
+
+        # Compressing random data would make it bigger.
+        noise = os.urandom(1000)
+        assert noise == compress(noise)
+
+    def test_compressor(self):
+        document = b"{}" * 1000
+        def do_get(url, *args, **kwargs):
+            return 200, {"content-type": "application/json"}, document
+
+        status, headers, content = Compressor().wrap(do_get)("http://a/")
+        assert 200 == status
+        assert "application/json" == headers["content-type"]
+        assert document == decompress(content)
+        assert len(content) < len(document)
+
+    def test_compressor_with_blob_store(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = BlobStore(directory, 1024 * 1024)
+            document = b"{}" * 1000
+            def do_get(url, *args, **kwargs):
+                return 200, {}, document
+            compressor = Compressor(blob_store=store)
+            assert store == compressor.blob_store
+
+            # The content is compressed and put in the blob store, and
+            # only a reference to it is returned.
+            status, headers, content = compressor.wrap(do_get)("http://a/")
+            assert True == BlobStore.is_reference(content)
+            assert compress(document) == store.resolve(content)
+
+            # The same document is only stored once.
+            assert content == compressor.wrap(do_get)("http://b/")[2]
+            assert 1 == len(list(store.blobs()))
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestCompressibleRepresentations(DatabaseTest):
+
+    def test_queries(self):
+        document = b"<cluster>" + (b"<name>Twain, Mark</name>" * 100) + b"</cluster>"
+
+        xml = Representation.TEXT_XML_MEDIA_TYPE
+        viaf, ignore = self._representation(
+            url="http://viaf.org/viaf/50566653/viaf.xml", media_type=xml,
+            content=document
+        )
+        compressed, ignore = self._representation(
+            url="http://viaf.org/viaf/9581122/viaf.xml", media_type=xml,
+            content=compress(document)
+        )
+        small, ignore = self._representation(
+            url="http://viaf.org/viaf/1/viaf.xml", media_type=xml,
+            content=b"<a/>"
+        )
+        empty, ignore = self._representation(
+            url="http://classify.oclc.org/classify2/Classify?isbn=1"
+        )
+        elsewhere, ignore = self._representation(
+            url="http://example.com/", media_type=xml, content=document
+        )
+
+        qu = self._db.query(Representation)
+        assert (set([viaf, compressed, small]) ==
+                set(compressible_representations(qu)))
+        assert [viaf] == uncompressed_representations(qu).all()
+
+        assert document == representation_content(viaf)
+        assert document == representation_content(compressed)
+
+
+class TestBlobStoreRepresentations(DatabaseTest):
+
+    def setup_method(self):
+        super(TestBlobStoreRepresentations, self).setup_method()
+        self.directory = tempfile.mkdtemp()
+        self.store = BlobStore(self.directory, 1024 * 1024)
+
+    def teardown_method(self):
+        shutil.rmtree(self.directory)
+        super(TestBlobStoreRepresentations, self).teardown_method()
+
+    def test_representation_content(self):
+        document = b"<cluster>" + (b"<name>Twain, Mark</name>" * 100) + b"</cluster>"
+        representation, ignore = self._representation(
+            url="http://viaf.org/viaf/50566653/viaf.xml",
+            media_type=Representation.TEXT_XML_MEDIA_TYPE,
+            content=self.store.store(compress(document))
+        )
+        assert document == representation_content(representation, self.store)
+
+        # Once the content is in the blob store, it's left alone by
+        # the compression sweep.
+        qu = self._db.query(Representation)
+        assert [] == uncompressed_representations(qu).all()
+        assert [] == unstored_representations(qu).all()
+
+        # If the blob has been evicted, the content is gone.
+        assert False == is_evicted(representation, self.store)
+        os.remove(self.store.path(self.store.digest(compress(document))))
+        assert True == is_evicted(representation, self.store)
+        assert None == representation_content(representation, self.store)
+
+        # Content that's not a reference is never evicted.
+        representation.content = compress(document)
+        assert False == is_evicted(representation, self.store)
+
+    def test_is_cached(self):
+        url = "http://viaf.org/viaf/50566653/viaf.xml"
+        def do_get(url, *args, **kwargs):
+            return 200, {"content-type": "text/xml"}, self.store.store(b"<cluster/>")
+
+        assert False == is_cached(self._db, url, blob_store=self.store)
+        representation, cached = get_representation(
+            self._db, url, do_get, blob_store=self.store
+        )
+        assert True == is_cached(self._db, url, blob_store=self.store)
+
+        # A copy that's too old doesn't count.
+        representation.fetched_at = utc_now() - datetime.timedelta(days=2)
+        assert False == is_cached(
+            self._db, url, max_age=datetime.timedelta(days=1),
+            blob_store=self.store
+        )
+        assert True == is_cached(self._db, url, blob_store=self.store)
+
+        # Neither does a copy whose blob has been evicted.
+        shutil.rmtree(self.directory)
+        os.mkdir(self.directory)
+        assert False == is_cached(self._db, url, blob_store=self.store)
+
+    def test_get_representation_refetches_evicted_blob(self):
+        url = "http://viaf.org/viaf/50566653/viaf.xml"
+        document = b"<cluster/>"
+        requests = []
+        def do_get(url, *args, **kwargs):
+            requests.append(url)
+            return 200, {"content-type": "text/xml"}, self.store.store(document)
+
+        representation, cached = get_representation(self._db, url, do_get)
+        assert False == cached
+        assert [url] == requests
+
+        # The second time, the cached copy is used.
+        representation, cached = get_representation(
+            self._db, url, do_get, blob_store=self.store
+        )
+        assert True == cached
+        assert [url] == requests
+
+        # Once the blob is evicted, the document is fetched again even
+        # though the Representation is fresh.
+        shutil.rmtree(self.directory)
+        os.mkdir(self.directory)
+        representation, cached = get_representation(
+            self._db, url, do_get, blob_store=self.store
+        )
+        assert False == cached
+        assert [url, url] == requests
+        assert document == representation_content(representation, self.store)
@@ -439,6 +439,13 @@ class TestContentCafeCoverageProvider(DatabaseTest):
         assert ("Content Cafe has no knowledge of this identifier." ==
             result.exception)
 
+        # Content Cafe probably won't know about the book for a while,
+        # so it's retried on a long backoff.
+        delay = provider.retry_delay_for(result)
+        assert datetime.timedelta(days=3) == delay(1)
+        assert datetime.timedelta(days=6) == delay(2)
+        assert datetime.timedelta(days=90) == delay(100)
+
     def test_process_item_exception(self):
         """Test what happens when an exception is raised
         in the course of obtaining coverage.
@@ -457,6 +464,12 @@ class TestContentCafeCoverageProvider(DatabaseTest):
         assert identifier == result.obj
         assert "Oh no!" in result.exception
 
+        # This might clear up soon, so it's retried on the normal
+        # backoff.
+        delay = provider.retry_delay_for(result)
+        assert provider.retry_delay(1) == delay(1)
+        assert datetime.timedelta(hours=1) == delay(1)
+
 
 class MockSession(DummyHTTPClient):
     """Mock the requests Session object used by zeep.transports.Transport."""
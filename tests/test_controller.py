@@ -5,6 +5,7 @@ import os
 import feedparser
 import json
 import re
+import time
 from Crypto.Cipher import PKCS1_OAEP
 from Crypto.Hash import SHA
 from Crypto.Signature import PKCS1_v1_5
@@ -1159,7 +1160,7 @@ class TestURNLookupHandler(DatabaseTest):
         handler = MockHandler(self._db, object(), object())
         work = object()
         handler.ready_work = work
-        identifier = object()
+        identifier = self._identifier()
         urn = object()
         handler.process_identifier(identifier, urn)
         assert [(identifier, work)] == handler.works
@@ -1168,6 +1169,7 @@ class TestURNLookupHandler(DatabaseTest):
         # resolver.ensure_coverage makes it presentation ready, it is
         # used immediately.
         class SuccessfulResolver(object):
+            OPERATION = "resolve"
             force = False
             def ensure_coverage(self, identifier, force):
                 handler.ready_work = work
@@ -1182,6 +1184,7 @@ class TestURNLookupHandler(DatabaseTest):
         # resolver.ensure_coverage does not make it presentation
         # ready, handler.add_status_message is called
         class UnsuccessfulResolver(object):
+            OPERATION = "resolve"
             force = False
             def ensure_coverage(self, identifier, force):
                 handler.ready_work = None
@@ -1193,6 +1196,115 @@ class TestURNLookupHandler(DatabaseTest):
         assert [] == handler.works
         assert (urn, identifier) == handler.status_message
 
+    def test_process_identifier_waits_for_other_process(self):
+        work = object()
+
+        class MockHandler(URNLookupHandler):
+            ready_work = None
+            claim = None
+            refreshed = False
+            refreshed_work = work
+            def presentation_ready_work_for(self, identifier):
+                return self.ready_work
+
+            def claim_resolution(self, identifier):
+                return self.claim
+
+            def refresh(self, identifier):
+                # While we were waiting, the other process may have
+                # created a presentation-ready work.
+                self.refreshed = True
+                self.ready_work = self.refreshed_work
+
+            def add_status_message(self, urn, identifier):
+                self.status_message = (urn, identifier)
+
+        class Resolver(object):
+            OPERATION = "resolve"
+            def ensure_coverage(self, identifier, force):
+                raise Exception("I should not be called.")
+
+        identifier = self._identifier()
+        urn = object()
+
+        # If another process is still working on the identifier,
+        # we report its status without calling the resolver.
+        handler = MockHandler(self._db, Resolver(), object())
+        handler.process_identifier(identifier, urn)
+        assert (urn, identifier) == handler.status_message
+        assert False == handler.refreshed
+
+        # If another process finished working on the identifier while
+        # we waited, we use the work it created.
+        handler = MockHandler(self._db, Resolver(), object())
+        handler.claim = False
+        handler.works = []
+        handler.process_identifier(identifier, urn)
+        assert True == handler.refreshed
+        assert [(identifier, work)] == handler.works
+
+        # If the other process finished without creating a work, we
+        # report on what it did rather than calling the resolver
+        # again.
+        handler = MockHandler(self._db, Resolver(), object())
+        handler.claim = False
+        handler.refreshed_work = None
+        handler.works = []
+        handler.process_identifier(identifier, urn)
+        assert True == handler.refreshed
+        assert [] == handler.works
+        assert (urn, identifier) == handler.status_message
+
+    def test_claim_resolution(self):
+        class MockHandler(URNLookupHandler):
+            RESOLUTION_WAIT = 1
+            RESOLUTION_POLL_INTERVAL = 0.25
+            def __init__(self, results):
+                self.results = results
+                self.attempts = 0
+            def try_resolution_lock(self, identifier):
+                self.attempts += 1
+                return self.results.pop(0) if self.results else False
+
+        sleeps = []
+        def sleep(seconds):
+            sleeps.append(seconds)
+            time.sleep(seconds)
+        identifier = self._identifier()
+
+        # We got the lock right away.
+        handler = MockHandler([True])
+        assert True == handler.claim_resolution(identifier, sleep)
+        assert [] == sleeps
+
+        # We got the lock after another process let go of it.
+        handler = MockHandler([False, False, True])
+        assert False == handler.claim_resolution(identifier, sleep)
+        assert [0.25, 0.25] == sleeps
+
+        # We never got the lock.
+        handler = MockHandler([])
+        assert None == handler.claim_resolution(identifier, sleep)
+        assert handler.attempts > 1
+
+        # If the request as a whole has run out of time, we don't
+        # wait at all.
+        handler = MockHandler([])
+        handler.resolution_deadline = time.monotonic()
+        assert None == handler.claim_resolution(identifier, sleep)
+        assert 1 == handler.attempts
+
+    def test_try_resolution_lock(self):
+        class Resolver(object):
+            OPERATION = "resolve"
+        handler = URNLookupHandler(self._db, Resolver(), object())
+        identifier = self._identifier()
+
+        # Advisory locks are reentrant within a database session, so
+        # within a single test we can always get the lock.
+        assert True == handler.try_resolution_lock(identifier)
+        assert True == handler.try_resolution_lock(identifier)
+
 class TestURNLookupController(ControllerTest):
 
     ISBN_URN = 'urn:isbn:9781449358068'
@@ -5,6 +5,7 @@ from core.model import (
     DataSource,
     ExternalIntegration,
     ExternalIntegrationLink,
+    Identifier,
 )
 
 from core.s3 import S3Uploader
@@ -17,6 +18,7 @@ from content_cafe import (
 )
 from coverage_provider import IdentifierResolutionCoverageProvider
 from integration_client import IntegrationClientCoverImageCoverageProvider
+from model import CoverageSchedule
 from oclc.classify import IdentifierLookupCoverageProvider
 from overdrive import OverdriveBibliographicCoverageProvider
 from viaf import VIAFClient
@@ -53,6 +55,10 @@ class TestIdentifierResolutionCoverageProvider(DatabaseTest):
         assert immediate == provider.provide_coverage_immediately
         assert force == provider.force
 
+        # By default, identifiers are registered with other
+        # CoverageProviders in the normal priority lane.
+        assert CoverageSchedule.NORMAL_PRIORITY == provider.priority
+
         # A random extra keyword argument was propagated to the
         # super-constructor.
         assert 93 == provider.batch_size
@@ -392,3 +398,63 @@ class TestIdentifierResolutionCoverageProvider(DatabaseTest):
         # In this case, collection is not provided, because
         # ensure_coverage has its own code to check
         # COVERAGE_COUNTS_FOR_EVERY_COLLECTION.
+
+    def test_process_one_provider_defers_when_upstream_unavailable(self):
+        """If a subprovider's upstream service is down, an Identifier
+        that was supposed to be covered immediately is registered
+        instead.
+        """
+        collection = self._default_collection
+        provider = IdentifierResolutionCoverageProvider(
+            collection, provide_coverage_immediately=True
+        )
+
+        class Down(CollectionCoverageProvider):
+            SERVICE_NAME = "Upstream is down"
+            DATA_SOURCE_NAME = DataSource.OVERDRIVE
+            COVERAGE_COUNTS_FOR_EVERY_COLLECTION = True
+            unavailable = True
+
+            def upstream_unavailable(self):
+                return self.unavailable
+
+            def register(self, identifier, collection, force):
+                self.register_called_with = [identifier, collection, force]
+                return None, None
+
+            def ensure_coverage(self, identifier, force):
+                self.ensure_coverage_called_with = [identifier, force]
+
+        i1 = self._identifier()
+        subprovider = Down(collection)
+        provider.process_one_provider(i1, subprovider)
+        assert [i1, None, provider.force] == subprovider.register_called_with
+        assert not hasattr(subprovider, 'ensure_coverage_called_with')
+
+        # Once it comes back, coverage happens immediately again.
+        subprovider.unavailable = False
+        provider.process_one_provider(i1, subprovider)
+        assert [i1, provider.force] == subprovider.ensure_coverage_called_with
+
+    def test_process_one_provider_sets_priority(self):
+        """When an Identifier is registered with a subprovider, the
+        resulting CoverageRecord is put in the resolver's priority lane.
+        """
+        collection = self._default_collection
+        provider = IdentifierResolutionCoverageProvider(
+            collection, priority=CoverageSchedule.HIGH_PRIORITY
+        )
+        subprovider = ContentCafeCoverageProvider(
+            collection, api=object()
+        )
+        identifier = self._identifier(identifier_type=Identifier.ISBN)
+        record = provider.process_one_provider(identifier, subprovider)
+        assert CoverageRecord.REGISTERED == record.status
+        schedule = CoverageSchedule.for_record(record)
+        assert CoverageSchedule.HIGH_PRIORITY == schedule.priority
+
+        # A later, lower-priority registration doesn't send the
+        # Identifier to the back of the line.
+        provider.priority = CoverageSchedule.NORMAL_PRIORITY
+        provider.process_one_provider(identifier, subprovider)
+        assert CoverageSchedule.HIGH_PRIORITY == schedule.priority
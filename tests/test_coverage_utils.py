@@ -1,3 +1,5 @@
+import datetime
+
 from . import (
     DatabaseTest,
 )
@@ -5,19 +7,29 @@ from . import (
 from core.coverage import CoverageFailure
 
 from core.model import (
+    CoverageRecord,
     DataSource,
     ExternalIntegration,
     ExternalIntegrationLink,
     Work,
+    WorkCoverageRecord,
 )
 from core.mirror import MirrorUploader
 from core.tests.test_s3 import S3UploaderTest
+from core.util.datetime_helpers import utc_now
 
 from coverage_utils import (
     MetadataWranglerBibliographicCoverageProvider,
     MetadataWranglerReplacementPolicy,
+    QueryCounter,
     ResolveVIAFOnSuccessCoverageProvider,
 )
+from integration_client import WorkPresentationCoverageProvider
+from model import (
+    ContributorVIAFCoverage,
+    CoverageSchedule,
+)
+from upstream import CircuitBreaker
 
 class MockProvider(MetadataWranglerBibliographicCoverageProvider):
     """A simple MetadataWranglerBibliographicCoverageProvider
@@ -26,6 +38,20 @@ class MockProvider(MetadataWranglerBibliographicCoverageProvider):
     SERVICE_NAME = "Mock"
     DATA_SOURCE_NAME = DataSource.GUTENBERG
 
+class TestQueryCounter(DatabaseTest):
+
+    def test_count(self):
+        self._db.flush()
+        with QueryCounter(self._db) as counter:
+            self._db.query(Work).all()
+            self._db.query(DataSource).all()
+        assert 2 == counter.count
+
+        # Once the block is over, queries aren't counted.
+        self._db.query(Work).all()
+        assert 2 == counter.count
+
+
 class TestMetadataWranglerReplacementPolicy(DatabaseTest):
 
     def test_from_db(self):
@@ -141,43 +167,163 @@ class TestMetadataWranglerBibliographicCoverageProvider(S3UploaderTest):
         work = pool.work
         assert True == work.presentation_ready
 
-    def test_handle_success_recalculates_presentation_of_existing_work(self):
+    def test_handle_success_registers_existing_work_for_recalculation(self):
         """If work() returns a Work that's already presentation-ready,
-        calculate_presentation() is called on the Work.
+        it's registered with WorkPresentationCoverageProvider instead of
+        having its presentation recalculated on the spot.
         """
+        work = self._work(with_license_pool=True)
+        work.presentation_ready = True
+        [pool] = work.license_pools
+
+        class Mock(MockProvider):
+            def work(self, identifier):
+                return work
+
+        provider = Mock(self._default_collection)
+        provider.handle_success(pool.identifier)
+
+        record = WorkCoverageRecord.lookup(
+            work, WorkPresentationCoverageProvider.OPERATION
+        )
+        assert CoverageRecord.REGISTERED == record.status
+        assert True == work.presentation_ready
 
-        class MockWork(Work):
-            """Act like a presentation-ready work that just needs
-            calculate_presentation() to be called.
-            """
-            def __init__(self):
-                self.presentation_ready = True
-                self.calculate_presentation_called = False
-                self.set_presentation_ready_called = False
+class TestScheduledCoverageProvider(DatabaseTest):
+
+    def test_register_sets_priority(self):
+        identifier = self._identifier()
+        record, is_new = MockProvider.register(
+            identifier, priority=CoverageSchedule.HIGH_PRIORITY
+        )
+        assert CoverageRecord.REGISTERED == record.status
+        schedule = CoverageSchedule.for_record(record)
+        assert CoverageSchedule.HIGH_PRIORITY == schedule.priority
+
+        # Registering without a priority leaves the existing
+        # priority alone.
+        MockProvider.register(identifier)
+        assert CoverageSchedule.HIGH_PRIORITY == schedule.priority
+
+        # bulk_register also accepts a priority.
+        i2 = self._identifier()
+        [record2], ignored = MockProvider.bulk_register(
+            [i2], priority=CoverageSchedule.HIGH_PRIORITY
+        )
+        assert (CoverageSchedule.HIGH_PRIORITY ==
+                CoverageSchedule.for_record(record2).priority)
 
-            def calculate_presentation(self):
-                self.calculate_presentation_called = True
+    def test_items_that_need_coverage_interleaves_lanes(self):
+        provider = MockProvider(self._default_collection)
+        normal = []
+        high = []
+        # This provider only covers identifiers with LicensePools in
+        # its collection.
+        for i in range(6):
+            identifier = self._licensepool(None).identifier
+            MockProvider.register(identifier)
+            normal.append(identifier)
+        for i in range(6):
+            identifier = self._licensepool(None).identifier
+            MockProvider.register(
+                identifier, priority=CoverageSchedule.HIGH_PRIORITY
+            )
+            high.append(identifier)
+
+        # Although the normal-priority identifiers were registered
+        # first, four high-priority identifiers come out for every
+        # normal-priority one, until the high-priority lane runs dry.
+        items = provider.items_that_need_coverage().all()
+        expect = high[:4] + normal[:1] + high[4:] + normal[1:]
+        assert expect == items
+
+        # A provider can be given different weights.
+        provider = MockProvider(
+            self._default_collection, priority_weights={
+                CoverageSchedule.HIGH_PRIORITY : 1,
+                CoverageSchedule.NORMAL_PRIORITY : 1,
+            }
+        )
+        items = provider.items_that_need_coverage().all()
+        assert [high[0], normal[0], high[1], normal[1]] == items[:4]
+        assert 4 == provider.PRIORITY_WEIGHTS[CoverageSchedule.HIGH_PRIORITY]
 
-            def set_presentation_ready(self, *args, **kwargs):
-                self.set_presentation_ready_called = True
+        # While a batch is being processed, only as many items as the
+        # batch could use are taken from each lane.
+        provider.schedule_window = 2
+        items = provider.items_that_need_coverage().all()
+        assert [high[0], normal[0], high[1], normal[1]] == items
 
-        work = MockWork()
 
+    def test_retry_delay(self):
+        provider = MockProvider(self._default_collection)
+        provider.RETRY_DELAY = datetime.timedelta(hours=1)
+        provider.MAX_RETRY_DELAY = datetime.timedelta(hours=5)
+        hours = lambda x: datetime.timedelta(hours=x)
+        assert hours(1) == provider.retry_delay(1)
+        assert hours(2) == provider.retry_delay(2)
+        assert hours(4) == provider.retry_delay(3)
+        assert hours(5) == provider.retry_delay(4)
+        assert hours(5) == provider.retry_delay(1000)
+
+        provider.RETRY_DELAY = None
+        assert None == provider.retry_delay(1)
+
+    def test_transient_failure_is_postponed(self):
+        class Failer(MockProvider):
+            def process_item(self, identifier):
+                return self.failure(identifier, "try later", transient=True)
+
+        provider = Failer(self._default_collection)
+        identifier = self._licensepool(None).identifier
+        assert [identifier] == provider.items_that_need_coverage().all()
+
+        provider.run_once_and_update_timestamp()
+        [record] = [x for x in identifier.coverage_records
+                    if x.data_source == provider.data_source]
+        assert CoverageRecord.TRANSIENT_FAILURE == record.status
+        schedule = CoverageSchedule.for_record(record)
+        assert 1 == schedule.attempts
+        assert schedule.next_attempt_time > utc_now()
+
+        # Until the next attempt time, the identifier is skipped.
+        assert [] == provider.items_that_need_coverage().all()
+
+        # Once the time has passed, it's back in the queue.
+        schedule.next_attempt_time = utc_now() - datetime.timedelta(hours=1)
+        assert [identifier] == provider.items_that_need_coverage().all()
+
+        # Registering the identifier again with force=True puts it
+        # back in the queue immediately.
+        schedule.next_attempt_time = utc_now() + datetime.timedelta(hours=1)
+        MockProvider.register(identifier, force=True)
+        assert [identifier] == provider.items_that_need_coverage().all()
+
+        # A success resets the count.
+        class Succeeder(MockProvider):
+            def process_item(self, identifier):
+                return identifier
+        Succeeder(self._default_collection).ensure_coverage(identifier)
+        assert 0 == schedule.attempts
+        assert None == schedule.next_attempt_time
+
+
+    def test_nothing_needs_coverage_while_upstream_unavailable(self):
         class Mock(MockProvider):
-            def work(self, identifier):
-                return work
+            UPSTREAM_URLS = ['http://example.com/api']
 
         provider = Mock(self._default_collection)
-        pool = self._licensepool(None)
-        provider.handle_success(pool.identifier)
+        identifier = self._licensepool(None).identifier
+        assert False == provider.upstream_unavailable()
+        assert [identifier] == provider.items_that_need_coverage().all()
 
-        # Since work.presentation_ready was already True,
-        # work.calculate_presentation() was called.
-        assert True == work.calculate_presentation_called
+        # Trip the circuit breaker for example.com.
+        breaker = CircuitBreaker(self._db)
+        for i in range(breaker.FAILURE_THRESHOLD):
+            breaker.record_failure('http://example.com/')
+        assert True == provider.upstream_unavailable()
+        assert [] == provider.items_that_need_coverage().all()
 
-        # work.set_presentation_ready() was called, just to
-        # be safe.
-        assert True == work.set_presentation_ready_called
 
 class MockResolveVIAF(ResolveVIAFOnSuccessCoverageProvider):
     SERVICE_NAME = "Mock resolve_viaf"
@@ -211,11 +357,6 @@ class TestResolveVIAFOnSuccessCoverageProvider(DatabaseTest):
         assert True == work.presentation_ready
 
     def test_resolve_viaf(self):
-        class MockVIAF(object):
-            processed = []
-            def process_contributor(self, contributor):
-                self.processed.append(contributor)
-
         # We did something and ended up with a functioning Work.
         work = self._work(
             authors=['Author 1', 'Author 2'], with_license_pool=True
@@ -234,15 +375,24 @@ class TestResolveVIAFOnSuccessCoverageProvider(DatabaseTest):
 
         # Now let's call resolve_viaf().
         provider = MockResolveVIAF(self._default_collection)
-        provider.viaf = MockVIAF()
         provider.resolve_viaf(work)
 
-        # The two contributors associated with the work's presentation edition
-        # were run through the MockVIAF().
-        assert set([c1, c2]) == set(provider.viaf.processed)
+        # The two contributors associated with the work's presentation
+        # edition were registered to be run through VIAF.
+        coverages = self._db.query(ContributorVIAFCoverage).all()
+        assert set([c1, c2]) == set([x.contributor for x in coverages])
+        for coverage in coverages:
+            assert ContributorVIAFCoverage.REGISTERED == coverage.status
 
-        # Since it's just a mock, no VIAF anything actually happened.
-        # But _because_ nothing happened, we made guesses as to the
-        # display names of the two contributors.
+        # Nothing has actually been looked up yet, so in the meantime
+        # we made guesses as to the display names of the two
+        # contributors.
         assert "Author 1" == c1.display_name
         assert "Author 2" == c2.display_name
+
+        # A contributor who was resolved recently isn't registered
+        # again.
+        [c1_coverage] = [x for x in coverages if x.contributor == c1]
+        c1_coverage.record(ContributorVIAFCoverage.NOT_FOUND)
+        provider.resolve_viaf(work)
+        assert ContributorVIAFCoverage.NOT_FOUND == c1_coverage.status
@@ -0,0 +1,158 @@
+from . import DatabaseTest
+
+from core.model import (
+    DataSource,
+    Equivalency,
+    Identifier,
+)
+
+from equivalency import EquivalencyClosureIndex
+from model import EquivalencyClosure
+
+
+class TestEquivalencyClosureIndex(DatabaseTest):
+
+    def setup_method(self):
+        super(TestEquivalencyClosureIndex, self).setup_method()
+        self.index = EquivalencyClosureIndex(self._db)
+        self.source = DataSource.lookup(self._db, DataSource.OCLC)
+        self.isbn = self._identifier(identifier_type=Identifier.ISBN)
+        self.number = self._identifier(identifier_type=Identifier.OCLC_NUMBER)
+        self.work_id = self._identifier(identifier_type=Identifier.OCLC_WORK)
+
+    def closure(self, identifier):
+        """The (equivalent ID, strength, depth) of every chain that
+        starts at `identifier`.
+        """
+        qu = self._db.query(EquivalencyClosure).filter(
+            EquivalencyClosure.identifier_id==identifier.id
+        ).order_by(EquivalencyClosure.equivalent_id)
+        return [(x.equivalent_id, round(x.strength, 2), x.depth) for x in qu]
+
+    def test_equivalent_to(self):
+        equivalency = self.index.equivalent_to(
+            self.isbn, self.source, self.number, 1
+        )
+        assert isinstance(equivalency, Equivalency)
+        assert [(self.number.id, 1, 1)] == self.closure(self.isbn)
+
+        # The closure goes both ways.
+        assert [(self.isbn.id, 1, 1)] == self.closure(self.number)
+
+        # Equivalents of equivalents are in the closure, as strong as
+        # the chain that connects them.
+        self.index.equivalent_to(self.number, self.source, self.work_id, 0.8)
+        assert [
+            (self.number.id, 1, 1), (self.work_id.id, 0.8, 2)
+        ] == self.closure(self.isbn)
+        assert [
+            (self.isbn.id, 0.8, 2), (self.number.id, 0.8, 1)
+        ] == self.closure(self.work_id)
+
+        # A stronger chain replaces a weaker one.
+        self.index.equivalent_to(self.isbn, self.source, self.work_id, 0.9)
+        assert [
+            (self.number.id, 1, 1), (self.work_id.id, 0.9, 1)
+        ] == self.closure(self.isbn)
+        assert [
+            (self.isbn.id, 0.9, 1), (self.number.id, 0.9, 2)
+        ] == self.closure(self.work_id)
+
+        # Making an Equivalency weaker rebuilds the closure around it.
+        self.index.equivalent_to(self.isbn, self.source, self.work_id, 0.1)
+        assert [
+            (self.number.id, 1, 1), (self.work_id.id, 0.8, 2)
+        ] == self.closure(self.isbn)
+
+        # Chains that are too weak aren't kept, so this Identifier is
+        # only equivalent to the Work ID, not to the ISBN.
+        other = self._identifier()
+        self.index.equivalent_to(self.work_id, self.source, other, 0.6)
+        assert [(self.work_id.id, 0.6, 1)] == self.closure(other)
+
+    def test_update(self):
+        # These Equivalencies were created without going through the
+        # index.
+        self.isbn.equivalent_to(self.source, self.number, 1)
+        self.number.equivalent_to(self.source, self.work_id, 1)
+        self._db.flush()
+        assert [] == self.closure(self.isbn)
+
+        # Updating the closure for the ISBN only picks up the
+        # Equivalencies that involve the ISBN.
+        self.index.update([self.isbn])
+        assert [(self.number.id, 1, 1)] == self.closure(self.isbn)
+
+        self.index.update([self.work_id])
+        assert [
+            (self.number.id, 1, 1), (self.work_id.id, 1, 2)
+        ] == self.closure(self.isbn)
+
+    def test_update_completes_chains_missed_by_concurrent_adds(self):
+        # One process made the ISBN equivalent to the OCLC Number,
+        # while another made the OCLC Number equivalent to the Work
+        # ID. Neither saw the other's change, so the closure doesn't
+        # connect the ISBN to the Work ID.
+        self.index.equivalent_to(self.isbn, self.source, self.number, 1)
+        equivalency = self.number.equivalent_to(self.source, self.work_id, 1)
+        for a, b in ((self.number, self.work_id), (self.work_id, self.number)):
+            self._db.add(EquivalencyClosure(
+                identifier_id=a.id, equivalent_id=b.id, strength=1, depth=1
+            ))
+        self._db.flush()
+        assert [(self.number.id, 1, 1)] == self.closure(self.isbn)
+
+        # Both Equivalencies are direct links in the closure, but
+        # they're still picked up as unindexed.
+        qu = self.index.unindexed(self._db.query(Equivalency))
+        assert equivalency in qu.all()
+
+        # So the closure is known to be behind for the ISBN.
+        other = self._identifier()
+        equivalents = self.index.equivalent_ids([self.isbn.id, other.id])
+        assert set([self.isbn.id]) == self.index.behind(equivalents)
+
+        # Updating the closure fills in the missing chain.
+        self.index.update([self.isbn])
+        assert [
+            (self.number.id, 1, 1), (self.work_id.id, 1, 2)
+        ] == self.closure(self.isbn)
+        assert [] == self.index.unindexed(self._db.query(Equivalency)).all()
+        equivalents = self.index.equivalent_ids([self.isbn.id, other.id])
+        assert set() == self.index.behind(equivalents)
+        assert set() == self.index.behind({})
+
+    def test_refresh(self):
+        self.index.equivalent_to(self.isbn, self.source, self.number, 1)
+        equivalency = self.index.equivalent_to(
+            self.number, self.source, self.work_id, 1
+        )
+
+        # Once an Equivalency is deleted, the chains that went
+        # through it are taken out of the closure.
+        self._db.delete(equivalency)
+        self._db.flush()
+        self.index.refresh([self.number.id])
+        assert [(self.number.id, 1, 1)] == self.closure(self.isbn)
+        assert [] == self.closure(self.work_id)
+
+    def test_equivalent_ids(self):
+        other = self._identifier()
+        self.index.equivalent_to(self.isbn, self.source, self.number, 1)
+        self.index.equivalent_to(self.number, self.source, self.work_id, 0.6)
+
+        ids = [self.isbn.id, other.id]
+        assert {
+            self.isbn.id: [self.isbn.id, self.number.id, self.work_id.id],
+            other.id: [other.id],
+        } == self.index.equivalent_ids(ids)
+
+        # The chains followed can be limited by length or strength.
+        expect = {
+            self.isbn.id: [self.isbn.id, self.number.id],
+            other.id: [other.id],
+        }
+        assert expect == self.index.equivalent_ids(ids, levels=1)
+        assert expect == self.index.equivalent_ids(ids, threshold=0.7)
+
+        assert {} == self.index.equivalent_ids([])
@@ -1,3 +1,5 @@
+import datetime
+
 from . import (
     DatabaseTest,
 )
@@ -11,8 +13,12 @@ from core.model import (
 )
 from core.s3 import MockS3Uploader
 from core.testing import AlwaysSuccessfulCoverageProvider
+from core.util.datetime_helpers import utc_now
 
-from coverage_utils import MetadataWranglerReplacementPolicy
+from coverage_utils import (
+    MetadataWranglerReplacementPolicy,
+    QueryCounter,
+)
 from integration_client import (
     CalculatesWorkPresentation,
     IntegrationClientCoverImageCoverageProvider,
@@ -62,6 +68,102 @@ class TestWorkPresentationCoverageProvider(DatabaseTest):
         # The work has been made presentation-ready.
         assert True == work.presentation_ready
 
+    def test_register_collapses_repeated_registrations(self):
+        work = self._work()
+        record, is_new = WorkPresentationCoverageProvider.register(
+            work, force=True
+        )
+        assert CoverageRecord.REGISTERED == record.status
+        original_timestamp = utc_now() - datetime.timedelta(minutes=5)
+        record.timestamp = original_timestamp
+
+        # Registering the work again while it's still waiting
+        # doesn't change anything -- in particular, it doesn't move
+        # the work to the back of the line.
+        record2, is_new = WorkPresentationCoverageProvider.register(
+            work, force=True
+        )
+        assert record == record2
+        assert False == is_new
+        assert original_timestamp == record.timestamp
+
+        # Once the work has been processed, it can be registered again.
+        record.status = CoverageRecord.SUCCESS
+        WorkPresentationCoverageProvider.register(work, force=True)
+        assert CoverageRecord.REGISTERED == record.status
+
+    def test_items_that_need_coverage_waits_for_debounce_window(self):
+        work = self._work()
+        record, is_new = WorkPresentationCoverageProvider.register(
+            work, force=True
+        )
+
+        # The work was just registered, so it's not processed yet.
+        assert [] == self.provider.items_that_need_coverage().all()
+
+        # Once the debounce window has passed, it is.
+        record.timestamp = (
+            utc_now() - WorkPresentationCoverageProvider.DEBOUNCE_WINDOW
+            - datetime.timedelta(seconds=1)
+        )
+        assert [work] == self.provider.items_that_need_coverage().all()
+
+        # A provider with no debounce window processes works
+        # immediately.
+        provider = WorkPresentationCoverageProvider(
+            self._db, debounce_window=None
+        )
+        record.timestamp = utc_now()
+        assert [work] == provider.items_that_need_coverage().all()
+
+
+    def test_preload(self):
+        works = [
+            self._work(authors=["Author %d" % i], with_license_pool=True)
+            for i in range(3)
+        ]
+        self._db.flush()
+        self._db.expire_all()
+
+        with QueryCounter(self._db) as counter:
+            result = self.provider.preload(works)
+        assert works == result
+        preload_queries = counter.count
+
+        # Once the works are preloaded, everything calculate_presentation
+        # looks at can be accessed without going back to the database.
+        with QueryCounter(self._db) as counter:
+            for work in works:
+                for pool in work.license_pools:
+                    edition = pool.presentation_edition
+                    [c.contributor.sort_name for c in edition.contributions]
+                    pool.identifier.classifications
+                    pool.identifier.measurements
+                    [l.resource for l in pool.identifier.links]
+                work.presentation_edition.contributions
+                work.coverage_records
+        assert 0 == counter.count
+
+        # The number of queries doesn't depend on the number of works.
+        more_works = works + [
+            self._work(authors=["Author %d" % i], with_license_pool=True)
+            for i in range(3, 10)
+        ]
+        self._db.flush()
+        self._db.expire_all()
+        with QueryCounter(self._db) as counter:
+            self.provider.preload(more_works)
+        assert preload_queries == counter.count
+
+    def test_process_batch(self):
+        works = [self._work(with_license_pool=True) for i in range(3)]
+        results = self.provider.process_batch(works)
+        assert works == results
+        for work in works:
+            assert True == work.presentation_ready
+            assert work.simple_opds_entry != None
+
+
 class TestCalculatesWorkPresentation(DatabaseTest):
 
     # Create a mock provider that uses the mixin.
@@ -0,0 +1,192 @@
+import datetime
+
+from . import DatabaseTest
+
+from core.model import DataSource
+from core.util.datetime_helpers import utc_now
+
+from model import (
+    ContributorVIAFCoverage,
+    CoverageSchedule,
+    VIAFCluster,
+)
+
+
+class TestCoverageSchedule(DatabaseTest):
+
+    def setup_method(self):
+        super(TestCoverageSchedule, self).setup_method()
+        self.source = DataSource.lookup(self._db, DataSource.GUTENBERG)
+
+    def test_for_record(self):
+        record = self._coverage_record(self._edition(), self.source)
+        schedule = CoverageSchedule.for_record(record)
+        assert record == schedule.coverage_record
+
+        # Calling for_record again returns the same object.
+        assert schedule == CoverageSchedule.for_record(record)
+
+    def test_prioritize(self):
+        record = self._coverage_record(self._edition(), self.source)
+
+        # Nothing happens if there's no record or no priority.
+        assert None == CoverageSchedule.prioritize(None, 10)
+        assert None == CoverageSchedule.prioritize(record, None)
+
+        # A record in the normal lane doesn't need a CoverageSchedule.
+        assert None == CoverageSchedule.prioritize(
+            record, CoverageSchedule.NORMAL_PRIORITY
+        )
+        assert [] == self._db.query(CoverageSchedule).all()
+
+        schedule = CoverageSchedule.prioritize(
+            record, CoverageSchedule.HIGH_PRIORITY
+        )
+        assert CoverageSchedule.HIGH_PRIORITY == schedule.priority
+
+        # A priority can be raised but not lowered.
+        CoverageSchedule.prioritize(record, CoverageSchedule.NORMAL_PRIORITY)
+        assert CoverageSchedule.HIGH_PRIORITY == schedule.priority
+        CoverageSchedule.prioritize(record, 20)
+        assert 20 == schedule.priority
+
+    def test_postpone_and_reset(self):
+        record = self._coverage_record(self._edition(), self.source)
+        now = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        delays = []
+        def retry_delay(attempts):
+            delays.append(attempts)
+            return datetime.timedelta(hours=attempts)
+
+        schedule = CoverageSchedule.postpone(record, retry_delay, now=now)
+        assert 1 == schedule.attempts
+        assert now + datetime.timedelta(hours=1) == schedule.next_attempt_time
+
+        CoverageSchedule.postpone(record, retry_delay, now=now)
+        assert 2 == schedule.attempts
+        assert now + datetime.timedelta(hours=2) == schedule.next_attempt_time
+        assert [1, 2] == delays
+
+        # If the delay function returns None, the record can be
+        # retried right away.
+        CoverageSchedule.postpone(record, lambda attempts: None)
+        assert 3 == schedule.attempts
+        assert None == schedule.next_attempt_time
+
+        # reset() starts the count over.
+        assert schedule == CoverageSchedule.reset(record)
+        assert 0 == schedule.attempts
+        assert None == schedule.next_attempt_time
+
+        # reset() doesn't create a CoverageSchedule where there
+        # wasn't one.
+        record2 = self._coverage_record(self._edition(), self.source)
+        assert None == CoverageSchedule.reset(record2)
+        assert None == CoverageSchedule.reset(None)
+
+    def test_deleted_with_coverage_record(self):
+        record = self._coverage_record(self._edition(), self.source)
+        schedule = CoverageSchedule.prioritize(
+            record, CoverageSchedule.HIGH_PRIORITY
+        )
+        self._db.flush()
+        self._db.delete(record)
+        self._db.flush()
+        self._db.expire_all()
+        assert [] == self._db.query(CoverageSchedule).all()
+
+
+class TestContributorVIAFCoverage(DatabaseTest):
+
+    def test_is_fresh(self):
+        now = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        day = datetime.timedelta(days=1)
+        coverage = ContributorVIAFCoverage()
+
+        # A Contributor that's waiting to be resolved doesn't need to
+        # be registered again.
+        coverage.status = ContributorVIAFCoverage.REGISTERED
+        coverage.timestamp = now - (1000 * day)
+        assert True == coverage.is_fresh(now)
+
+        # A match is good for a year; a miss for three months.
+        coverage.status = ContributorVIAFCoverage.MATCHED
+        coverage.timestamp = now - (300 * day)
+        assert True == coverage.is_fresh(now)
+        coverage.timestamp = now - (400 * day)
+        assert False == coverage.is_fresh(now)
+
+        coverage.status = ContributorVIAFCoverage.NOT_FOUND
+        coverage.timestamp = now - (30 * day)
+        assert True == coverage.is_fresh(now)
+        coverage.timestamp = now - (100 * day)
+        assert False == coverage.is_fresh(now)
+
+        # An error is only fresh for an hour.
+        coverage.status = ContributorVIAFCoverage.ERROR
+        coverage.timestamp = now
+        assert True == coverage.is_fresh(now)
+        coverage.timestamp = now - datetime.timedelta(hours=2)
+        assert False == coverage.is_fresh(now)
+
+    def test_register(self):
+        contributor = self._contributor()[0]
+        coverage, is_registered = ContributorVIAFCoverage.register(contributor)
+        assert True == is_registered
+        assert contributor == coverage.contributor
+        assert ContributorVIAFCoverage.REGISTERED == coverage.status
+
+        # Registering it again does nothing.
+        assert (coverage, False) == ContributorVIAFCoverage.register(
+            contributor
+        )
+
+        # Once the Contributor has been resolved, it's not registered
+        # again until the outcome goes stale.
+        coverage.record(ContributorVIAFCoverage.MATCHED, confidence=95)
+        assert 95 == coverage.confidence
+        assert (coverage, False) == ContributorVIAFCoverage.register(
+            contributor
+        )
+
+        coverage.timestamp = utc_now() - datetime.timedelta(days=400)
+        assert (coverage, True) == ContributorVIAFCoverage.register(
+            contributor
+        )
+        assert ContributorVIAFCoverage.REGISTERED == coverage.status
+        assert None == coverage.confidence
+
+        # An error is retried the next time the Contributor comes up,
+        # as long as it's not too recent.
+        coverage.record(ContributorVIAFCoverage.ERROR, exception="oops")
+        assert (coverage, False) == ContributorVIAFCoverage.register(
+            contributor
+        )
+        coverage.timestamp = utc_now() - datetime.timedelta(hours=2)
+        assert (coverage, True) == ContributorVIAFCoverage.register(
+            contributor
+        )
+        assert None == coverage.exception
+
+
+class TestVIAFCluster(DatabaseTest):
+
+    def test_store_and_is_fresh(self):
+        now = utc_now()
+        cluster = VIAFCluster.store(self._db, "123", "{}", 1, now)
+        day = datetime.timedelta(days=1)
+        assert True == cluster.is_fresh(day, 1)
+
+        # A summary in an old format is never fresh.
+        assert False == cluster.is_fresh(day, 2)
+
+        # Neither is an old summary.
+        assert False == cluster.is_fresh(day, 1, now=now + (2 * day))
+
+        # Storing a new summary replaces the old one.
+        assert cluster == VIAFCluster.store(
+            self._db, "123", '{"viaf":"123"}', 2
+        )
+        assert '{"viaf":"123"}' == cluster.summary
+        assert 2 == cluster.version
+        assert True == cluster.is_fresh(day, 2)
@@ -1,9 +1,33 @@
+import datetime
+import shutil
+import tempfile
+
 from . import DatabaseTest
 
-from core.model import Subject
+from core.model import (
+    DataSource,
+    Identifier,
+    Representation,
+    Subject,
+    WorkCoverageRecord,
+)
+from core.metadata_layer import ContributorData
+from core.util.datetime_helpers import utc_now
 
+from blobstore import BlobStore
+from compression import (
+    decompress,
+    is_compressed,
+    representation_content,
+)
+from integration_client import WorkPresentationCoverageProvider
+from model import ContributorVIAFCoverage
 from monitor import (
+    AuthorityIndexSweep,
+    ContributorVIAFSweep,
+    EquivalencyClosureSweep,
     FASTNameAssignmentMonitor,
+    RepresentationCompressionSweep,
 )
 
 
@@ -66,3 +90,243 @@ class TestFASTNameAssignmentMonitor(DatabaseTest):
         # been processed.
         assert "FAST Name 1" == fast1.name
         assert "LCSH Name 1" == lcsh1.name
+
+
+class TestContributorVIAFSweep(DatabaseTest):
+
+    class MockVIAF(object):
+        def __init__(self):
+            self.results = []
+            self.processed = []
+            # Maps a duplicate Contributor to the one it's merged into.
+            self.merges = {}
+
+        def process_contributor(self, contributor):
+            self.processed.append(contributor)
+            result = self.results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            survivor = self.merges.get(contributor)
+            if survivor:
+                contributor.merge_into(survivor)
+                return survivor, result
+            return contributor, result
+
+    def setup_method(self):
+        super(TestContributorVIAFSweep, self).setup_method()
+        self.viaf = self.MockVIAF()
+        self.monitor = ContributorVIAFSweep(self._db, viaf=self.viaf)
+
+    def test_item_query(self):
+        registered = self._contributor()[0]
+        ContributorVIAFCoverage.register(registered)
+
+        error = self._contributor()[0]
+        coverage, ignore = ContributorVIAFCoverage.register(error)
+        an_hour_ago = utc_now() - datetime.timedelta(hours=1, minutes=1)
+        coverage.record(ContributorVIAFCoverage.ERROR, now=an_hour_ago)
+
+        # This Contributor's error is too recent to retry yet.
+        recent_error = self._contributor()[0]
+        coverage, ignore = ContributorVIAFCoverage.register(recent_error)
+        coverage.record(ContributorVIAFCoverage.ERROR)
+
+        matched = self._contributor()[0]
+        coverage, ignore = ContributorVIAFCoverage.register(matched)
+        coverage.record(ContributorVIAFCoverage.MATCHED)
+
+        # This Contributor was never registered.
+        self._contributor()
+
+        qu = self.monitor.item_query()
+        assert set([registered, error]) == set(qu.all())
+
+        # With no retry delay, every error is retried.
+        self.monitor.RETRY_DELAY = None
+        qu = self.monitor.item_query()
+        assert set([registered, error, recent_error]) == set(qu.all())
+
+    def test_process_item_match(self):
+        work = self._work(authors=["Author"], with_license_pool=True)
+        [contributor] = work.presentation_edition.contributors
+        ContributorVIAFCoverage.register(contributor)
+
+        self.viaf.results.append(
+            (ContributorData(), dict(total=92), ["A Title"])
+        )
+        self.monitor.process_item(contributor)
+        assert [contributor] == self.viaf.processed
+
+        [coverage] = self._db.query(ContributorVIAFCoverage).all()
+        assert ContributorVIAFCoverage.MATCHED == coverage.status
+        assert 92 == coverage.confidence
+
+        # The Contributor's Work was registered to have its
+        # presentation recalculated.
+        record = WorkCoverageRecord.lookup(
+            work, WorkPresentationCoverageProvider.OPERATION
+        )
+        assert WorkCoverageRecord.REGISTERED == record.status
+
+    def test_process_item_merged_into_duplicate(self):
+        earlier = self._contributor()[0]
+        coverage, ignore = ContributorVIAFCoverage.register(earlier)
+        coverage.record(ContributorVIAFCoverage.NOT_FOUND)
+
+        work = self._work(authors=["Duplicate"], with_license_pool=True)
+        [duplicate] = work.presentation_edition.contributors
+        ContributorVIAFCoverage.register(duplicate)
+        self._db.commit()
+
+        # VIAF finds that the Contributor is the same person as an
+        # earlier one, and merges them.
+        self.viaf.merges[duplicate] = earlier
+        self.viaf.results.append(
+            (ContributorData(), dict(total=95), ["A Title"])
+        )
+        self.monitor.run()
+        assert [duplicate] == self.viaf.processed
+
+        # The earlier Contributor has the outcome.
+        [coverage] = self._db.query(ContributorVIAFCoverage).all()
+        assert earlier == coverage.contributor
+        assert ContributorVIAFCoverage.MATCHED == coverage.status
+        assert 95 == coverage.confidence
+        assert [] == self.monitor.item_query().all()
+
+        # The Work is now credited to the earlier Contributor, and was
+        # registered to have its presentation recalculated.
+        assert set([earlier]) == work.presentation_edition.contributors
+        record = WorkCoverageRecord.lookup(
+            work, WorkPresentationCoverageProvider.OPERATION
+        )
+        assert WorkCoverageRecord.REGISTERED == record.status
+
+    def test_process_item_no_match(self):
+        contributor = self._contributor()[0]
+        self.viaf.results.append(None)
+        self.monitor.process_item(contributor)
+        [coverage] = self._db.query(ContributorVIAFCoverage).all()
+        assert ContributorVIAFCoverage.NOT_FOUND == coverage.status
+        assert None == coverage.confidence
+
+    def test_process_item_error(self):
+        contributor = self._contributor()[0]
+        self.viaf.results.append(IOError("VIAF is down"))
+        self.monitor.process_item(contributor)
+        [coverage] = self._db.query(ContributorVIAFCoverage).all()
+        assert ContributorVIAFCoverage.ERROR == coverage.status
+        assert "VIAF is down" in coverage.exception
+
+
+class TestAuthorityIndexSweep(DatabaseTest):
+
+    def test_item_query(self):
+        monitor = AuthorityIndexSweep(self._db)
+
+        twain, ignore = self._contributor(sort_name="Twain, Mark")
+        twain.display_name = "Mark Twain"
+
+        # This Contributor can't be indexed, since it has no display
+        # name.
+        no_display_name, ignore = self._contributor(sort_name="Anonymous")
+        no_display_name.display_name = None
+
+        # Only the Contributor that hasn't been indexed yet needs to be
+        # processed.
+        assert [twain] == monitor.item_query().all()
+        monitor.process_item(twain)
+        self._db.flush()
+        assert [] == monitor.item_query().all()
+
+        # Once its names change, it needs to be indexed again.
+        twain.display_name = "Samuel Clemens"
+        assert [twain] == monitor.item_query().all()
+        monitor.process_item(twain)
+        self._db.flush()
+        assert [] == monitor.item_query().all()
+        assert "Twain, Mark" == monitor.index.lookup("Samuel Clemens")
+
+        # That includes losing a name, which takes it out of the index.
+        twain.sort_name = None
+        assert [twain] == monitor.item_query().all()
+        monitor.process_item(twain)
+        self._db.flush()
+        assert [] == monitor.item_query().all()
+        assert None == monitor.index.lookup("Samuel Clemens")
+
+
+class TestEquivalencyClosureSweep(DatabaseTest):
+
+    def test_item_query(self):
+        monitor = EquivalencyClosureSweep(self._db)
+        source = DataSource.lookup(self._db, DataSource.OCLC)
+        isbn = self._identifier(identifier_type=Identifier.ISBN)
+        number = self._identifier(identifier_type=Identifier.OCLC_NUMBER)
+        other = self._identifier(identifier_type=Identifier.OCLC_NUMBER)
+
+        # An Equivalency too weak to be kept in the closure never
+        # needs to be processed.
+        isbn.equivalent_to(source, other, 0.1)
+
+        # An Equivalency that was created outside the index needs to
+        # be processed.
+        equivalency = isbn.equivalent_to(source, number, 0.6)
+        self._db.flush()
+        assert [equivalency] == monitor.item_query().all()
+        monitor.process_item(equivalency)
+        assert [] == monitor.item_query().all()
+        assert {isbn.id: [isbn.id, number.id]} == (
+            monitor.index.equivalent_ids([isbn.id])
+        )
+
+        # Once it gets stronger, it needs to be processed again.
+        equivalency.strength = 0.9
+        self._db.flush()
+        assert [equivalency] == monitor.item_query().all()
+        monitor.process_item(equivalency)
+        assert [] == monitor.item_query().all()
+
+
+class TestRepresentationCompressionSweep(DatabaseTest):
+
+    def test_process_item(self):
+        document = b"<cluster>" + (b"<name>Kaling, Mindy</name>" * 100) + b"</cluster>"
+        representation, ignore = self._representation(
+            url="http://viaf.org/viaf/9581122/viaf.xml",
+            media_type=Representation.TEXT_XML_MEDIA_TYPE, content=document
+        )
+        monitor = RepresentationCompressionSweep(self._db)
+        assert [representation] == monitor.item_query().all()
+
+        monitor.process_item(representation)
+        assert True == is_compressed(representation.content)
+        assert document == decompress(representation.content)
+
+        # Now that it's compressed, it won't be processed again.
+        self._db.flush()
+        assert [] == monitor.item_query().all()
+
+    def test_process_item_with_blob_store(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = BlobStore(directory, 1024 * 1024)
+            document = b"<cluster>" + (b"<name>Kaling, Mindy</name>" * 100) + b"</cluster>"
+            representation, ignore = self._representation(
+                url="http://viaf.org/viaf/9581122/viaf.xml",
+                media_type=Representation.TEXT_XML_MEDIA_TYPE, content=document
+            )
+            monitor = RepresentationCompressionSweep(
+                self._db, blob_store=store
+            )
+            assert [representation] == monitor.item_query().all()
+
+            # The document is compressed and moved to the blob store.
+            monitor.process_item(representation)
+            assert True == BlobStore.is_reference(representation.content)
+            assert document == representation_content(representation, store)
+
+            self._db.flush()
+            assert [] == monitor.item_query().all()
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,51 @@
+from core.util import personal_names as core_personal_names
+
+import personal_names
+from personal_names import (
+    contributor_name_match_ratio,
+    display_name_to_sort_name,
+    name_tidy,
+)
+
+
+class TestMemoizedNames(object):
+
+    def test_same_results_as_core(self):
+        for name in ("Mindy Kaling", "Twain, Mark", "Bob Jones, Jr.", ""):
+            for f in personal_names.MEMOIZED[1:]:
+                original = getattr(core_personal_names, f.__name__)
+                assert original(name) == f(name)
+                assert original(name) == f(name)
+
+        assert (
+            core_personal_names.contributor_name_match_ratio(
+                "Kaling, Mindy", "Mindy Kaling"
+            ) == contributor_name_match_ratio("Kaling, Mindy", "Mindy Kaling")
+        )
+        assert (
+            core_personal_names.contributor_name_match_ratio(
+                "Kaling, Mindy", "Mindy Kaling", normalize_names=False
+            ) == contributor_name_match_ratio(
+                "Kaling, Mindy", "Mindy Kaling", normalize_names=False
+            )
+        )
+
+    def test_statistics(self):
+        for f in personal_names.MEMOIZED:
+            f.cache.clear()
+            f.cache.hits = f.cache.misses = 0
+
+        name_tidy("Kaling, Mindy")
+        name_tidy("Kaling, Mindy")
+        display_name_to_sort_name("Mindy Kaling")
+
+        stats = personal_names.statistics()
+        assert (dict(hits=1, misses=1, hit_rate=0.5, size=1) ==
+                stats['name_tidy'])
+        assert (dict(hits=0, misses=1, hit_rate=0, size=1) ==
+                stats['display_name_to_sort_name'])
+        assert (dict(hits=0, misses=0, hit_rate=None, size=0) ==
+                stats['normalize_contributor_name_for_matching'])
+
+        description = personal_names.describe_statistics()
+        assert "name_tidy: 1 hits, 1 misses, 1 cached" in description
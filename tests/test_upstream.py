@@ -0,0 +1,433 @@
+import datetime
+import threading
+
+import pytest
+
+from . import DatabaseTest
+
+from core.util.datetime_helpers import utc_now
+
+from model import (
+    UpstreamCircuit,
+    UpstreamRateLimit,
+)
+import upstream
+from upstream import (
+    CircuitBreaker,
+    MockCircuitBreaker,
+    MockRateLimiter,
+    Prefetcher,
+    RateLimiter,
+    UpstreamUnavailable,
+    execute,
+    protect,
+)
+
+
+class TestExecute(object):
+
+    def test_execute(self, monkeypatch):
+        """Outside of tests, statements run on a connection of their
+        own, even when the session is bound to a Connection.
+        """
+        calls = []
+
+        class Result(object):
+            def fetchone(self):
+                return ("row",)
+
+        class MockConnection(object):
+            def execute(self, statement, **params):
+                calls.append(("own connection", statement, params))
+                return Result()
+
+        class Transaction(object):
+            def __enter__(self):
+                calls.append("begin")
+                return MockConnection()
+            def __exit__(self, *args):
+                calls.append("commit")
+
+        class MockEngine(object):
+            def begin(self):
+                return Transaction()
+
+        class MockBind(object):
+            engine = MockEngine()
+
+        class MockSession(object):
+            def get_bind(self):
+                return MockBind()
+            def execute(self, statement, params):
+                calls.append(("session", statement, params))
+                return Result()
+
+        monkeypatch.setattr(upstream, 'IN_CALLER_TRANSACTION', False)
+        assert ("row",) == execute(MockSession(), "statement", host="a")
+        assert [
+            "begin", ("own connection", "statement", dict(host="a")), "commit"
+        ] == calls
+
+        # Tests keep everything in the caller's transaction.
+        del calls[:]
+        monkeypatch.setattr(upstream, 'IN_CALLER_TRANSACTION', True)
+        execute(MockSession(), "statement", host="a")
+        assert [("session", "statement", dict(host="a"))] == calls
+
+
+class TestRateLimiter(DatabaseTest):
+
+    def setup_method(self):
+        super(TestRateLimiter, self).setup_method()
+        self.sleeps = []
+        self.limiter = RateLimiter(
+            self._db, rates={'example.com' : (1, 2)},
+            sleep=self.sleeps.append
+        )
+
+    def test_host_for(self):
+        m = RateLimiter.host_for
+        assert 'viaf.org' == m('http://viaf.org/viaf/123/viaf.xml')
+        assert 'www.worldcat.org' == m('http://WWW.worldcat.org/isbn/1')
+        assert 'not a url' == m('not a url')
+
+    def test_rate_for(self):
+        assert (1, 2) == self.limiter.rate_for('example.com')
+        assert RateLimiter.RATES['viaf.org'] == self.limiter.rate_for('viaf.org')
+        assert RateLimiter.DEFAULT_RATE == self.limiter.rate_for('other.com')
+
+    def test_acquire(self):
+        url = 'http://example.com/a'
+
+        # The bucket starts out full, so the first two requests don't
+        # have to wait.
+        assert 0 == self.limiter.acquire(url)
+        assert 0 == self.limiter.acquire(url)
+        assert [] == self.sleeps
+
+        # The third request has to wait about a second for a token to
+        # come back.
+        waited = self.limiter.acquire(url)
+        assert 0.9 < waited <= 1
+        assert [waited] == self.sleeps
+
+        # The state of the bucket is kept in the database, where every
+        # process can see it.
+        [limit] = self._db.query(UpstreamRateLimit).all()
+        assert 'example.com' == limit.host
+        assert 3 == limit.requests
+        assert limit.tokens < 0
+        assert 0.9 < limit.seconds_waited <= 1
+
+        # A different host has its own bucket.
+        assert 0 == self.limiter.acquire('http://viaf.org/')
+
+    def test_wrap(self):
+        calls = []
+        def do_get(url, *args, **kwargs):
+            calls.append((url, args, kwargs))
+            return "response"
+
+        limited = self.limiter.wrap(do_get)
+        assert "response" == limited('http://example.com/', 'h', timeout=5)
+        assert [('http://example.com/', ('h',), dict(timeout=5))] == calls
+        [limit] = self._db.query(UpstreamRateLimit).all()
+        assert 1 == limit.requests
+
+    def test_effective_rates(self):
+        self.limiter.acquire('http://example.com/')
+        self.limiter.acquire('http://example.com/')
+        [(host, requests, per_second, waited)] = RateLimiter.effective_rates(
+            self._db, reset=True
+        )
+        assert 'example.com' == host
+        assert 2 == requests
+        assert per_second > 0
+        assert 0 == waited
+
+        # The counters were reset.
+        [(host, requests, per_second, waited)] = RateLimiter.effective_rates(
+            self._db
+        )
+        assert 0 == requests
+
+
+class TestMockRateLimiter(object):
+
+    def test_acquire(self):
+        limiter = MockRateLimiter()
+        limited = limiter.wrap(lambda url: url.upper())
+        assert 'HTTP://A/' == limited('http://a/')
+        assert ['http://a/'] == limiter.requests
+
+
+class TestCircuitBreaker(DatabaseTest):
+
+    def setup_method(self):
+        super(TestCircuitBreaker, self).setup_method()
+        self.breaker = CircuitBreaker(self._db)
+        self.breaker.FAILURE_THRESHOLD = 2
+        self.url = 'http://example.com/'
+
+    def circuit(self):
+        self._db.expire_all()
+        return self._db.query(UpstreamCircuit).one()
+
+    def test_open_and_close(self):
+        # A host we've never had trouble with is fine.
+        assert 0 == self.breaker.check(self.url)
+        assert False == self.breaker.is_open(self.url)
+
+        # One failure isn't enough to open the circuit.
+        assert 1 == self.breaker.record_failure(self.url)
+        assert 1 == self.breaker.check(self.url)
+        assert False == self.breaker.is_open(self.url)
+
+        # Two is.
+        assert 2 == self.breaker.record_failure(self.url)
+        assert True == self.breaker.is_open(self.url)
+        with pytest.raises(UpstreamUnavailable) as excinfo:
+            self.breaker.check(self.url)
+        assert "example.com has failed 2 times in a row" in str(excinfo.value)
+
+        # Other hosts aren't affected.
+        assert 0 == self.breaker.check('http://viaf.org/')
+
+        # Once the cooldown is over, the circuit is half-open: one
+        # probe is allowed through.
+        circuit = self.circuit()
+        circuit.open_until = utc_now() - datetime.timedelta(seconds=1)
+        self._db.flush()
+        assert False == self.breaker.is_open(self.url)
+        assert 2 == self.breaker.check(self.url)
+
+        # But only one.
+        with pytest.raises(UpstreamUnavailable):
+            self.breaker.check(self.url)
+
+        # If the probe succeeds, the circuit closes.
+        self.breaker.record_success(self.url)
+        circuit = self.circuit()
+        assert 0 == circuit.failures
+        assert None == circuit.open_until
+        assert 0 == self.breaker.check(self.url)
+
+    def test_changes_go_through_execute(self, monkeypatch):
+        # Every statement runs through execute(), which commits it on
+        # a connection of its own outside of tests.
+        statements = []
+        real_execute = upstream.execute
+        def recording_execute(_db, statement, **params):
+            statements.append(statement)
+            return real_execute(_db, statement, **params)
+        monkeypatch.setattr(upstream, 'execute', recording_execute)
+
+        self.breaker.record_failure(self.url)
+        self.breaker.record_failure(self.url)
+        circuit = self.circuit()
+        circuit.open_until = utc_now() - datetime.timedelta(seconds=1)
+        self._db.flush()
+        self.breaker.check(self.url)
+        self.breaker.record_success(self.url)
+        assert [
+            CircuitBreaker.RECORD_FAILURE, CircuitBreaker.RECORD_FAILURE,
+            CircuitBreaker.CHECK, CircuitBreaker.CLAIM_PROBE,
+            CircuitBreaker.RECORD_SUCCESS,
+        ] == statements
+
+    def test_failed_probe_reopens_circuit(self):
+        self.breaker.record_failure(self.url)
+        self.breaker.record_failure(self.url)
+        circuit = self.circuit()
+        circuit.open_until = utc_now() - datetime.timedelta(seconds=1)
+        circuit.last_failure = utc_now() - datetime.timedelta(days=1)
+        self._db.flush()
+
+        self.breaker.check(self.url)
+        self.breaker.record_failure(self.url)
+        assert True == self.breaker.is_open(self.url)
+
+    def test_failures_must_be_close_together(self):
+        self.breaker.record_failure(self.url)
+        circuit = self.circuit()
+        circuit.last_failure = utc_now() - datetime.timedelta(days=1)
+        self._db.flush()
+
+        # The earlier failure was a long time ago, so the count
+        # starts over.
+        assert 1 == self.breaker.record_failure(self.url)
+        assert False == self.breaker.is_open(self.url)
+
+    def test_is_failure(self):
+        m = CircuitBreaker.is_failure
+        assert False == m((200, {}, b"ok"))
+        assert False == m((404, {}, b"not found"))
+        assert True == m((503, {}, b"down"))
+
+        class Response(object):
+            def __init__(self, status_code):
+                self.status_code = status_code
+        assert False == m(Response(200))
+        assert True == m(Response(500))
+
+    def test_wrap(self):
+        responses = []
+        def do_get(url):
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        guarded = self.breaker.wrap(do_get)
+
+        # An exception is recorded as a failure and passed along.
+        responses.append(IOError("timed out"))
+        with pytest.raises(IOError):
+            guarded(self.url)
+        assert 1 == self.circuit().failures
+
+        # A success clears it.
+        responses.append((200, {}, b"ok"))
+        assert (200, {}, b"ok") == guarded(self.url)
+        assert 0 == self.circuit().failures
+
+        # Two server errors in a row open the circuit, and after that
+        # the function isn't called at all.
+        responses.extend([(500, {}, b""), (500, {}, b""), "not used"])
+        guarded(self.url)
+        guarded(self.url)
+        with pytest.raises(UpstreamUnavailable):
+            guarded(self.url)
+        assert ["not used"] == responses
+
+
+class TestProtect(object):
+
+    def test_protect(self):
+        breaker = MockCircuitBreaker()
+        limiter = MockRateLimiter()
+        guarded = protect(lambda url: url.upper(), breaker, limiter)
+        assert 'HTTP://A/' == guarded('http://a/')
+        assert ['http://a/'] == limiter.requests
+
+        assert False == breaker.is_open('http://a/')
+        breaker.open.add('a')
+        assert True == breaker.is_open('http://a/')
+
+
+class TestPrefetcher(object):
+
+    def test_prefetch(self):
+        calls = []
+        def do_get(url, *args, **kwargs):
+            calls.append((url, args))
+            if url == 'http://b/':
+                raise IOError("oops")
+            return url.upper()
+
+        with Prefetcher(max_workers=2) as prefetcher:
+            prefetcher.prefetch(do_get, ['http://a/', 'http://b/'], {})
+
+            # A URL that's already been sent for isn't sent for again.
+            prefetcher.prefetch(do_get, ['http://a/'], {})
+
+            # The outcomes are served by the wrapped function, once each.
+            get = prefetcher.wrap(do_get)
+            assert 'HTTP://A/' == get('http://a/', {})
+            with pytest.raises(IOError):
+                get('http://b/', {})
+            assert [
+                ('http://a/', ({},)), ('http://b/', ({},))
+            ] == sorted(calls)
+
+            # After that, and for any other URL, the request goes out as
+            # usual.
+            assert 'HTTP://A/' == get('http://a/', {})
+            assert 'HTTP://C/' == get('http://c/', {})
+            assert [('http://a/', ({},)), ('http://c/', ({},))] == calls[2:]
+
+            # A prefetched response isn't used by a request with
+            # different arguments.
+            prefetcher.prefetch(do_get, ['http://d/'], {})
+            assert 'HTTP://D/' == get('http://d/', {'Accept': 'text/xml'})
+            assert ('http://d/', ({'Accept': 'text/xml'},)) == calls[-1]
+            assert {} == prefetcher.responses
+
+            # But conditional headers, sent for a stale cached copy,
+            # don't make a difference.
+            prefetcher.prefetch(do_get, ['http://e/'], {})
+            headers = {'If-None-Match': '"etag"', 'If-Modified-Since': 'x'}
+            assert 'HTTP://E/' == get('http://e/', headers)
+            assert ('http://e/', ({},)) == calls[-1]
+            assert 1 == len([x for x in calls if x[0] == 'http://e/'])
+
+        assert None == prefetcher.executor
+
+    def test_guards_run_in_calling_thread(self):
+        class Breaker(MockCircuitBreaker):
+            def __init__(self):
+                super(Breaker, self).__init__()
+                self.events = []
+            def check(self, url):
+                self.events.append(('check', url, threading.current_thread()))
+                return super(Breaker, self).check(url)
+            def record_failure(self, url):
+                self.events.append(('failure', url, threading.current_thread()))
+                return 1
+
+        breaker = Breaker()
+        breaker.open.add('c')
+        limiter = MockRateLimiter()
+        threads = []
+        def do_get(url, *args, **kwargs):
+            threads.append(threading.current_thread())
+            if url == 'http://b/':
+                raise IOError("oops")
+            return (200, {}, url)
+
+        main = threading.current_thread()
+        with Prefetcher(2, limiter, breaker) as prefetcher:
+            prefetcher.prefetch(do_get, ['http://a/', 'http://b/', 'http://c/'])
+
+            # The circuit was checked and a rate-limit token taken for
+            # each request in this thread. No request was sent to the
+            # host whose circuit is open.
+            assert ['http://a/', 'http://b/'] == limiter.requests
+            assert [
+                ('check', 'http://a/', main), ('check', 'http://b/', main),
+                ('check', 'http://c/', main),
+            ] == breaker.events
+            assert 'http://c/' not in prefetcher.responses
+
+            # The failure is recorded in this thread when the response
+            # is picked up.
+            get = prefetcher.wrap(do_get)
+            assert (200, {}, 'http://a/') == get('http://a/')
+            with pytest.raises(IOError):
+                get('http://b/')
+            assert ('failure', 'http://b/', main) == breaker.events[-1]
+
+        # Only the requests themselves went out in worker threads.
+        assert 2 == len(threads)
+        assert main not in threads
+
+    def test_close(self):
+        started = threading.Event()
+        finish = threading.Event()
+        calls = []
+        def do_get(url, *args, **kwargs):
+            calls.append(url)
+            started.set()
+            finish.wait(5)
+            return url
+
+        prefetcher = Prefetcher(max_workers=1)
+        prefetcher.prefetch(do_get, ['http://a/', 'http://b/'])
+        started.wait(5)
+
+        # Closing the Prefetcher doesn't wait for the request in
+        # progress, and the one that hasn't started never does.
+        prefetcher.close()
+        assert {} == prefetcher.responses
+        finish.set()
+        assert ['http://a/'] == calls
@@ -1,5 +1,13 @@
 # encoding: utf-8
+import datetime
+import gzip
 import logging
+import os
+import shutil
+import tempfile
+
+import pytest
+from lxml import etree
 
 from . import (
     DatabaseTest,
@@ -9,14 +17,51 @@ from . import (
 
 from core.metadata_layer import ContributorData
 from core.model import Contributor
+from core.util.datetime_helpers import utc_now
+from core.util.titles import (
+    title_match_ratio,
+    unfluff_title,
+)
 
+from compression import representation_content
+from model import VIAFCluster
 from testing import MockVIAFClient
+from upstream import (
+    MockCircuitBreaker,
+    MockRateLimiter,
+)
 from viaf import (
     NameParser,
+    TitleMatcher,
+    VIAFClusterSummary,
+    VIAFDumpIndex,
     VIAFParser,
     VIAFClient
 )
 
+
+def write_viaf_dump(path, *filenames):
+    """Write the clusters in sample VIAF documents to a gzipped dump,
+    one per line, the way VIAF publishes them.
+
+    :return: The clusters, in the order they were written.
+    """
+    clusters = []
+    with gzip.open(path, 'wt', encoding="utf-8") as dump:
+        for filename in filenames:
+            # Without the whitespace between elements, and with
+            # newlines in text escaped, each cluster fits on one line.
+            tree = etree.fromstring(
+                sample_data(filename, "viaf"),
+                parser=etree.XMLParser(recover=True, remove_blank_text=True)
+            )
+            for cluster in VIAFParser.CLUSTERS(tree):
+                viaf = VIAFParser().summarize(cluster).viaf
+                xml = etree.tostring(cluster, encoding="unicode")
+                dump.write("%s\t%s\n" % (viaf, xml.replace("\n", "&#10;")))
+                clusters.append(cluster)
+    return clusters
+
 class TestNameParser(object):
     """Test the NameParser class."""
 
@@ -263,6 +308,166 @@ class TestVIAFNameParser(DatabaseTest):
         assert match_confidences['library_popularity'] == 4
 
 
+    def test_summarize(self):
+        xml = self.sample_data("mindy_kaling.xml")
+        cluster = etree.fromstring(xml, parser=etree.XMLParser(recover=True))
+        summary = self.parser.summarize(cluster)
+        assert "9581122" == summary.viaf
+        assert "Kaling, Mindy" in summary.sort_names
+        assert 1 == len(summary.unimarc_names)
+        assert summary.alternate_names
+        assert ("Is everyone hanging out without me? (and other concerns), c2011:"
+                in summary.titles)
+
+        # The Wikipedia link in this cluster is really a Wikidata ID,
+        # so it's ignored.
+        assert None == summary.wikipedia_name
+
+        # A summary is returned as-is.
+        assert summary == self.parser.summarize(summary)
+
+        # A summary survives a round trip through JSON.
+        assert summary == VIAFClusterSummary.from_json(summary.to_json())
+
+        # Working from the summary gives the same results as working
+        # from the XML.
+        for names in (("Kaling, Mindy", None), (None, "Mindy Kaling"),
+                      ("Chokalingam, Vera", "Vera Chokalingam")):
+            from_xml = self.parser.extract_viaf_info(cluster, *names)
+            from_summary = self.parser.extract_viaf_info(summary, *names)
+            assert from_xml[0].__dict__ == from_summary[0].__dict__
+            assert from_xml[1:] == from_summary[1:]
+
+    def test_summarize_matches_field_by_field_extraction(self):
+        # summarize() walks each cluster once. It finds the same
+        # things as the methods that pick out one field at a time.
+        parser = self.parser
+        for filename in (
+            "amy_levin_all_viaf.xml", "john_jewel_all_viaf.xml",
+            "mark_twain.xml", "mindy_kaling.xml", "palmer.xml",
+            "will_eisner.xml",
+        ):
+            tree = etree.fromstring(
+                self.sample_data(filename),
+                parser=etree.XMLParser(recover=True)
+            )
+            clusters = parser.CLUSTERS(tree) or [tree]
+            for cluster in clusters:
+                summary = parser.summarize(cluster)
+                viaf_tag = parser._xpath1(
+                    cluster, './/*[local-name()="viafID"]'
+                )
+                assert viaf_tag.text == summary.viaf
+                assert (parser.extract_wikipedia_name(cluster) ==
+                        summary.wikipedia_name)
+                assert (list(parser.sort_names_for_cluster(cluster)) ==
+                        summary.sort_names)
+                assert (list(parser.name_titles_for_cluster(cluster)) ==
+                        summary.name_titles)
+                assert (list(parser.alternate_name_forms_for_cluster(cluster)) ==
+                        summary.alternate_names)
+                unimarcs = parser._xpath(
+                    cluster, './/*[local-name()="datafield"][@dtype="UNIMARC"]'
+                )
+                assert ([parser.extract_name_from_unimarc(x) for x in unimarcs] ==
+                        summary.unimarc_names)
+                titles = parser._xpath(
+                    cluster, './/*[local-name()="titles"]/*[local-name()="work"]/*[local-name()="title"]'
+                )
+                assert [x.text for x in titles] == summary.titles
+
+    def test_max_possible_weight(self):
+        m = VIAFParser.max_possible_weight
+        best = m(1)
+        assert VIAFParser.MAX_NAME_WEIGHT - 10 == best
+
+        # Less popular candidates can't weigh as much.
+        assert VIAFParser.MAX_NAME_WEIGHT - 110 == m(11)
+
+        # Unless popularity is being ignored.
+        assert VIAFParser.MAX_NAME_WEIGHT == m(11, ignore_popularity=True)
+
+        # Every known title could add weight.
+        assert (
+            VIAFParser.MAX_NAME_WEIGHT + 2 * VIAFParser.MAX_TITLE_WEIGHT - 10
+            == m(1, ["a", "b"])
+        )
+
+        # No real candidate weighs more than the maximum.
+        xml = self.sample_data("john_jewel_all_viaf.xml")
+        name = "Jewel, John"
+        titles = ["The Apology of the Church of England"]
+        for candidate in self.parser.parse_multiple(xml, working_sort_name=name):
+            weight = self.parser.weigh_contributor(
+                candidate, name, known_titles=titles
+            )
+            assert weight <= m(
+                candidate[1]['library_popularity'], known_titles=titles
+            )
+
+    def test_weigh_candidates(self):
+        # Weighing candidates in a batch gives the same weights, and so
+        # the same ranking, as weighing them one at a time.
+        for filename, name, titles in (
+            ("john_jewel_all_viaf.xml", "Jewel, John",
+             ["The Apology of the Church of England", "An apologie"]),
+            ("amy_levin_all_viaf.xml", "Levin, Amy",
+             ["Faithfully Feminist", "Defining memory"]),
+        ):
+            xml = self.sample_data(filename)
+            for strict in (False, True):
+                one_at_a_time = self.parser.parse_multiple(
+                    xml, working_sort_name=name
+                )
+                expect = [
+                    self.parser.weigh_contributor(
+                        candidate, name, known_titles=titles, strict=strict
+                    )
+                    for candidate in one_at_a_time
+                ]
+
+                matcher = TitleMatcher()
+                batch = self.parser.parse_multiple(xml, working_sort_name=name)
+                assert expect == self.parser.weigh_candidates(
+                    batch, name, known_titles=titles, strict=strict,
+                    matcher=matcher
+                )
+                assert ([x[1] for x in one_at_a_time] ==
+                        [x[1] for x in batch])
+
+                # The matcher remembers the comparisons it made.
+                if not strict:
+                    assert matcher.ratios
+                    assert set(titles).issubset(matcher.unfluffed)
+
+                def viafs(candidates):
+                    return [x[0].viaf for x in candidates]
+                by_weight = sorted(
+                    zip(expect, one_at_a_time), key=lambda x: x[0],
+                    reverse=True
+                )
+                ordered = self.parser.order_candidates(
+                    batch, name, known_titles=titles, strict=strict
+                )
+                # The fixture is already in popularity order, so
+                # order_candidates' first sort doesn't change it.
+                assert viafs([x[1] for x in by_weight]) == viafs(ordered)
+
+    def test_title_matcher(self):
+        matcher = TitleMatcher()
+        ratio = matcher.ratio("Pride and Prejudice", "Pride & Prejudice")
+        assert ratio == title_match_ratio("Pride and Prejudice", "Pride & Prejudice")
+        assert {("Pride and Prejudice", "Pride & Prejudice"): ratio} == matcher.ratios
+
+        # A memoized value is reused rather than calculated again.
+        matcher.ratios[("Pride and Prejudice", "Emma")] = 12
+        assert 12 == matcher.ratio("Pride and Prejudice", "Emma")
+
+        unfluffed = matcher.unfluff("Pride and Prejudice (Unabridged)")
+        assert unfluffed == unfluff_title("Pride and Prejudice (Unabridged)")
+        matcher.unfluffed["Emma"] = "Emma Woodhouse"
+        assert "Emma Woodhouse" == matcher.unfluff("Emma")
+
     def test_birthdates(self):
         # TODO: waiting on https://github.com/NYPL-Simplified/Simplified/issues/61
         # Good for testing separating authors by birth dates -- VIAF has several Amy Levins, with different birthdates.
@@ -284,6 +489,138 @@ class TestVIAFNameParser(DatabaseTest):
         # make sure birthdate is 1986
 
 
+class TestVIAFDumpIndex(object):
+
+    def setup_method(self):
+        self.directory = tempfile.mkdtemp()
+        self.dump_directory = os.path.join(
+            self.directory, VIAFDumpIndex.SUBDIR
+        )
+        os.mkdir(self.dump_directory)
+        self.dump = os.path.join(self.dump_directory, "clusters.xml.gz")
+
+    def teardown_method(self):
+        shutil.rmtree(self.directory)
+
+    def test_from_data_directory(self):
+        [mindy, twain] = write_viaf_dump(
+            self.dump, "mindy_kaling.xml", "mark_twain.xml"
+        )
+        index = VIAFDumpIndex.from_data_directory(self.directory)
+        assert os.path.join(
+            self.dump_directory, VIAFDumpIndex.FILENAME
+        ) == index.path
+
+        # Each cluster's summary can be looked up by ID.
+        parser = VIAFParser()
+        assert parser.summarize(mindy) == index.summary("9581122")
+        assert parser.summarize(twain) == index.summary("50566653")
+        assert None == index.summary("0")
+
+        # Or by any of its names, in any order.
+        for name in ("Kaling, Mindy", "Mindy Kaling"):
+            [summary] = index.search(name)
+            assert "9581122" == summary.viaf
+        assert "50566653" == index.search("Twain, Mark")[0].viaf
+        assert [] == index.search("Nobody In Particular")
+        assert [] == index.search(None)
+
+        # Loading the directory again doesn't read the dump again.
+        index = VIAFDumpIndex.from_data_directory(self.directory)
+        assert 0 == index.load_dump(self.dump)
+        assert parser.summarize(mindy) == index.summary("9581122")
+
+    @classmethod
+    def dump_line(cls, viaf, sort_name, works=0):
+        """A line of a VIAF dump with a minimal cluster on it."""
+        return (
+            '%s\t<ns2:VIAFCluster xmlns:ns2="http://viaf.org/viaf/terms#">'
+            '<ns2:viafID>%s</ns2:viafID><ns2:mainHeadings>'
+            '<ns2:mainHeadingEl><ns2:datafield dtype="MARC21" tag="100">'
+            '<ns2:subfield code="a">%s</ns2:subfield></ns2:datafield>'
+            '</ns2:mainHeadingEl></ns2:mainHeadings><ns2:titles>%s'
+            '</ns2:titles></ns2:VIAFCluster>'
+        ) % (
+            viaf, viaf, sort_name,
+            "<ns2:work><ns2:title>A Title</ns2:title></ns2:work>" * works
+        )
+
+    def test_search_ranks_by_works(self):
+        index = VIAFDumpIndex(os.path.join(self.directory, "index.sqlite"))
+        assert 3 == index.load_lines("dump", [
+            self.dump_line("1", "Smith, Jo", 1),
+            self.dump_line("2", "Smith, Jo", 3),
+            self.dump_line("3", "Smith, Jo Ann", 5),
+        ], 3)
+
+        # The cluster with more works comes first.
+        assert ["2", "1"] == [x.viaf for x in index.search("Jo Smith")]
+        assert ["3"] == [x.viaf for x in index.search("Smith, Jo Ann")]
+
+    def test_summarize_line(self):
+        index = VIAFDumpIndex(os.path.join(self.directory, "index.sqlite"))
+        assert None == index.summarize_line("\n")
+
+        line = self.dump_line("1", "Smith, Jo")
+        summary = index.summarize_line(line)
+        assert "1" == summary.viaf
+        assert ["Smith, Jo"] == summary.sort_names
+        assert set([index.key("Jo Smith")]) == index.keys(summary)
+
+        # A line with no ID is just XML.
+        assert "1" == index.summarize_line(line.split("\t")[1]).viaf
+
+        # If the XML doesn't give the cluster's ID, it's taken from the
+        # start of the line, which may be a URL.
+        assert "9581122" == index.summarize_line(
+            "http://viaf.org/viaf/9581122\t<cluster/>"
+        ).viaf
+
+    def test_load_dump_resumes(self):
+        write_viaf_dump(self.dump, "mark_twain.xml", "mindy_kaling.xml")
+        index = VIAFDumpIndex(os.path.join(self.directory, "index.sqlite"))
+        index.BATCH_SIZE = 1
+
+        # The load is interrupted after the first batch is committed.
+        load_lines = index.load_lines
+        def interrupted(*args, **kwargs):
+            index.load_lines = None
+            return load_lines(*args, **kwargs)
+        index.load_lines = interrupted
+        with pytest.raises(TypeError):
+            index.load_dump(self.dump)
+        assert "50566653" == index.summary("50566653").viaf
+        assert None == index.summary("9581122")
+
+        # Loading the dump again picks up where the first load left
+        # off.
+        index.load_lines = load_lines
+        assert 1 == index.load_dump(self.dump)
+        assert "9581122" == index.summary("9581122").viaf
+        assert 0 == index.load_dump(self.dump)
+
+    def test_default(self):
+        path = os.path.join(self.directory, "index.sqlite")
+        old = os.environ.pop(VIAFDumpIndex.PATH_VARIABLE, None)
+        try:
+            assert None == VIAFDumpIndex.default()
+
+            # An index that hasn't been built isn't used.
+            os.environ[VIAFDumpIndex.PATH_VARIABLE] = path
+            assert None == VIAFDumpIndex.default()
+
+            VIAFDumpIndex(path)
+            index = VIAFDumpIndex.default()
+            assert path == index.path
+            assert index == VIAFDumpIndex.default()
+        finally:
+            if old:
+                os.environ[VIAFDumpIndex.PATH_VARIABLE] = old
+            else:
+                os.environ.pop(VIAFDumpIndex.PATH_VARIABLE, None)
+            VIAFDumpIndex._default = None
+
+
 class MockVIAFClientLookup(MockVIAFClient, VIAFClient):
     """A mocked VIAFClient that can queue mocked lookup results and
     still be used to test VIAFClient#process_contributor.
@@ -298,7 +635,10 @@ class TestVIAFClient(DatabaseTest):
 
     def setup_method(self):
         super(TestVIAFClient, self).setup_method()
-        self.client = VIAFClient(self._db)
+        self.client = VIAFClient(
+            self._db, rate_limiter=MockRateLimiter(),
+            circuit_breaker=MockCircuitBreaker()
+        )
         self.log = logging.getLogger("VIAF Client Test")
 
     def sample_data(self, filename):
@@ -317,7 +657,7 @@ class TestVIAFClient(DatabaseTest):
         # If lookup returns an empty array (as in the case of
         # VIAFParser#parse_multiple), the contributor is not updated.
         client.queue_lookup([])
-        client.process_contributor(contributor)
+        assert (contributor, None) == client.process_contributor(contributor)
         assert contributor.sort_name == '2001'
         assert contributor.display_name == None
 
@@ -345,7 +685,9 @@ class TestVIAFClient(DatabaseTest):
         assert edition.contributors == set([contributor])
 
         queue_lookup_result()
-        client.process_contributor(contributor)
+        survivor, match = client.process_contributor(contributor)
+        assert earliest_contributor == survivor
+        assert "9581122" == match[0].viaf
         assert earliest_contributor.sort_name == "Kaling, Mindy"
         assert edition.contributors == set([earliest_contributor])
         # The new contributor has been deleted.
@@ -385,3 +727,199 @@ class TestVIAFClient(DatabaseTest):
          contributor_titles) = self.client.lookup_by_name(sort_name="Mindy Kaling", do_get=h.do_get)
         assert selected_candidate.viaf == "9581122"
         assert selected_candidate.sort_name == "Kaling, Mindy"
+
+    def test_can_stop_paging(self):
+        m = self.client.can_stop_paging
+
+        # We can't stop before we've seen anything.
+        assert False == m(1, None)
+
+        # We can stop once the best candidate outweighs anything on
+        # the next page.
+        ceiling = VIAFParser.max_possible_weight(11)
+        assert False == m(2, ceiling - 1)
+        assert True == m(2, ceiling)
+
+        # A margin makes us more or less patient.
+        self.client.early_termination_margin = 5
+        assert False == m(2, ceiling)
+        self.client.early_termination_margin = -5
+        assert True == m(2, ceiling - 1)
+        self.client.early_termination_margin = 0
+
+        # Known titles and ignoring popularity both raise the ceiling.
+        assert False == m(2, ceiling, known_titles=["A Title"])
+        assert False == m(2, ceiling, ignore_popularity=True)
+
+        # Eventually, nothing on the next page could be a good enough
+        # match, even if we haven't found anything.
+        assert False == m(3, None)
+        assert True == m(4, None)
+        assert False == m(4, None, ignore_popularity=True)
+
+        # And we never go past MAX_PAGES.
+        assert True == m(VIAFClient.MAX_PAGES + 1, None, ignore_popularity=True)
+
+    def test_lookup_by_name_stops_early(self):
+        # VIAF will keep sending results forever.
+        xml = self.sample_data("mindy_kaling.xml")
+        requests = []
+        def do_get(url, *args, **kwargs):
+            requests.append(url)
+            return 200, {"content-type": "text/xml"}, xml
+
+        (selected_candidate,
+         match_confidences,
+         contributor_titles) = self.client.lookup_by_name(
+             sort_name="Mindy Kaling", do_get=do_get
+         )
+        assert "9581122" == selected_candidate.viaf
+
+        # But the later results were too unpopular to be worth
+        # looking at, so we didn't read anywhere near MAX_PAGES
+        # pages.
+        [(pages, lookups)] = list(self.client.pages_per_lookup.items())
+        assert 1 == lookups
+        assert pages <= 3
+
+        # Some pages may have been fetched concurrently, but no page
+        # was requested twice.
+        assert len(requests) == len(set(requests))
+
+    def test_prefetched_stale_page_is_fetched_once(self):
+        xml = self.sample_data("mindy_kaling.xml")
+        requests = []
+        def do_get(url, *args, **kwargs):
+            requests.append((url, args))
+            return 200, {"content-type": "text/xml", "etag": '"1"'}, xml
+
+        # A page of search results was cached a long time ago.
+        url = self.client.search_url("Mindy Kaling", 2)
+        representation, cached = self.client._get(url, do_get)
+        representation.etag = '"1"'
+        representation.fetched_at = utc_now() - datetime.timedelta(
+            seconds=VIAFClient.REPRESENTATION_MAX_AGE + 1
+        )
+        assert False == self.client._is_cached(url)
+        del requests[:]
+        del self.client.rate_limiter.requests[:]
+
+        # It's prefetched, then asked for again -- probably with
+        # headers that ask whether it's changed.
+        with self.client._prefetcher() as prefetcher:
+            prefetcher.prefetch(self.client._fetch(do_get), [url], {})
+            representation, cached = self.client._get(
+                url, do_get, prefetcher
+            )
+        assert False == cached
+        assert xml == representation_content(representation)
+
+        # The prefetched response was used, so only one request went
+        # upstream, and only one rate-limiting token was taken.
+        assert [(url, ({},))] == requests
+        assert [url] == self.client.rate_limiter.requests
+
+    def test_cluster_summary(self):
+        h = self.queue_file_in_mock_http("mindy_kaling.xml")
+        summary = self.client.cluster_summary("9581122", do_get=h.do_get)
+        assert "9581122" == summary.viaf
+        assert 1 == len(h.requests)
+
+        # The summary was stored in the database.
+        [stored] = self._db.query(VIAFCluster).all()
+        assert "9581122" == stored.viaf
+        assert VIAFClusterSummary.VERSION == stored.version
+        assert summary == VIAFClusterSummary.from_json(stored.summary)
+
+        # Looking the cluster up again doesn't touch the network,
+        # whichever lookup method is used.
+        assert summary == self.client.cluster_summary("9581122", do_get=h.do_get)
+        (contributor_data, match_confidences,
+         contributor_titles) = self.client.lookup_by_viaf(
+             "9581122", do_get=h.do_get
+        )
+        assert "Kaling, Mindy" == contributor_data.sort_name
+        assert summary.name_titles == self.client.lookup_name_title(
+            "9581122", do_get=h.do_get
+        )
+        assert 1 == len(h.requests)
+        assert 3 == self.client.summary_cache.hits
+
+        # A different VIAFClient finds the summary in the database.
+        client = VIAFClient(
+            self._db, rate_limiter=MockRateLimiter(),
+            circuit_breaker=MockCircuitBreaker()
+        )
+        assert summary == client.cluster_summary("9581122", do_get=h.do_get)
+        assert 1 == len(h.requests)
+
+        # Once the stored summary is as old as the document it came
+        # from would be, it's extracted from the document again.
+        stored.summary = '{"viaf":"stale"}'
+        stored.timestamp = utc_now() - datetime.timedelta(
+            seconds=VIAFClient.REPRESENTATION_MAX_AGE + 1
+        )
+        client.summary_cache.clear()
+        assert summary == client.cluster_summary("9581122", do_get=h.do_get)
+        assert summary.to_json() == stored.summary
+        assert stored.timestamp > utc_now() - datetime.timedelta(days=1)
+
+    def test_cluster_summary_failure(self):
+        # VIAF is having trouble.
+        h = DummyHTTPClient()
+        h.queue_response(500, media_type='text/html', content='Oops')
+        summary = self.client.cluster_summary("9581122", do_get=h.do_get)
+        assert VIAFClusterSummary() == summary
+
+        # The empty summary wasn't kept anywhere.
+        assert [] == self._db.query(VIAFCluster).all()
+        assert None == self.client.summary_cache.get("9581122")
+
+        # The same goes for a response with no content.
+        h.queue_response(200, media_type='text/xml', content=None)
+        summary = self.client.cluster_summary("9581122", do_get=h.do_get)
+        assert VIAFClusterSummary() == summary
+        assert [] == self._db.query(VIAFCluster).all()
+
+    def test_lookups_from_dump_index(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "clusters.xml.gz")
+            write_viaf_dump(path, "mindy_kaling.xml")
+            index = VIAFDumpIndex(os.path.join(directory, "index.sqlite"))
+            index.load_dump(path)
+            client = VIAFClient(
+                self._db, rate_limiter=MockRateLimiter(),
+                circuit_breaker=MockCircuitBreaker(), dump_index=index
+            )
+
+            # Clusters in the index are looked up without going to
+            # the network.
+            requests = []
+            def do_get(url, *args, **kwargs):
+                requests.append(url)
+                return 200, {"content-type": "text/xml"}, self.sample_data(
+                    "mindy_kaling.xml"
+                )
+
+            (selected_candidate, match_confidences,
+             contributor_titles) = client.lookup_by_name(
+                 sort_name="Kaling, Mindy", do_get=do_get
+            )
+            assert "9581122" == selected_candidate.viaf
+            assert "Kaling, Mindy" == selected_candidate.sort_name
+            assert {0: 1} == dict(client.pages_per_lookup)
+
+            (contributor_data, match_confidences,
+             contributor_titles) = client.lookup_by_viaf(
+                 "9581122", do_get=do_get
+            )
+            assert "Kaling, Mindy" == contributor_data.sort_name
+            assert [] == requests
+
+            # The network is only used when the index has nothing.
+            client.lookup_by_name(sort_name="Twain, Mark", do_get=do_get)
+            assert len(requests) > 0
+            assert 1 == client.pages_per_lookup[0]
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,506 @@
+"""Coordinate the requests that every metadata wrangler process --
+web workers and coverage scripts alike -- makes to upstream services.
+"""
+import datetime
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from sqlalchemy.sql import text
+
+from model import (
+    UpstreamCircuit,
+    UpstreamRateLimit,
+)
+
+
+# Tests run inside one transaction that's rolled back at the end, so
+# they set this to keep shared upstream state in that transaction.
+# Nothing else should.
+IN_CALLER_TRANSACTION = False
+
+
+def execute(_db, statement, **params):
+    """Run a statement against shared upstream state and return the
+    first row.
+
+    The statement is committed right away on a connection of its own,
+    even if the session is bound to a Connection with a transaction in
+    progress. That way, locks aren't held until the end of the
+    caller's transaction, other processes see the change immediately,
+    and the change survives if the caller rolls back.
+    """
+    if IN_CALLER_TRANSACTION:
+        return _db.execute(statement, params).fetchone()
+    bind = _db.get_bind()
+    # A Connection knows its Engine; an Engine is its own engine.
+    engine = bind.engine
+    with engine.begin() as connection:
+        return connection.execute(statement, **params).fetchone()
+
+
+def protect(do_get, *guards):
+    """Wrap an HTTP GET function in a number of guards, such as a
+    CircuitBreaker and a RateLimiter. The first guard is outermost.
+    """
+    for guard in reversed(guards):
+        do_get = guard.wrap(do_get)
+    return do_get
+
+
+class Prefetcher(object):
+    """Send GET requests for a number of URLs at once, ahead of the code
+    that will actually ask for them.
+
+    Only the requests themselves run in worker threads. RateLimiter
+    and CircuitBreaker keep their state in the database, through a
+    session that can't be shared between threads, so they run in the
+    calling thread instead: a token is taken and the circuit is
+    checked as each request is sent off, and the outcome is recorded
+    with the circuit breaker when the code that needs the response
+    picks it up.
+
+    The worker threads are kept until close() is called, so use a
+    Prefetcher as a context manager.
+    """
+
+    # A request for a stale cached document carries these headers, so
+    # that the server can say the document hasn't changed. They're
+    # ignored when matching a request against a prefetched one: the
+    # prefetched response is a complete answer to the request either
+    # way.
+    CONDITIONAL_HEADERS = set(['if-modified-since', 'if-none-match'])
+
+    def __init__(self, max_workers=4, rate_limiter=None,
+                 circuit_breaker=None):
+        self.max_workers = max_workers
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker
+        self.executor = None
+        self.responses = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def prefetch(self, do_get, urls, *args, **kwargs):
+        """Send off a GET request for every URL in `urls`, to be run up
+        to `max_workers` at a time, and hold on to the outcomes.
+
+        This returns once every request has been sent off, without
+        waiting for any of them to finish.
+
+        :param do_get: An HTTP GET function that isn't guarded by a
+            RateLimiter or CircuitBreaker, since those are applied
+            here.
+        :param args: Passed into `do_get` after the URL, along with
+            `kwargs`. A prefetched response is only used by a request
+            made with the same arguments, apart from any
+            CONDITIONAL_HEADERS.
+        """
+        for url in urls:
+            if url in self.responses:
+                continue
+            failures = 0
+            if self.circuit_breaker:
+                try:
+                    failures = self.circuit_breaker.check(url)
+                except UpstreamUnavailable:
+                    # The request will fail the same way when it's
+                    # actually made.
+                    continue
+            if self.rate_limiter:
+                self.rate_limiter.acquire(url)
+            if not self.executor:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers
+                )
+            future = self.executor.submit(do_get, url, *args, **kwargs)
+            self.responses[url] = (future, failures, args, kwargs)
+
+    def wrap(self, do_get):
+        """Serve prefetched URLs from their stored outcome.
+
+        Each outcome is used once, by a request made with the same
+        arguments as the prefetched one, apart from any
+        CONDITIONAL_HEADERS. Anything else is passed through to
+        `do_get`, which should be guarded as usual.
+        """
+        def prefetched(url, *args, **kwargs):
+            prefetch = self.responses.pop(url, None)
+            if prefetch is None:
+                return do_get(url, *args, **kwargs)
+            future, failures, prefetch_args, prefetch_kwargs = prefetch
+            if (self.unconditional(args, kwargs) !=
+                self.unconditional(prefetch_args, prefetch_kwargs)):
+                # This isn't the request that was prefetched -- it
+                # might have different headers.
+                future.cancel()
+                return do_get(url, *args, **kwargs)
+            try:
+                response = future.result()
+            except Exception:
+                if self.circuit_breaker:
+                    self.circuit_breaker.record_failure(url)
+                raise
+            if self.circuit_breaker:
+                self.circuit_breaker.record_response(url, failures, response)
+            return response
+        return prefetched
+
+    @classmethod
+    def unconditional(cls, args, kwargs):
+        """Leave any CONDITIONAL_HEADERS out of the arguments to an
+        HTTP GET function.
+
+        :return: A 2-tuple (args, kwargs).
+        """
+        def strip(value):
+            if not isinstance(value, dict):
+                return value
+            return dict(
+                (k, v) for k, v in list(value.items())
+                if not (isinstance(k, str)
+                        and k.lower() in cls.CONDITIONAL_HEADERS)
+            )
+        return (
+            tuple(strip(x) for x in args),
+            dict((k, strip(v)) for k, v in list(kwargs.items()))
+        )
+
+    def close(self):
+        """Let go of the worker threads.
+
+        Requests that haven't started are cancelled. This doesn't
+        wait for requests in progress, whose outcomes are ignored.
+        """
+        for future, failures, args, kwargs in list(self.responses.values()):
+            future.cancel()
+        self.responses = {}
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+class UpstreamUnavailable(IOError):
+    """We're not sending requests to an upstream host, because it's
+    been failing.
+    """
+
+
+class RateLimiter(object):
+    """A token bucket for each upstream host, shared through the
+    database by every process that talks to that host.
+
+    Each request takes a token. Tokens come back at `rate` per second,
+    up to `burst`. A process that finds the bucket empty still takes
+    its token -- the bucket goes into debt -- and then sleeps until
+    that token would have come back. This means a request costs a
+    single atomic statement no matter how many processes are
+    competing.
+
+    Only requests that actually go out over the network should be
+    counted. Wrap the do_get function passed into Representation.get,
+    rather than calling acquire() before Representation.get, so that
+    cache hits are free.
+    """
+
+    # (requests per second, burst size) for each upstream host.
+    RATES = {
+        'viaf.org' : (2, 10),
+        'classify.oclc.org' : (1, 5),
+        'www.worldcat.org' : (2, 10),
+        'experiment.worldcat.org' : (2, 10),
+        'contentcafe2.btol.com' : (5, 10),
+    }
+
+    # Used for any host not mentioned in RATES.
+    DEFAULT_RATE = (1, 5)
+
+    # Take a token from the bucket, first refilling it for the time
+    # that has passed since it was last updated. clock_timestamp() is
+    # used so that every process shares the database's clock.
+    TAKE_TOKEN = text("""
+insert into %(table)s (host, tokens, updated, requests, seconds_waited, counted_since)
+ values (:host, :burst - 1, clock_timestamp(), 1, 0, clock_timestamp())
+on conflict (host) do update set
+ tokens = least(:burst, %(table)s.tokens + extract(epoch from clock_timestamp() - %(table)s.updated) * :rate) - 1,
+ seconds_waited = %(table)s.seconds_waited + greatest(0, 1 - least(:burst, %(table)s.tokens + extract(epoch from clock_timestamp() - %(table)s.updated) * :rate)) / :rate,
+ updated = clock_timestamp(),
+ requests = %(table)s.requests + 1
+returning tokens""" % dict(table=UpstreamRateLimit.__tablename__))
+
+    def __init__(self, _db, rates=None, sleep=time.sleep):
+        """Constructor.
+
+        :param rates: A dictionary to use instead of RATES.
+        :param sleep: A drop-in replacement for time.sleep, for use
+            in tests.
+        """
+        self._db = _db
+        self.rates = dict(self.RATES)
+        self.rates.update(rates or {})
+        self.sleep = sleep
+        self.log = logging.getLogger("Upstream rate limiter")
+
+    @classmethod
+    def host_for(cls, url):
+        """Find the host a URL is asking for."""
+        return (urlparse(url).hostname or url).lower()
+
+    def rate_for(self, host):
+        return self.rates.get(host, self.DEFAULT_RATE)
+
+    def acquire(self, url):
+        """Wait until it's our turn to send a request to `url`'s host.
+
+        :return: The number of seconds spent waiting.
+        """
+        host = self.host_for(url)
+        rate, burst = self.rate_for(host)
+        [tokens] = execute(
+            self._db, self.TAKE_TOKEN, host=host, rate=float(rate), burst=float(burst)
+        )
+        wait = 0
+        if tokens < 0:
+            wait = -tokens / float(rate)
+            self.log.debug("Waiting %.2fs to send a request to %s", wait, host)
+            self.sleep(wait)
+        return wait
+
+    def wrap(self, do_get):
+        """Rate-limit an HTTP GET function.
+
+        :param do_get: Any function whose first argument is a URL,
+            such as Representation.simple_http_get or
+            HTTP.get_with_timeout.
+        :return: A function with the same signature.
+        """
+        def limited(url, *args, **kwargs):
+            self.acquire(url)
+            return do_get(url, *args, **kwargs)
+        return limited
+
+    @classmethod
+    def effective_rates(cls, _db, reset=False):
+        """Report how fast requests have actually been sent to each host.
+
+        :param reset: Start the counters over after reporting them.
+        :return: A list of (host, requests, requests per second,
+            seconds spent waiting) tuples.
+        """
+        now = _db.execute(text("select clock_timestamp()")).scalar()
+        results = []
+        for limit in _db.query(UpstreamRateLimit).order_by(
+            UpstreamRateLimit.host
+        ):
+            elapsed = (now - limit.counted_since).total_seconds()
+            per_second = 0
+            if elapsed > 0:
+                per_second = limit.requests / elapsed
+            results.append(
+                (limit.host, limit.requests, per_second, limit.seconds_waited)
+            )
+            if reset:
+                limit.requests = 0
+                limit.seconds_waited = 0
+                limit.counted_since = now
+        return results
+
+
+class CircuitBreaker(object):
+    """A circuit breaker for each upstream host, shared through the
+    database by every process that talks to that host.
+
+    After FAILURE_THRESHOLD failures in a row (with no more than
+    FAILURE_WINDOW between them) the circuit opens, and for COOLDOWN
+    every request to that host fails immediately with
+    UpstreamUnavailable instead of waiting out its timeout. After that,
+    the circuit is half-open: one process is allowed to send a probe
+    request, and if it succeeds, the circuit closes again.
+
+    Every change to a circuit goes through execute(), so it's
+    committed as soon as it's made. Other processes see a failure
+    right away, a failure is remembered even if the caller's
+    transaction is rolled back, and claiming the probe is a single
+    committed update that only one process can win.
+    """
+
+    FAILURE_THRESHOLD = 5
+    FAILURE_WINDOW = datetime.timedelta(minutes=1)
+    COOLDOWN = datetime.timedelta(minutes=2)
+
+    # How long a process gets to finish its probe request before
+    # another process is allowed to try.
+    PROBE_TIMEOUT = datetime.timedelta(minutes=1)
+
+    TABLE = UpstreamCircuit.__tablename__
+
+    CHECK = text("""
+select failures, open_until is not null, open_until > clock_timestamp()
+ from %s where host=:host""" % TABLE)
+
+    CLAIM_PROBE = text("""
+update %(table)s set open_until = clock_timestamp() + :probe_timeout
+ where host=:host and open_until <= clock_timestamp()
+returning id""" % dict(table=TABLE))
+
+    # A failure while the circuit is tripped (that is, a failed probe)
+    # always reopens it.
+    RECORD_FAILURE = text("""
+insert into %(table)s (host, failures, last_failure, open_until)
+ values (:host, 1, clock_timestamp(), case when 1 >= :threshold then clock_timestamp() + :cooldown else null end)
+on conflict (host) do update set
+ failures = case when %(table)s.last_failure < clock_timestamp() - :window then 1 else %(table)s.failures + 1 end,
+ last_failure = clock_timestamp(),
+ open_until = case when %(table)s.open_until is not null or (case when %(table)s.last_failure < clock_timestamp() - :window then 1 else %(table)s.failures + 1 end) >= :threshold then clock_timestamp() + :cooldown else null end
+returning failures""" % dict(table=TABLE))
+
+    RECORD_SUCCESS = text("""
+update %s set failures=0, open_until=null where host=:host""" % TABLE)
+
+    def __init__(self, _db):
+        self._db = _db
+        self.log = logging.getLogger("Upstream circuit breaker")
+
+    def is_open(self, url):
+        """Is the circuit for `url`'s host open?
+
+        A half-open circuit doesn't count as open, since a request
+        might be allowed through to probe it.
+        """
+        row = execute(
+            self._db, self.CHECK, host=RateLimiter.host_for(url)
+        )
+        return bool(row and row[2])
+
+    def check(self, url):
+        """Make sure a request can be sent to `url`'s host.
+
+        :return: The number of recent failures for that host.
+        :raise UpstreamUnavailable: If the circuit is open, or it's
+            half-open and some other process is sending the probe.
+        """
+        host = RateLimiter.host_for(url)
+        row = execute(self._db, self.CHECK, host=host)
+        if not row:
+            # We've never had a problem with this host.
+            return 0
+        failures, tripped, is_open = row
+        if not tripped:
+            return failures
+        if not is_open:
+            # The circuit is half-open. Try to claim the probe.
+            claimed = execute(
+                self._db, self.CLAIM_PROBE, host=host,
+                probe_timeout=self.PROBE_TIMEOUT
+            )
+            if claimed:
+                self.log.info("Probing %s to see if it's back.", host)
+                return failures
+        raise UpstreamUnavailable(
+            "%s has failed %d times in a row; not sending requests." % (
+                host, failures
+            )
+        )
+
+    def record_failure(self, url):
+        host = RateLimiter.host_for(url)
+        [failures] = execute(
+            self._db, self.RECORD_FAILURE, host=host,
+            threshold=self.FAILURE_THRESHOLD, window=self.FAILURE_WINDOW,
+            cooldown=self.COOLDOWN
+        )
+        if failures >= self.FAILURE_THRESHOLD:
+            self.log.warning(
+                "%s has failed %d times in a row; opening the circuit.",
+                host, failures
+            )
+        return failures
+
+    def record_success(self, url):
+        execute(self._db, self.RECORD_SUCCESS, host=RateLimiter.host_for(url))
+
+    def record_response(self, url, failures, response):
+        """Record the response to a request that check() let through.
+
+        :param failures: The number of failures check() reported.
+        """
+        if self.is_failure(response):
+            self.record_failure(url)
+        elif failures:
+            # Only write to the database if there's something to
+            # clear.
+            self.record_success(url)
+
+    @classmethod
+    def is_failure(cls, response):
+        """Does the response from an HTTP GET function indicate a
+        problem with the upstream host?
+
+        :param response: A (status, headers, content) tuple, as
+            returned by Representation.simple_http_get, or a
+            requests Response.
+        """
+        if isinstance(response, tuple):
+            status = response[0]
+        else:
+            status = getattr(response, 'status_code', None)
+        return isinstance(status, int) and status >= 500
+
+    def wrap(self, do_get):
+        """Guard an HTTP GET function with this circuit breaker.
+
+        :param do_get: Any function whose first argument is a URL.
+        :return: A function with the same signature.
+        """
+        def guarded(url, *args, **kwargs):
+            failures = self.check(url)
+            try:
+                response = do_get(url, *args, **kwargs)
+            except Exception:
+                self.record_failure(url)
+                raise
+            self.record_response(url, failures, response)
+            return response
+        return guarded
+
+
+class MockCircuitBreaker(CircuitBreaker):
+    """A circuit breaker that's open only for the hosts in `self.open`,
+    and doesn't touch the database.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.open = set()
+
+    def is_open(self, url):
+        return RateLimiter.host_for(url) in self.open
+
+    def check(self, url):
+        if self.is_open(url):
+            raise UpstreamUnavailable("%s is open." % url)
+        return 0
+
+    def record_failure(self, url):
+        return 0
+
+    def record_success(self, url):
+        pass
+
+    def wrap(self, do_get):
+        return do_get
+
+
+class MockRateLimiter(RateLimiter):
+    """Keeps track of requests without touching the database or sleeping."""
+
+    def __init__(self, *args, **kwargs):
+        self.requests = []
+
+    def acquire(self, url):
+        self.requests.append(url)
+        return 0
@@ -1,6 +1,11 @@
+import datetime
+import gzip
+import json
 import logging
 import os
 import re
+import sqlite3
+import time
 
 from lxml import etree
 from fuzzywuzzy import fuzz
@@ -16,14 +21,10 @@ from core.model import (
     Contributor,
     DataSource,
     Representation,
+    get_one,
 )
 
-from core.util.personal_names import (
-    contributor_name_match_ratio,
-    display_name_to_sort_name,
-    is_corporate_name,
-    normalize_contributor_name_for_matching,
-)
+from core.util.personal_names import is_corporate_name
 
 from core.util.titles import (
     normalize_title_for_matching,
@@ -31,10 +32,36 @@ from core.util.titles import (
     unfluff_title,
 )
 
+from core.util.datetime_helpers import utc_now
 from core.util.xmlparser import (
     XMLParser,
 )
 
+from cache import LRUCache
+from compression import (
+    Compressor,
+    compress,
+    decompress,
+    get_representation,
+    is_cached,
+    representation_content,
+)
+from model import VIAFCluster
+from personal_names import (
+    contributor_name_match_ratio,
+    display_name_to_sort_name,
+    normalize_contributor_name_for_matching,
+)
+
+from upstream import (
+    CircuitBreaker,
+    MockCircuitBreaker,
+    MockRateLimiter,
+    Prefetcher,
+    RateLimiter,
+    protect,
+)
+
 
 class NameParser(object):
     """Parse VIAF-style personal names.
@@ -95,6 +122,108 @@ class NameParser(object):
 
         return name_without_lifespan.strip(), birth, death
 
+class VIAFClusterSummary(object):
+    """The parts of a VIAF cluster that VIAFParser looks at, extracted
+    from the XML once so the cluster never has to be parsed again.
+    """
+
+    # Change this whenever the information extracted from a cluster
+    # changes, so that old summaries are thrown out.
+    VERSION = 1
+
+    def __init__(self, viaf=None, wikipedia_name=None, sort_names=None,
+                 name_titles=None, alternate_names=None, unimarc_names=None,
+                 titles=None):
+        """Constructor.
+
+        :param sort_names: The names in the cluster's MARC 100 and 110
+            records, in order. A name that shows up in more records is
+            more popular.
+        :param name_titles: Titles (such as "Sir") from those records.
+        :param alternate_names: Pseudonyms and other names from the
+            cluster's MARC 400 and 700 records.
+        :param unimarc_names: A (given name, family name, extra, sort
+            name) 4-tuple for each of the cluster's UNIMARC records.
+        :param titles: The titles of works in the cluster.
+        """
+        self.viaf = viaf
+        self.wikipedia_name = wikipedia_name
+        self.sort_names = sort_names or []
+        self.name_titles = name_titles or []
+        self.alternate_names = alternate_names or []
+        self.unimarc_names = [tuple(x) for x in (unimarc_names or [])]
+        self.titles = titles or []
+
+    FIELDS = ('viaf', 'wikipedia_name', 'sort_names', 'name_titles',
+              'alternate_names', 'unimarc_names', 'titles')
+
+    def __eq__(self, other):
+        return isinstance(other, VIAFClusterSummary) and all(
+            getattr(self, field) == getattr(other, field)
+            for field in self.FIELDS
+        )
+
+    def __repr__(self):
+        return '<VIAFClusterSummary: viaf=%s sort_names=%r>' % (
+            self.viaf, self.sort_names
+        )
+
+    def sort_name_popularity(self):
+        """Count how often each sort name shows up in the cluster.
+
+        :return: A Counter, which the caller is free to modify.
+        """
+        popularity = Counter()
+        for sort_name in self.sort_names:
+            if sort_name.endswith(","):
+                sort_name = sort_name[:-1]
+            popularity[sort_name] += 1
+        return popularity
+
+    def to_json(self):
+        """Serialize this summary as compactly as possible, leaving out
+        anything that's empty.
+        """
+        data = dict()
+        for field in self.FIELDS:
+            value = getattr(self, field)
+            if value:
+                data[field] = value
+        return json.dumps(data, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, serialized):
+        return cls(**json.loads(serialized))
+
+
+class TitleMatcher(object):
+    """Remembers the title comparisons made by VIAFParser.weigh_titles.
+
+    The same known titles are compared against the titles of every
+    candidate in a search, and every candidate is weighed more than
+    once over the course of a lookup. With a TitleMatcher shared across
+    all of that, each title is only normalized once and each pair of
+    titles is only compared once.
+    """
+
+    def __init__(self):
+        self.unfluffed = {}
+        self.ratios = {}
+
+    def unfluff(self, title):
+        """Memoized unfluff_title."""
+        if title not in self.unfluffed:
+            self.unfluffed[title] = unfluff_title(title)
+        return self.unfluffed[title]
+
+    def ratio(self, known_title, contributor_title):
+        """Memoized title_match_ratio."""
+        key = (known_title, contributor_title)
+        if key not in self.ratios:
+            self.ratios[key] = title_match_ratio(known_title, contributor_title)
+        return self.ratios[key]
+
+
 class VIAFParser(XMLParser):
 
     NAMESPACES = {'ns2' : "http://viaf.org/viaf/terms#"}
@@ -140,8 +269,33 @@ class VIAFParser(XMLParser):
         return normalize_contributor_name_for_matching(name)
 
 
+    # The most weigh_contributor() can add to a candidate's weight for
+    # matching names and having good data, and for each known title.
+    MAX_NAME_WEIGHT = (
+        2 * 100 + 0.5 * 100 + 0.3 * 100 + 0.5 * 100 + 0.2 * 100 + 0.2 + 0.2
+    )
+    MAX_TITLE_WEIGHT = 0.8 * 100
+
+    @classmethod
+    def max_possible_weight(cls, library_popularity, known_titles=None,
+                            ignore_popularity=False):
+        """The highest weight weigh_contributor() could give a candidate
+        with the given library popularity.
+
+        Less popular candidates are penalized, so this puts a ceiling
+        on the weight of every candidate on later pages of search
+        results.
+        """
+        weight = (
+            cls.MAX_NAME_WEIGHT +
+            cls.MAX_TITLE_WEIGHT * len(known_titles or [])
+        )
+        if not ignore_popularity:
+            weight -= 10 * library_popularity
+        return weight
+
     @classmethod
-    def weigh_contributor(cls, candidate, working_sort_name, known_titles=None, strict=False, ignore_popularity=False):
+    def weigh_contributor(cls, candidate, working_sort_name, known_titles=None, strict=False, ignore_popularity=False, matcher=None):
         """ Find the author who corresponds the best to the working_sort_name.
             Consider as evidence of suitability:
             - top-most in viaf-returned xml (most popular in libraries)
@@ -152,6 +306,9 @@ class VIAFParser(XMLParser):
             So, if the total match confidence is 110%, that's acceptable, and may not even
             be the best match if there's a 120% out there.  But having an exact title match
             does matter more than a fuzzy unimarc tag match.
+
+            :param matcher: A TitleMatcher shared with other calls to
+                this method.
         """
         report_string = "no_viaf"
         (contributor, match_confidences, contributor_titles) = candidate
@@ -219,7 +376,7 @@ class VIAFParser(XMLParser):
         if contributor.viaf:
             match_confidences["total"] += 0.2
 
-        cls.weigh_titles(known_titles, contributor_titles, match_confidences, strict)
+        cls.weigh_titles(known_titles, contributor_titles, match_confidences, strict, matcher)
         if "title" in match_confidences:
             report_string += ", mc[title]=%s" % match_confidences["title"]
 
@@ -232,7 +389,31 @@ class VIAFParser(XMLParser):
 
 
     @classmethod
-    def weigh_titles(cls, known_titles=None, contributor_titles=None, match_confidences=None, strict=False):
+    def weigh_candidates(cls, contributor_candidates, working_sort_name,
+                         known_titles=None, strict=False,
+                         ignore_popularity=False, matcher=None):
+        """Weigh a batch of candidates with weigh_contributor().
+
+        The candidates share a TitleMatcher, so titles that come up for
+        more than one candidate are only compared once.
+
+        :param matcher: A TitleMatcher to use instead of a new one, so
+            that comparisons made here can be reused later.
+        :return: A list of weights, in the same order as the candidates.
+        """
+        matcher = matcher or TitleMatcher()
+        return [
+            cls.weigh_contributor(
+                candidate, working_sort_name, known_titles=known_titles,
+                strict=strict, ignore_popularity=ignore_popularity,
+                matcher=matcher
+            )
+            for candidate in contributor_candidates
+        ]
+
+    @classmethod
+    def weigh_titles(cls, known_titles=None, contributor_titles=None, match_confidences=None, strict=False, matcher=None):
+        matcher = matcher or TitleMatcher()
         if known_titles:
             for known_title in known_titles:
                 if strict:
@@ -254,7 +435,7 @@ class VIAFParser(XMLParser):
                         # TODO: In future, consider doing:
                         # "Pride and Prejudice (Spanish)" should connect to two authors --
                         # Jane Austen and the translator.
-                        if cls.name_matches(unfluff_title(contributor_title), unfluff_title(known_title)):
+                        if cls.name_matches(matcher.unfluff(contributor_title), matcher.unfluff(known_title)):
                             match_confidences["title"] = 90
                             match_confidences["total"] += 0.8 * match_confidences["title"]
                             # match is good enough, we can stop
@@ -265,7 +446,7 @@ class VIAFParser(XMLParser):
                         <ns1:title>Britain, detente and changing east-west relations</ns1:title> (with accented e in detente)
                         doesn't match "Britain, Detente and Changing East-West Relations" in our DB.
                         '''
-                        match_confidence = title_match_ratio(known_title, contributor_title)
+                        match_confidence = matcher.ratio(known_title, contributor_title)
                         match_confidences["title"] = match_confidence
                         if match_confidence > 80:
                             match_confidences["total"] += 0.6 * match_confidence
@@ -274,36 +455,125 @@ class VIAFParser(XMLParser):
 
 
 
+    # Precompiled XPath expressions used to pick fields out of a
+    # cluster one at a time. summarize() doesn't need them -- it gets
+    # everything in one pass over the cluster.
+    MARC21_DATAFIELDS = etree.XPath(
+        './/*[local-name()="datafield"][@dtype="MARC21"][@tag=$tag]'
+    )
+    SUBFIELDS = etree.XPath('*[local-name()="subfield"][@code=$code]')
+    UNIMARC_SUBFIELD = etree.XPath(
+        'ns2:subfield[@code=$code]', namespaces=NAMESPACES
+    )
+    SOURCES = etree.XPath(
+        './/*[local-name()="sources"]/*[local-name()="source"]'
+    )
+    CLUSTERS = etree.XPath('//*[local-name()="VIAFCluster"]')
+
+    # The MARC 21 records summarize() looks at: names (100 and 110)
+    # and alternate names (400 and 700).
+    NAME_TAGS = ('100', '110')
+    ALTERNATE_NAME_TAGS = ('400', '700')
+
+    def _marc21_subfields(self, cluster, tags, code):
+        for tag in tags:
+            for data_field in self.MARC21_DATAFIELDS(cluster, tag=tag):
+                for potential_match in self.SUBFIELDS(data_field, code=code):
+                    yield potential_match.text
+
     def alternate_name_forms_for_cluster(self, cluster):
         """Find all pseudonyms in the given cluster."""
-        for tag in ('400', '700'):
-            for data_field in self._xpath(
-                    cluster, './/*[local-name()="datafield"][@dtype="MARC21"][@tag="%s"]' % tag):
-                for potential_match in self._xpath(
-                        data_field, '*[local-name()="subfield"][@code="a"]'):
-                    yield potential_match.text
+        return self._marc21_subfields(cluster, self.ALTERNATE_NAME_TAGS, 'a')
 
 
     def sort_names_for_cluster(self, cluster):
         """Find all sort names for the given cluster."""
-        for tag in ('100', '110'):
-            for data_field in self._xpath(
-                    cluster, './/*[local-name()="datafield"][@dtype="MARC21"][@tag="%s"]' % tag):
-                for potential_match in self._xpath(
-                        data_field, '*[local-name()="subfield"][@code="a"]'):
-                    yield potential_match.text
+        return self._marc21_subfields(cluster, self.NAME_TAGS, 'a')
 
 
     def name_titles_for_cluster(self, cluster):
         """Find all sort names for the given cluster."""
-        for tag in ('100', '110'):
-            for data_field in self._xpath(
-                    cluster, './/*[local-name()="datafield"][@dtype="MARC21"][@tag="%s"]' % tag):
-                for potential_match in self._xpath(
-                        data_field, '*[local-name()="subfield"][@code="c"]'):
-                    yield potential_match.text
+        return self._marc21_subfields(cluster, self.NAME_TAGS, 'c')
 
 
+    @classmethod
+    def _local_name(cls, element):
+        """The tag of an element, without its namespace, or None if
+        it's a comment or processing instruction.
+        """
+        tag = element.tag
+        if not isinstance(tag, str):
+            return None
+        return tag.rpartition('}')[2]
+
+    def summarize(self, cluster):
+        """Extract everything this parser needs from an XML cluster.
+
+        This walks the cluster once, rather than running a separate
+        XPath query for each field.
+
+        :param cluster: An XML cluster, or a VIAFClusterSummary, which
+            is returned as-is.
+        :return: A VIAFClusterSummary.
+        """
+        if isinstance(cluster, VIAFClusterSummary):
+            return cluster
+        local_name = self._local_name
+
+        viaf_tag = None
+        wikipedia_name = None
+        # Subfield text from the MARC 21 records, keyed by (tag, code).
+        marc21 = defaultdict(list)
+        wanted_tags = self.NAME_TAGS + self.ALTERNATE_NAME_TAGS
+        unimarc_names = []
+        titles = []
+        for element in cluster.iterdescendants():
+            name = local_name(element)
+            if name == 'datafield':
+                dtype = element.get('dtype')
+                if dtype == 'MARC21':
+                    tag = element.get('tag')
+                    if tag in wanted_tags:
+                        for subfield in element:
+                            if local_name(subfield) == 'subfield':
+                                marc21[tag, subfield.get('code')].append(
+                                    subfield.text
+                                )
+                elif dtype == 'UNIMARC':
+                    unimarc_names.append(
+                        self.extract_name_from_unimarc(element)
+                    )
+            elif name == 'viafID':
+                if viaf_tag is None:
+                    viaf_tag = element
+            elif name == 'source':
+                if (wikipedia_name is None
+                    and local_name(element.getparent()) == 'sources'):
+                    wikipedia_name = self.wikipedia_name_from_source(
+                        element.text
+                    )
+            elif name == 'title':
+                work = element.getparent()
+                if (local_name(work) == 'work'
+                    and local_name(work.getparent()) == 'titles'):
+                    titles.append(element.text)
+
+        def subfields(tags, code):
+            values = []
+            for tag in tags:
+                values.extend(marc21[tag, code])
+            return values
+
+        return VIAFClusterSummary(
+            viaf=None if viaf_tag is None else viaf_tag.text,
+            wikipedia_name=wikipedia_name,
+            sort_names=subfields(self.NAME_TAGS, 'a'),
+            name_titles=subfields(self.NAME_TAGS, 'c'),
+            alternate_names=subfields(self.ALTERNATE_NAME_TAGS, 'a'),
+            unimarc_names=unimarc_names,
+            titles=titles,
+        )
+
     def cluster_has_record_for_named_author(
             self, cluster, working_sort_name, working_display_name, contributor_data=None):
         """  Looks through the xml cluster for all fields that could indicate the
@@ -312,9 +582,11 @@ class VIAFParser(XMLParser):
         Don't short-circuit the xml parsing process -- if found an author name
         match, keep parsing and see what else can find.
 
+        :param cluster: An XML cluster or a VIAFClusterSummary.
         :return: a dictionary containing description of xml field
         that matched author name searched for.
         """
+        summary = self.summarize(cluster)
         match_confidences = {}
         if not contributor_data:
             contributor_data = ContributorData()
@@ -322,7 +594,7 @@ class VIAFParser(XMLParser):
         # If we have a sort name to look for, and it's in this cluster's
         # sort names, great.
         if working_sort_name:
-            for potential_match in self.sort_names_for_cluster(cluster):
+            for potential_match in summary.sort_names:
                 match_confidence = contributor_name_match_ratio(potential_match, working_sort_name)
                 match_confidences["sort_name"] = match_confidence
                 # fuzzy match filter may not always give a 100% match, so cap arbitrarily at 90% as a "sure match"
@@ -333,7 +605,7 @@ class VIAFParser(XMLParser):
         # If we have a display name to look for, and this cluster's
         # Wikipedia name converts to the display name, great.
         if working_display_name:
-            wikipedia_name = self.extract_wikipedia_name(cluster)
+            wikipedia_name = summary.wikipedia_name
             if wikipedia_name:
                 contributor_data.wikipedia_name=wikipedia_name
                 display_name = self.wikipedia_name_to_display_name(wikipedia_name)
@@ -345,11 +617,8 @@ class VIAFParser(XMLParser):
 
         # If there are UNIMARC records, and every part of the UNIMARC
         # record matches the sort name or the display name, great.
-        unimarcs = self._xpath(cluster, './/*[local-name()="datafield"][@dtype="UNIMARC"]')
-        candidates = []
-        for unimarc in unimarcs:
-            (possible_given, possible_family,
-             possible_extra, possible_sort_name) = self.extract_name_from_unimarc(unimarc)
+        for (possible_given, possible_family,
+             possible_extra, possible_sort_name) in summary.unimarc_names:
             if working_sort_name:
                 match_confidence = contributor_name_match_ratio(possible_sort_name, working_sort_name)
                 match_confidences["unimarc"] = match_confidence
@@ -371,7 +640,7 @@ class VIAFParser(XMLParser):
         # of the cluster sort names.
         if working_display_name and not working_sort_name:
             test_sort_name = display_name_to_sort_name(working_display_name)
-            for potential_match in self.sort_names_for_cluster(cluster):
+            for potential_match in summary.sort_names:
                 match_confidence = contributor_name_match_ratio(potential_match, test_sort_name)
                 match_confidences["guessed_sort_name"] = match_confidence
                 if match_confidence > 90:
@@ -380,7 +649,7 @@ class VIAFParser(XMLParser):
 
         # OK, last last-ditch effort.  See if the alternate name forms (pseudonyms) are it.
         if working_sort_name:
-            for potential_match in self.alternate_name_forms_for_cluster(cluster):
+            for potential_match in summary.alternate_names:
                 match_confidence = contributor_name_match_ratio(potential_match, working_sort_name)
                 match_confidences["alternate_name"] = match_confidence
                 if match_confidence > 90:
@@ -391,7 +660,7 @@ class VIAFParser(XMLParser):
 
 
     def order_candidates(self, contributor_candidates, working_sort_name,
-                        known_titles=None, strict=False):
+                        known_titles=None, strict=False, matcher=None):
         """
         Accepts a list of tuples, each tuple containing:
         - a ContributorData object filled with VIAF id, display, sort, family,
@@ -407,6 +676,8 @@ class VIAFParser(XMLParser):
         appears in most libraries when searching for working_sort_name is on top.
         Assumes the xml's order is preserved in the contributor_candidates list.
 
+        :param matcher: A TitleMatcher that may already have compared
+            some of the titles.
         :return: the list of tuples, ordered by percent match, in descending order
         (top match first).
         """
@@ -416,6 +687,35 @@ class VIAFParser(XMLParser):
         # Double-check that the candidate list is ordered by library
         # popularity, as it came from viaf
         contributor_candidates.sort(key=lambda c: c[1].get('library_popularity'))
+        ignore_popularity = self.should_ignore_popularity(
+            contributor_candidates
+        )
+
+        # higher score for better match, so to have best match first, do desc order.
+        weights = self.weigh_candidates(
+            contributor_candidates, working_sort_name,
+            known_titles=known_titles, strict=strict,
+            ignore_popularity=ignore_popularity, matcher=matcher
+        )
+        weight_for = dict(
+            (id(candidate), weight)
+            for candidate, weight in zip(contributor_candidates, weights)
+        )
+        contributor_candidates.sort(
+            key=lambda x: weight_for[id(x)], reverse=True
+        )
+        return contributor_candidates
+
+    def should_ignore_popularity(self, contributor_candidates):
+        """Should weigh_contributor() ignore library popularity when
+        weighing these candidates?
+
+        :param contributor_candidates: A list of candidates in library
+            popularity order.
+        """
+        if not contributor_candidates:
+            return False
+
         # Grab the most popular candidate.
         (contributor_data, match_confidences, contributor_titles) = contributor_candidates[0]
 
@@ -436,18 +736,7 @@ class VIAFParser(XMLParser):
             if (("sort_name" not in match_confidences) and
                 ("guessed_sort_name" not in match_confidences)):
                 ignore_popularity = True
-
-
-        # higher score for better match, so to have best match first, do desc order.
-        contributor_candidates.sort(
-            key=lambda x: self.weigh_contributor(
-                x, working_sort_name=working_sort_name,
-                known_titles=known_titles, strict=strict,
-                ignore_popularity=ignore_popularity
-            ),
-            reverse=True
-        )
-        return contributor_candidates
+        return ignore_popularity
 
 
     def parse_multiple(
@@ -486,7 +775,7 @@ class VIAFParser(XMLParser):
         # a contributor_data, a dictionary of search match confidence weights,
         # and a list of metadata objects representing authored titles.
         contributor_candidates = []
-        for cluster in self._xpath(tree, '//*[local-name()="VIAFCluster"]'):
+        for cluster in self.CLUSTERS(tree):
             contributor_data, match_confidences, contributor_titles = self.extract_viaf_info(
                 cluster, working_sort_name, working_display_name)
 
@@ -521,13 +810,25 @@ class VIAFParser(XMLParser):
 
     def extract_wikipedia_name(self, cluster):
         """Extract Wiki name from a single VIAF cluster."""
-        for source in self._xpath(cluster, './/*[local-name()="sources"]/*[local-name()="source"]'):
-            if source.text.startswith("WKP|"):
-                # This could be a Wikipedia page, which is great,or it
-                # could be a Wikidata ID, which we don't want.
-                potential_wikipedia = source.text[4:]
-                if not self.wikidata_id.search(potential_wikipedia):
-                    return potential_wikipedia
+        for source in self.SOURCES(cluster):
+            wikipedia_name = self.wikipedia_name_from_source(source.text)
+            if wikipedia_name:
+                return wikipedia_name
+
+
+    def wikipedia_name_from_source(self, source):
+        """Find a Wikipedia page name in the text of a <source> tag.
+
+        :return: The name of the page, or None if this source isn't a
+            Wikipedia page.
+        """
+        if source and source.startswith("WKP|"):
+            # This could be a Wikipedia page, which is great,or it
+            # could be a Wikidata ID, which we don't want.
+            potential_wikipedia = source[4:]
+            if not self.wikidata_id.search(potential_wikipedia):
+                return potential_wikipedia
+        return None
 
 
     def sort_names_by_popularity(self, cluster):
@@ -543,12 +844,14 @@ class VIAFParser(XMLParser):
                           working_display_name=False):
         """ Extract name info from a single VIAF cluster.
 
+        :param cluster: An XML cluster or a VIAFClusterSummary.
         :return: a tuple containing:
         - ContributorData object filled with display, sort, family, and wikipedia names.
         - dictionary of ways the xml cluster data matched the names searched for.
         - list of titles attributed to the contributor in the cluster.
         or Nones on error.
         """
+        summary = self.summarize(cluster)
         contributor_data = ContributorData()
         contributor_titles = []
         match_confidences = {}
@@ -556,23 +859,19 @@ class VIAFParser(XMLParser):
         # Find out if one of the working names shows up in a name record.
         # Note: Potentially sets contributor_data.sort_name.
         match_confidences = self.cluster_has_record_for_named_author(
-                cluster, working_sort_name, working_display_name,
+                summary, working_sort_name, working_display_name,
                 contributor_data
         )
 
         # Get the VIAF ID for this cluster, just in case we don't have one yet.
-        viaf_tag = self._xpath1(cluster, './/*[local-name()="viafID"]')
-        if viaf_tag is None:
-            contributor_data.viaf = None
-        else:
-            contributor_data.viaf = viaf_tag.text
+        contributor_data.viaf = summary.viaf
 
         # If we don't have a working sort name, find the most popular
         # sort name in this cluster and use it as the sort name.
-        sort_name_popularity = self.sort_names_by_popularity(cluster)
+        sort_name_popularity = summary.sort_name_popularity()
 
         # Does this cluster have a Wikipedia page?
-        contributor_data.wikipedia_name = self.extract_wikipedia_name(cluster)
+        contributor_data.wikipedia_name = summary.wikipedia_name
         if contributor_data.wikipedia_name:
             contributor_data.display_name = self.wikipedia_name_to_display_name(contributor_data.wikipedia_name)
             working_display_name = contributor_data.display_name
@@ -581,11 +880,9 @@ class VIAFParser(XMLParser):
             # a band they're in.)
 
         known_name = working_sort_name or working_display_name
-        unimarcs = self._xpath(cluster, './/*[local-name()="datafield"][@dtype="UNIMARC"]')
         candidates = []
-        for unimarc in unimarcs:
-            (possible_given, possible_family,
-             possible_extra, possible_sort_name) = self.extract_name_from_unimarc(unimarc)
+        for (possible_given, possible_family,
+             possible_extra, possible_sort_name) in summary.unimarc_names:
             # Some part of this name must also show up in the original
             # name for it to even be considered. Otherwise it's a
             # better bet to try to munge the original name.
@@ -629,9 +926,7 @@ class VIAFParser(XMLParser):
 
 
         # Now go through the title elements, and make a list.
-        titles = self._xpath(cluster, './/*[local-name()="titles"]/*[local-name()="work"]/*[local-name()="title"]')
-        for title in titles:
-            contributor_titles.append(title.text)
+        contributor_titles.extend(summary.titles)
 
         return contributor_data, match_confidences, contributor_titles
 
@@ -715,7 +1010,8 @@ class VIAFParser(XMLParser):
                 ('b', 'given'),
                 ('c', 'extra'),
                 ):
-            value = self._xpath1(unimarc, 'ns2:subfield[@code="%s"]' % code)
+            values = self.UNIMARC_SUBFIELD(unimarc, code=code)
+            value = values[0] if values else None
             if value is not None and value.text:
                 value = value.text
                 value = self.remove_commas_from(value)
@@ -726,6 +1022,261 @@ class VIAFParser(XMLParser):
 
 
 
+class VIAFDumpIndex(object):
+    """A local index of the clusters in a VIAF data dump, so that
+    VIAFClient can answer lookups without going to the network.
+
+    VIAF publishes its clusters as a gzipped file with one cluster per
+    line: the cluster's ID, a tab, and the cluster's XML. Each cluster
+    is summarized as it's read. The index maps each VIAF ID to the
+    cluster's summary, and each normalized name in a cluster to the
+    IDs of the clusters with that name.
+
+    The dump doesn't include the library holdings counts VIAF sorts
+    search results by, so clusters are ranked by the number of works
+    they list instead.
+
+    The index is a SQLite database, read through a memory map.
+    """
+
+    SUBDIR = "VIAF"
+    FILENAME = "index.sqlite"
+
+    # Set this environment variable to the path of an index to have
+    # VIAFClient look there before going to the network.
+    PATH_VARIABLE = 'SIMPLIFIED_VIAF_DUMP_INDEX'
+
+    # Commit after reading this many lines of a dump. A load that's
+    # interrupted picks up after the last commit, and no more than
+    # this many clusters are held in memory at once.
+    BATCH_SIZE = 1000
+
+    # Map up to this many bytes of the index into memory.
+    MMAP_SIZE = 1024 * 1024 * 1024
+
+    # Look at this many of the clusters with a given name, at most.
+    MAX_CANDIDATES = 50
+
+    WORD = re.compile(r"\w+", re.UNICODE)
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS clusters (
+            viaf TEXT PRIMARY KEY, version INTEGER, works INTEGER,
+            summary BLOB
+        ) WITHOUT ROWID""",
+        """CREATE TABLE IF NOT EXISTS names (
+            key TEXT, viaf TEXT, works INTEGER, PRIMARY KEY (key, viaf)
+        ) WITHOUT ROWID""",
+        """CREATE TABLE IF NOT EXISTS dumps (
+            filename TEXT PRIMARY KEY, lines INTEGER, complete INTEGER
+        )""",
+    ]
+
+    _default = None
+
+    @classmethod
+    def default(cls):
+        """The index configured through the environment, or None if
+        there isn't one.
+        """
+        path = os.environ.get(cls.PATH_VARIABLE)
+        if not path or not os.path.exists(path):
+            return None
+        if not cls._default or cls._default.path != path:
+            cls._default = cls(path)
+        return cls._default
+
+    @classmethod
+    def from_data_directory(cls, data_directory):
+        """Load every gzipped VIAF dump in a directory into an index in
+        that same directory.
+
+        Loading a full dump takes hours, but it can be interrupted.
+        The next call picks up where the last one left off, and skips
+        dumps that were already loaded.
+        """
+        my_directory = os.path.join(data_directory, cls.SUBDIR)
+        index = cls(os.path.join(my_directory, cls.FILENAME))
+        a = time.time()
+        loaded = 0
+        for i in sorted(os.listdir(my_directory)):
+            if i.endswith(".xml.gz"):
+                loaded += index.load_dump(os.path.join(my_directory, i))
+        b = time.time()
+        index.log.info(
+            "Loaded %d %s clusters in %.1f sec", loaded, cls.SUBDIR, (b-a)
+        )
+        return index
+
+    def __init__(self, path):
+        self.path = path
+        self.parser = VIAFParser()
+        self.log = logging.getLogger("VIAF dump index")
+        # Lookups may come from whichever thread is using the
+        # VIAFClient.
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA mmap_size=%d" % self.MMAP_SIZE)
+        with self.connection:
+            for statement in self.SCHEMA:
+                self.connection.execute(statement)
+
+    @classmethod
+    def key(cls, name):
+        """Normalize a name for lookup. Word order doesn't matter, so a
+        sort name and a display name come out the same.
+        """
+        if not name:
+            return None
+        normalized = normalize_contributor_name_for_matching(name) or ""
+        return " ".join(sorted(cls.WORD.findall(normalized))) or None
+
+    def keys(self, summary):
+        """All the names a cluster can be found under."""
+        names = list(summary.sort_names) + list(summary.alternate_names)
+        names.extend(x[3] for x in summary.unimarc_names)
+        if summary.wikipedia_name:
+            names.append(
+                self.parser.wikipedia_name_to_display_name(
+                    summary.wikipedia_name
+                )
+            )
+        keys = set(self.key(name) for name in names)
+        keys.discard(None)
+        return keys
+
+    def summarize_line(self, line):
+        """Summarize the cluster on one line of a dump.
+
+        :return: A VIAFClusterSummary, or None if the line doesn't hold
+            a usable cluster.
+        """
+        line = line.strip()
+        if not line:
+            return None
+        viaf, tab, xml = line.partition("\t")
+        if not tab:
+            viaf, xml = None, line
+        try:
+            cluster = etree.fromstring(
+                xml.encode("utf8"), parser=etree.XMLParser(recover=True)
+            )
+        except etree.XMLSyntaxError as e:
+            self.log.warning("Could not parse cluster %s: %s", viaf, e)
+            return None
+        if cluster is None:
+            return None
+        summary = self.parser.summarize(cluster)
+        if not summary.viaf and viaf:
+            # The ID may be given as a URL.
+            summary.viaf = viaf.rstrip("/").rsplit("/", 1)[-1]
+        return summary
+
+    def load_dump(self, path):
+        """Load the clusters in a gzipped dump, resuming a previous load
+        of the same file if there was one.
+
+        :return: The number of clusters loaded.
+        """
+        filename = os.path.basename(path)
+        progress = self.connection.execute(
+            "SELECT lines, complete FROM dumps WHERE filename=?", (filename,)
+        ).fetchone()
+        done, complete = progress or (0, False)
+        if complete:
+            self.log.info("Already loaded %s.", path)
+            return 0
+        if done:
+            self.log.info("Resuming %s after line %d.", path, done)
+        else:
+            self.log.info("Loading %s.", path)
+
+        loaded = 0
+        batch = []
+        line_number = done
+        with gzip.open(path, 'rt', encoding="utf-8") as dump:
+            for line_number, line in enumerate(dump, 1):
+                if line_number <= done:
+                    continue
+                batch.append(line)
+                if len(batch) >= self.BATCH_SIZE:
+                    loaded += self.load_lines(filename, batch, line_number)
+                    batch = []
+        loaded += self.load_lines(filename, batch, line_number, complete=True)
+        return loaded
+
+    def load_lines(self, filename, lines, line_number, complete=False):
+        """Load a batch of lines from a dump and record how far into the
+        dump we've gotten, in a single transaction.
+
+        :return: The number of clusters loaded.
+        """
+        clusters = []
+        names = []
+        for line in lines:
+            summary = self.summarize_line(line)
+            if not summary or not summary.viaf:
+                continue
+            works = len(summary.titles)
+            clusters.append((
+                summary.viaf, VIAFClusterSummary.VERSION, works,
+                compress(summary.to_json().encode("utf8"))
+            ))
+            for key in self.keys(summary):
+                names.append((key, summary.viaf, works))
+
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO clusters VALUES (?, ?, ?, ?)",
+                clusters
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO names VALUES (?, ?, ?)", names
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO dumps VALUES (?, ?, ?)",
+                (filename, line_number, complete)
+            )
+        return len(clusters)
+
+    @classmethod
+    def _summary(cls, stored):
+        return VIAFClusterSummary.from_json(
+            decompress(bytes(stored)).decode("utf8")
+        )
+
+    def summary(self, viaf):
+        """Find the summary of the cluster with the given ID.
+
+        :return: A VIAFClusterSummary, or None if the cluster isn't in
+            the index.
+        """
+        row = self.connection.execute(
+            "SELECT summary FROM clusters WHERE viaf=? AND version=?",
+            (viaf, VIAFClusterSummary.VERSION)
+        ).fetchone()
+        if not row:
+            return None
+        return self._summary(row[0])
+
+    def search(self, name):
+        """Find the clusters with the given name.
+
+        :return: A list of VIAFClusterSummary objects, the ones with the
+            most works first.
+        """
+        key = self.key(name)
+        if not key:
+            return []
+        rows = self.connection.execute(
+            """SELECT clusters.summary FROM names
+            JOIN clusters ON clusters.viaf=names.viaf
+            WHERE names.key=? AND clusters.version=?
+            ORDER BY names.works DESC, names.viaf LIMIT ?""",
+            (key, VIAFClusterSummary.VERSION, self.MAX_CANDIDATES)
+        )
+        return [self._summary(summary) for [summary] in rows]
+
+
 class VIAFClient(object):
 
     LOOKUP_URL = 'http://viaf.org/viaf/%(viaf)s/viaf.xml'
@@ -736,10 +1287,103 @@ class VIAFClient(object):
     MEDIA_TYPE = Representation.TEXT_XML_MEDIA_TYPE
     REPRESENTATION_MAX_AGE = 60*60*24*30*6    # 6 months
 
-    def __init__(self, _db):
+    # From OCLC tech support: VIAF's SRU endpoint can only return a
+    # maximum of 10 records when the recordSchema is
+    # http://viaf.org/VIAFCluster.
+    PAGE_SIZE = 10
+
+    # Limit ourselves to reading the first 500 VIAF clusters, on the
+    # assumption that search match quality is unlikely to be usable
+    # after that.
+    MAX_PAGES = 50
+
+    # select_best_match() won't accept a candidate with less weight
+    # than this.
+    MINIMUM_MATCH_WEIGHT = 70
+
+    # Stop paging through search results once the best candidate so
+    # far outweighs anything on the remaining pages by this much. At
+    # zero, the result is the same as if every page had been read. A
+    # negative margin stops sooner, at the risk of missing a slightly
+    # better match.
+    EARLY_TERMINATION_MARGIN = 0
+
+    # Once it's clear that a search needs more than one page of
+    # results, fetch this many pages at a time.
+    PAGE_CONCURRENCY = 4
+
+    # Keep this many cluster summaries in memory, in front of the
+    # ones stored in the database.
+    SUMMARY_CACHE_SIZE = 1000
+
+    def __init__(self, _db, rate_limiter=None, circuit_breaker=None,
+                 early_termination_margin=None, page_concurrency=None,
+                 dump_index=None):
+        """Constructor.
+
+        :param dump_index: A VIAFDumpIndex to consult before going to
+            the network. Defaults to the one configured through the
+            environment, if any.
+        """
         self._db = _db
         self.parser = VIAFParser()
         self.log = logging.getLogger("VIAF Client")
+        self.rate_limiter = rate_limiter or RateLimiter(_db)
+        self.circuit_breaker = circuit_breaker or CircuitBreaker(_db)
+        if early_termination_margin is None:
+            early_termination_margin = self.EARLY_TERMINATION_MARGIN
+        self.early_termination_margin = early_termination_margin
+        self.page_concurrency = page_concurrency or self.PAGE_CONCURRENCY
+        self.dump_index = dump_index or VIAFDumpIndex.default()
+
+        # How many pages of search results each lookup_by_name() call
+        # has needed, as a histogram.
+        self.pages_per_lookup = Counter()
+
+        self.summary_max_age = datetime.timedelta(
+            seconds=self.REPRESENTATION_MAX_AGE
+        )
+        self.summary_cache = LRUCache(
+            self.SUMMARY_CACHE_SIZE, max_age=self.summary_max_age
+        )
+
+    def _fetch(self, do_get=None):
+        """The HTTP GET function to use, without the guards that keep
+        track of shared upstream state.
+        """
+        return protect(
+            do_get or Representation.simple_http_get, Compressor()
+        )
+
+    def _guard(self, do_get=None):
+        return protect(
+            self._fetch(do_get), self.circuit_breaker, self.rate_limiter
+        )
+
+    def _prefetcher(self):
+        """A Prefetcher that applies this client's rate limiter and
+        circuit breaker.
+        """
+        return Prefetcher(
+            self.page_concurrency, self.rate_limiter, self.circuit_breaker
+        )
+
+    def _get(self, url, do_get=None, prefetcher=None):
+        """Retrieve a VIAF document, through the cache if possible.
+
+        :param prefetcher: An upstream.Prefetcher that may already
+            have fetched the document.
+        """
+        do_get = self._guard(do_get)
+        if prefetcher:
+            do_get = prefetcher.wrap(do_get)
+        return get_representation(
+            self._db, url, do_get, max_age=self.REPRESENTATION_MAX_AGE
+        )
+
+    def _is_cached(self, url):
+        """Is there a fresh copy of this document in the cache?"""
+        return is_cached(self._db, url, self.REPRESENTATION_MAX_AGE)
 
     @property
     def data_source(self):
@@ -752,8 +1396,13 @@ class VIAFClient(object):
         Finds any possible duplicate Contributor objects in our database, and
         updates them with the information gleaned from VIAF.
 
-        :return: a ContributorData object filled with display, sort, family, and wikipedia names
-        from VIAF or None on error.
+        :return: A 2-tuple (contributor, match). `contributor` is the
+            Contributor that ended up with the VIAF data: either the one
+            passed in or, if that turned out to be a duplicate, the
+            earlier Contributor it was merged into. `match` is a
+            3-tuple (ContributorData, match_confidences,
+            contributor_titles) describing the VIAF cluster that was
+            applied, or None if no good match was found.
         """
         if contributor.viaf:
             contributor_candidate = self.lookup_by_viaf(
@@ -772,7 +1421,7 @@ class VIAFClient(object):
             )
         if not contributor_candidate:
             # No good match was identified.
-            return None
+            return contributor, None
 
         (selected_candidate, match_confidences, contributor_titles) = contributor_candidate
         if selected_candidate.viaf is not None:
@@ -784,20 +1433,22 @@ class VIAFClient(object):
                 if earliest_duplicate.display_name == selected_candidate.display_name:
                     selected_candidate.apply(earliest_duplicate)
                     contributor.merge_into(earliest_duplicate)
-                    return
+                    return earliest_duplicate, contributor_candidate
                 else:
                     # TODO: This might be okay or it might be a
                     # problem we need to address. Whatever it is,
                     # don't merge the records. Instead, apply the VIAF
                     # data to the provided contributor, potentially
                     # creating an accursed duplicate.
-                    self.log.warn(
+                    self.log.warning(
                         "AVOIDING POSSIBLE SPURIOUS AUTHOR MERGE: %r => %r",
                         selected_candidate, earliest_duplicate
                     )
             selected_candidate.apply(contributor)
+        return contributor, contributor_candidate
 
-    def select_best_match(self, candidates, working_sort_name, known_titles=None):
+    def select_best_match(self, candidates, working_sort_name, known_titles=None,
+                          matcher=None):
         """Gets the best VIAF match from a series of potential matches
 
         Return a tuple containing the selected_candidate (a ContributorData
@@ -805,13 +1456,15 @@ class VIAFClient(object):
         contributor.
 
         :param known_titles: A list of titles we know this author wrote.
+        :param matcher: A TitleMatcher that may already have compared
+            some of the titles.
         """
 
         # Sort for the best match and select the first.
         candidates = self.parser.order_candidates(
             working_sort_name=working_sort_name,
             contributor_candidates=candidates,
-            known_titles=known_titles
+            known_titles=known_titles, matcher=matcher
         )
         if not candidates:
             return None
@@ -819,39 +1472,110 @@ class VIAFClient(object):
         (selected_candidate, match_confidences, contributor_titles) = candidates[0]
 
         if (not selected_candidate or "total" not in match_confidences or
-            match_confidences["total"] < 70):
+            match_confidences["total"] < self.MINIMUM_MATCH_WEIGHT):
             # The best match is dubious. Best to avoid this.
             return None
 
         return selected_candidate, match_confidences, contributor_titles
 
 
-    def lookup_name_title(self, viaf, do_get=None):
-        url = self.LOOKUP_URL % dict(viaf=viaf)
-        r, cached = Representation.get(
-            self._db, url, do_get=do_get, max_age=self.REPRESENTATION_MAX_AGE
-        )
+    def cluster_summary(self, viaf, do_get=None):
+        """Find a summary of the VIAF cluster with the given ID.
 
-        xml = r.content
-        cluster = etree.fromstring(xml, parser=etree.XMLParser(recover=True))
-
-        titles = []
-        for potential_title in self.parser.name_titles_for_cluster(cluster):
-            titles.append(potential_title)
-        return titles
+        The summary comes from memory if possible, then from the
+        database, then from the VIAF dump index. Only if none of them
+        has a copy is the cluster fetched and parsed.
 
+        :return: A VIAFClusterSummary. If the cluster couldn't be
+            retrieved, the summary is empty, and it isn't kept, so the
+            next lookup tries again.
+        """
+        summary = self.summary_cache.get(viaf)
+        if summary:
+            return summary
+
+        stored = get_one(self._db, VIAFCluster, viaf=viaf)
+        if stored and stored.is_fresh(
+            self.summary_max_age, VIAFClusterSummary.VERSION
+        ):
+            summary = VIAFClusterSummary.from_json(stored.summary)
+            timestamp = stored.timestamp
+        elif self.dump_index:
+            summary = self.dump_index.summary(viaf)
+            timestamp = utc_now()
+
+        if not summary:
+            url = self.LOOKUP_URL % dict(viaf=viaf)
+            r, cached = self._get(url, do_get)
+            content = None
+            if (not r.fetch_exception and r.status_code
+                and r.status_code // 100 == 2):
+                content = representation_content(r)
+            cluster = None
+            if content:
+                cluster = etree.fromstring(
+                    content, parser=etree.XMLParser(recover=True)
+                )
+            if cluster is None:
+                self.log.warning(
+                    "Could not retrieve VIAF cluster %s: status=%s, %s",
+                    viaf, r.status_code, r.fetch_exception
+                )
+                return VIAFClusterSummary()
+            summary = self.parser.summarize(cluster)
+
+            # The summary goes stale along with the document it came
+            # from.
+            timestamp = r.fetched_at or utc_now()
+            VIAFCluster.store(
+                self._db, viaf, summary.to_json(), VIAFClusterSummary.VERSION,
+                timestamp
+            )
+        self.summary_cache.set(viaf, summary, timestamp)
+        return summary
 
+    def lookup_name_title(self, viaf, do_get=None):
+        return list(self.cluster_summary(viaf, do_get).name_titles)
 
     def lookup_by_viaf(self, viaf, working_sort_name=None,
                        working_display_name=None, do_get=None):
-        url = self.LOOKUP_URL % dict(viaf=viaf)
-        r, cached = Representation.get(
-            self._db, url, do_get=do_get, max_age=self.REPRESENTATION_MAX_AGE
+        summary = self.cluster_summary(viaf, do_get)
+        return self.parser.extract_viaf_info(
+            summary, working_sort_name, working_display_name
         )
 
-        xml = r.content
-        return self.parser.parse(xml, working_sort_name, working_display_name)
 
+    def search_url(self, author_name, page):
+        """The URL to page `page` of VIAF search results for an author."""
+        scope = 'local.personalNames'
+        if is_corporate_name(author_name):
+            scope = 'local.corporateNames'
+        return self.SEARCH_URL.format(
+            scope=scope, author_name=author_name.encode("utf8"),
+            maximum_records=self.PAGE_SIZE,
+            start_record=1 + self.PAGE_SIZE * (page-1)
+        )
+
+    def can_stop_paging(self, page, best_weight, known_titles=None,
+                        ignore_popularity=False):
+        """Is there no point in reading page `page` of search results, or
+        any page after it?
+
+        :param best_weight: The weight of the best candidate found so
+            far, or None if there are no candidates yet.
+        """
+        if page > self.MAX_PAGES:
+            return True
+        ceiling = self.parser.max_possible_weight(
+            1 + self.PAGE_SIZE * (page-1), known_titles, ignore_popularity
+        )
+        if ceiling < self.MINIMUM_MATCH_WEIGHT:
+            # Nothing on this page or any later page could be accepted.
+            return True
+        return (
+            best_weight is not None and
+            best_weight >= ceiling + self.early_termination_margin
+        )
 
     def lookup_by_name(self, sort_name, display_name=None, do_get=None,
                        known_titles=None):
@@ -860,6 +1584,14 @@ class VIAFClient(object):
         author name.  Selects the cluster we deem the best match for
         the author we mean.
 
+        If there's a VIAF dump index and it has a good match, the
+        network isn't used at all.
+
+        Candidates are weighed as each page of results comes in, and
+        paging stops once no later page could hold a better match.
+        If more than one page is needed, the next few pages are
+        fetched concurrently.
+
         :param sort_name: Author name in Last, First format.
         :param display_name: Author name in First Last format.
         :param do_get: Ask Representation to use Http GET?
@@ -867,53 +1599,123 @@ class VIAFClient(object):
         :return: (selected_candidate, match_confidences, contributor_titles) for selected ContributorData.
         """
         author_name = sort_name or display_name
-        # from OCLC tech support:
-        # VIAF's SRU endpoint can only return a maximum number of 10 records
-        # when the recordSchema is http://viaf.org/VIAFCluster
-        maximum_records = 10 # viaf maximum that's not ignored
-        page = 1
-        contributor_candidates = []
-
-        # limit ourselves to reading the first 500 viaf clusters, on the
-        # assumption that search match quality is unlikely to be usable after that.
-        for page in range (1, 51):
-            start_record = 1 + maximum_records * (page-1)
-            scope = 'local.personalNames'
-            if is_corporate_name(author_name):
-                scope = 'local.corporateNames'
-
-            url = self.SEARCH_URL.format(
-                scope=scope, author_name=author_name.encode("utf8"),
-                maximum_records=maximum_records, start_record=start_record
+        if self.dump_index:
+            best_match = self.lookup_by_name_in_dump(
+                sort_name, display_name, known_titles
             )
-            representation, cached = Representation.get(
-                self._db, url, do_get=do_get, max_age=self.REPRESENTATION_MAX_AGE
-            )
-            xml = representation.content
+            if best_match:
+                self.pages_per_lookup[0] += 1
+                return best_match
 
-            candidates = self.parser.parse_multiple(xml, sort_name, display_name, page)
-            if not any(candidates):
-                # Delete the representation so it's not cached.
-                self._db.query(Representation).filter(
-                    Representation.id==representation.id
-                ).delete()
-                # We ran out of clusters, so we can relax and move on to
-                # ordering the returned results
-                break
+        contributor_candidates = []
+        best_weight = None
+        # Every candidate is weighed once when its page is read, and
+        # again by select_best_match, so share title comparisons
+        # between the two.
+        matcher = TitleMatcher()
+        ignore_popularity = False
+        pages_read = pages_fetched = 0
+
+        with self._prefetcher() as prefetcher:
+            page = 1
+            while not self.can_stop_paging(
+                    page, best_weight, known_titles, ignore_popularity
+            ):
+                url = self.search_url(author_name, page)
+                if page > 1 and url not in prefetcher.responses:
+                    # One page wasn't enough. Fetch the next few pages that
+                    # could still make a difference all at once.
+                    urls = []
+                    for later in range(page, page + self.page_concurrency):
+                        if self.can_stop_paging(
+                            later, best_weight, known_titles, ignore_popularity
+                        ):
+                            break
+                        later_url = self.search_url(author_name, later)
+                        if not self._is_cached(later_url):
+                            urls.append(later_url)
+                    if len(urls) > 1:
+                        # These documents will be asked for with no
+                        # extra headers, apart from the conditional
+                        # ones sent for a stale copy, which the
+                        # Prefetcher doesn't hold against them.
+                        prefetcher.prefetch(self._fetch(do_get), urls, {})
+
+                representation, cached = self._get(url, do_get, prefetcher)
+                pages_read += 1
+                if not cached:
+                    pages_fetched += 1
+                xml = representation_content(representation)
+
+                candidates = self.parser.parse_multiple(xml, sort_name, display_name, page)
+                if not any(candidates):
+                    # Delete the representation so it's not cached.
+                    self._db.query(Representation).filter(
+                        Representation.id==representation.id
+                    ).delete()
+                    # We ran out of clusters, so we can relax and move on to
+                    # ordering the returned results
+                    break
 
-            contributor_candidates.extend(candidates)
-            page += 1
+                contributor_candidates.extend(candidates)
+                if page == 1:
+                    ignore_popularity = self.parser.should_ignore_popularity(
+                        contributor_candidates
+                    )
+                for weight in self.parser.weigh_candidates(
+                    candidates, author_name, known_titles=known_titles,
+                    ignore_popularity=ignore_popularity, matcher=matcher
+                ):
+                    if best_weight is None or weight > best_weight:
+                        best_weight = weight
+                page += 1
+
+        self.pages_per_lookup[pages_read] += 1
+        self.log.info(
+            "Read %d page(s) of VIAF search results for %r, %d from the network.",
+            pages_read, author_name, pages_fetched
+        )
 
         best_match = self.select_best_match(candidates=contributor_candidates,
-            working_sort_name=author_name, known_titles=known_titles)
+            working_sort_name=author_name, known_titles=known_titles,
+            matcher=matcher)
 
         return best_match
 
+    def lookup_by_name_in_dump(self, sort_name, display_name=None,
+                               known_titles=None):
+        """Find the best match for an author name among the clusters in
+        the VIAF dump index.
+
+        :return: The same as lookup_by_name(), or None if the index
+            has no good match.
+        """
+        author_name = sort_name or display_name
+        candidates = []
+        for popularity, summary in enumerate(
+            self.dump_index.search(author_name), 1
+        ):
+            (contributor_data, match_confidences,
+             contributor_titles) = self.parser.extract_viaf_info(
+                 summary, sort_name, display_name
+            )
+            match_confidences["library_popularity"] = popularity
+            candidates.append(
+                (contributor_data, match_confidences, contributor_titles)
+            )
+        return self.select_best_match(
+            candidates=candidates, working_sort_name=author_name,
+            known_titles=known_titles
+        )
+
 
 class MockVIAFClient(VIAFClient):
 
     def __init__(self, _db):
-        super(MockVIAFClient, self).__init__(_db)
+        super(MockVIAFClient, self).__init__(
+            _db, rate_limiter=MockRateLimiter(),
+            circuit_breaker=MockCircuitBreaker()
+        )
         self.log = logging.getLogger("Mocked VIAF Client")
         base_path = os.path.split(__file__)[0]
         self.resource_path = os.path.join(base_path, "tests", "files", "viaf")